@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import cv2
+import numpy as np
+
+
+class BandBlobDetector(object):
+
+    '''
+    Incremental blob detector for a waterfall image that grows one row per
+    ping. Each update only labels the band of rows that can still change:
+    the new rows, the rows of the blobs that touched the last row of the
+    previous update (they may keep growing) and a margin.
+
+    A blob is final once it doesn't touch the newest row, since the following
+    rows can't connect to it anymore. It is then filtered by area and
+    circularity, like cv2.SimpleBlobDetector, and reported exactly once.
+
+    The rows are indexed globally, as counted by the WaterfallBuffer.
+    '''
+
+    def __init__(self, threshold=1., outlier=10., min_area=50, max_area=300,
+                 min_circularity=0.3, max_circularity=0.8, margin=2):
+
+        '''
+        threshold: min difference of a blob pixel [m]
+        outlier: differences over it are ignored [m]
+        min_area, max_area: blob area bounds [pixels]
+        min_circularity, max_circularity: bounds of 4 pi area / perimeter^2
+        margin: rows of context above the band
+        '''
+
+        self.threshold = threshold
+        self.outlier = outlier
+        self.min_area = min_area
+        self.max_area = max_area
+        self.min_circularity = min_circularity
+        self.max_circularity = max_circularity
+        self.margin = margin
+
+        # the blobs ending before this row have been reported already
+        self.done = 0
+        # first row of the blobs still open
+        self.open_from = 0
+
+    def update(self, waterfall, count):
+
+        '''
+        Reports the blobs finished since the previous update
+        waterfall: (h,beams) numpy array, latest rows of the waterfall, oldest first
+        count: global index of the row after the last one of waterfall
+        returns:
+            blobs: list of (row, col) centroids, with global rows
+        '''
+
+        first = count - len(waterfall)
+        start = max(min(self.open_from, self.done) - self.margin, first)
+        band = waterfall[start - first:]
+        mask = ((band > self.threshold) & (band < self.outlier)).astype(np.uint8)
+
+        n, labels, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
+
+        blobs = []
+        open_from = count
+        for k in range(1, n):
+            x, y, w, h, area = stats[k]
+            top = start + y
+            bottom = top + h - 1
+            if bottom == count - 1:
+                # may still grow with the next rows
+                open_from = min(open_from, top)
+                continue
+            if bottom < self.done or not self.min_area <= area <= self.max_area:
+                continue
+
+            blob = (labels[y:y+h, x:x+w] == k).astype(np.uint8)
+            contours = cv2.findContours(blob, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)[-2]
+            perimeter = max(cv2.arcLength(c, True) for c in contours)
+            circularity = 4. * np.pi * area / max(perimeter, 1.)**2
+            if self.min_circularity <= circularity <= self.max_circularity:
+                blobs.append((start + centroids[k, 1], centroids[k, 0]))
+
+        self.done = count - 1
+        self.open_from = open_from
+
+        return blobs
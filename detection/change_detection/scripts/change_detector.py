@@ -7,7 +7,6 @@ import scipy.misc
 from PIL import Image
 
 import numpy as np
-import scipy.interpolate
 import math
 import matplotlib.pyplot as plt
 
@@ -18,10 +17,13 @@ from tf.transformations import rotation_matrix, rotation_from_matrix, translatio
 from sensor_msgs.msg import PointCloud2
 from nav_msgs.msg import Odometry
 from geometry_msgs.msg import Pose, PoseArray, Transform, PoseWithCovarianceStamped, Vector3
-import sensor_msgs.point_cloud2 as pc2
+from auv_utils.ping_codec import decode_cloud, ping_ranges
 
 import message_filters
 
+from waterfall_buffer import WaterfallBuffer
+from band_detector import BandBlobDetector
+
 class ChangeDetector(object):
 
     def __init__(self):
@@ -33,6 +35,8 @@ class ChangeDetector(object):
         auv_exp_mbes_top = rospy.get_param("~expected_mbes_topic", '/pf/avg_mbes')
         pf_pose_top = rospy.get_param("~average_pose_topic", '/pf/avg_pose')
         detection_top = rospy.get_param("~detection_topic", '/detection_pose')
+        # Detections closer than this to a published one are the same car
+        self.dedup_radius = rospy.get_param("~dedup_radius", 5.)
 
         self.auv_mbes = message_filters.Subscriber(auv_mbes_top, PointCloud2)
         self.exp_mbes = message_filters.Subscriber(auv_exp_mbes_top, PointCloud2)
@@ -61,126 +65,69 @@ class ChangeDetector(object):
             rospy.loginfo("ERROR: Could not lookup transform from base_link to mbes_link")
 
 
-        # Register cb after tf is locked
-        self.ts.registerCallback(self.pingCB)
-
         plt.ion()
         plt.show()
 
         self.ping_cnt = 0
-        self.scale = 1
         self.max_height = 250 # TODO: this should equal the n beams in ping
-        self.new_msg = False
-        first_msg = True
-        self.waterfall =[]
-        self.active_auv_poses = []
-        self.active_pf_pings = []
-        self.detector = self.init_blob_detector()
+        # Latest rows of the waterfall with their PF pings and AUV poses,
+        # filled by pingCB and read by the detection loop
+        self.waterfall = WaterfallBuffer(self.max_height, self.max_height)
+        self.detector = BandBlobDetector(threshold=rospy.get_param("~diff_threshold", 1.))
+        # Positions of the cars published so far
+        self.published = np.zeros((0, 3))
+
+        # Register cb after tf is locked and the buffer allocated
+        self.ts.registerCallback(self.pingCB)
 
         #Init detection publisher
         self.detection_pb = rospy.Publisher(detection_top, PoseArray, queue_size=10)
 
         rospy.loginfo("Change detection node created")
 
-        detections = PoseArray()
-        detections.header.frame_id = 'map'
+        count = 0
         while not rospy.is_shutdown():
-            if self.new_msg:
-                #Visualize
-                detection = False
-                if len(self.waterfall)==self.max_height:
-                    waterfall_detect, centroids_row, centroids_col, detection = self.car_detection(np.array(self.waterfall), self.scale)
-                    # Visualize detection markers
-                    if len(centroids_row) > 0:
-                        for i in range(len(centroids_row)):
-                            row = centroids_row[i]
-                            col = centroids_col[i]
-
-                            det_msg = Pose()
-                            #  det_msg.pose = self.active_auv_poses[row].pose
-                            det_msg.position.x = self.active_pf_pings[row][col][0]
-                            det_msg.position.y = self.active_pf_pings[row][col][1]
-                            det_msg.position.z = self.active_pf_pings[row][col][2]
-                            det_msg.orientation.y = 0.7071068
-                            det_msg.orientation.w = 0.7071068
-                            detections.poses.append(det_msg)
-                if detection:
-                    plt.imshow(np.array(waterfall_detect), norm=plt.Normalize(0., 5.),
-                            cmap='gray', aspect='equal', origin = "lower")
-                else:
-                    plt.imshow(np.array(self.waterfall), norm=plt.Normalize(0., 5.),
-                            cmap='gray', aspect='equal', origin = "lower")
-                if first_msg:
-                    first_msg = False
-                    #  plt.colorbar()
-                    plt.title("Bathymetry difference (m)")
-
-                plt.pause(0.01)
-
-            self.new_msg = False
-            self.detection_pb.publish(detections)
-
-    def init_blob_detector(self):
-        # Setup SimpleBlobDetector parameters.
-        params = cv2.SimpleBlobDetector_Params()
-
-        params.blobColor = 255
-        params.minThreshold = 0
-        params.maxThreshold = 255
-
-        params.filterByArea = True
-        params.minArea = int(50*self.scale**2)
-        params.maxArea = int(300*self.scale**2)
-
-        params.filterByCircularity = True
-        params.minCircularity = 0.3
-        params.maxCircularity = 0.8
-
-        params.filterByConvexity = False
-        params.minConvexity = 0.87
-        return cv2.SimpleBlobDetector_create(params)
-
-
-    def car_detection(self, img_array, scale):
-        # Turn numpy array into cv2 image (and make bigger)
-        img_array = np.float32(img_array)
-
-        #Filter out outliers
-        img_array = np.where(img_array < 10, img_array, np.median(img_array))
-
-        #Normalize between 0-255 black-white
-        img_array *= (255.0/img_array.max())
-        f = scipy.interpolate.RectBivariateSpline(np.linspace(0 ,1 , np.size(img_array, 0)),
-                                                  np.linspace(0, 1, np.size(img_array, 1)), img_array)
-        scaled_img_array = f(np.linspace(0, 1, scale*np.size(img_array, 0)),
-                      np.linspace(0, 1, scale*np.size(img_array, 1)))
-
-        gray_img = scaled_img_array.astype(np.uint8)
-
-
-        # Detect blobs.
-        keypoints = self.detector.detect(gray_img)
-        rows, cols = [], []
-        if len(keypoints) != 0:
-            for keypoint in keypoints:
-                rows.append(int(keypoint.pt[1]/scale))
-                cols.append(int(keypoint.pt[0]/scale))
-
-        im_with_keypoints = cv2.drawKeypoints(gray_img, keypoints, np.array([]), (0,0,255),
-                                              cv2.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS)
-
-        out_img_array = np.empty((np.size(img_array,0), np.size(img_array,1) ,3), dtype=float)
-        for i in range(np.size(im_with_keypoints,2)):
-            f = scipy.interpolate.RectBivariateSpline(np.linspace(0 ,255, np.size(im_with_keypoints, 0)),
-                                    np.linspace(0,255, np.size(im_with_keypoints, 1)), im_with_keypoints[:,:,i])
-            out_img_array[:,:,i] = f(np.linspace(0, 255, np.size(img_array, 0)),
-                                     np.linspace(0, 255, np.size(img_array, 1)))
-
-        out_img_array = out_img_array.astype(np.uint8)
-        detection = False
-        if len(keypoints) > 0:
-            detection = True
-        return out_img_array, rows, cols, detection
+            # Sleep until pingCB appends new rows
+            if not self.waterfall.wait(count, timeout=0.1):
+                continue
+            # Zero-copy window of the latest rows
+            count, waterfall, active_pf_pings, _ = self.waterfall.window()
+
+            # Only the rows added since the last frame are labelled
+            blobs = self.detector.update(waterfall, count)
+            first = count - len(waterfall)
+            rows = np.array([int(b[0]) - first for b in blobs], dtype=int)
+            cols = np.array([int(b[1]) for b in blobs], dtype=int)
+            centroids = active_pf_pings[rows, cols]
+            # Drop them if pingCB has overwritten the window meanwhile
+            if not self.waterfall.valid(count):
+                centroids = []
+
+            detections = PoseArray()
+            detections.header.frame_id = 'map'
+            for centroid in centroids:
+                if np.any(np.linalg.norm(self.published - centroid, axis=1) < self.dedup_radius):
+                    continue
+                self.published = np.vstack((self.published, centroid))
+                det_msg = Pose()
+                det_msg.position.x = centroid[0]
+                det_msg.position.y = centroid[1]
+                det_msg.position.z = centroid[2]
+                det_msg.orientation.y = 0.7071068
+                det_msg.orientation.w = 0.7071068
+                detections.poses.append(det_msg)
+            # Only the new cars
+            if detections.poses:
+                self.detection_pb.publish(detections)
+
+            #Visualize
+            plt.cla()
+            plt.imshow(waterfall, norm=plt.Normalize(0., 5.),
+                    cmap='gray', aspect='equal', origin = "lower")
+            plt.plot(cols, rows, 'ro', fillstyle='none', markersize=10)
+            plt.title("Bathymetry difference (m)")
+
+            plt.pause(0.01)
 
     def pcloud2ranges(self, point_cloud, tf_mat):
         angle, direc, point = rotation_from_matrix(tf_mat)
@@ -190,27 +137,9 @@ class ChangeDetector(object):
         t = translation_from_matrix(tf_mat)
         t_inv = rot_inv.dot(t)
 
-        ranges = []
-        for p in pc2.read_points(point_cloud, field_names = ("x", "y", "z"), skip_nans=True):
-            p_part = rot_inv.dot(p) - t_inv
-            ranges.append(np.linalg.norm(p_part[-2:]))
-
-        return np.asarray(ranges)
-
-    def ping2ranges(self, point_cloud):
-        ranges = []
-        for p in pc2.read_points(point_cloud, field_names = ("x", "y", "z"), skip_nans=True):
-            ranges.append(np.linalg.norm(p[-2:]))
+        p_part = np.matmul(decode_cloud(point_cloud), rot_inv.T) - t_inv
 
-        return np.asarray(ranges)
-
-    def ping2vecs(self, point_cloud, tf_mat):
-
-        ranges = []
-        for p in pc2.read_points(point_cloud, field_names = ("x", "y", "z"), skip_nans=True):
-            ranges.append(p)
-
-        return np.asarray(ranges)
+        return np.linalg.norm(p_part[:, -2:], axis=1)
 
 
     def pingCB(self, auv_ping, exp_ping, auv_pose, pf_pose):
@@ -221,7 +150,7 @@ class ChangeDetector(object):
             tf_mat = self.matrix_from_tf(particle_tf)
             m2auv = np.matmul(self.m2o_mat, np.matmul(tf_mat, self.base2mbes_mat))
 
-            auv_ping_ranges = self.ping2ranges(auv_ping)
+            auv_ping_ranges = ping_ranges(auv_ping)
             exp_ping_ranges = self.pcloud2ranges(exp_ping, m2auv)
             #  print "------"
             #  print len(auv_ping_ranges)
@@ -230,17 +159,13 @@ class ChangeDetector(object):
             # TODO: do the trimming of pings better than this
             idx1 = np.round(np.linspace(0, len(exp_ping_ranges)-1 , self.max_height)).astype(int)
             idx2 = np.round(np.linspace(0, len(auv_ping_ranges) - 40, self.max_height)).astype(int)
-            self.waterfall.append(abs(auv_ping_ranges[idx2] - exp_ping_ranges[idx1]))
-            self.active_auv_poses.append(auv_pose)
-            beams_vec = self.ping2vecs(exp_ping, m2auv)
-            self.active_pf_pings.append(beams_vec[idx1])
-
-            if len(self.waterfall)>self.max_height:
-                self.waterfall.pop(0)
-                self.active_auv_poses.pop(0)
-                self.active_pf_pings.pop(0)
-
-            self.new_msg = True
+            beams_vec = decode_cloud(exp_ping)
+            pose = auv_pose.pose.pose
+            self.waterfall.append(abs(auv_ping_ranges[idx2] - exp_ping_ranges[idx1]),
+                                  beams_vec[idx1],
+                                  [pose.position.x, pose.position.y, pose.position.z,
+                                   pose.orientation.x, pose.orientation.y,
+                                   pose.orientation.z, pose.orientation.w])
 
         except rospy.ROSInternalException:
             pass
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+import threading
+import numpy as np
+
+
+class WaterfallBuffer(object):
+
+    '''
+    Sliding window over the latest max_height rows of a waterfall image,
+    with the expected beams and the AUV pose of each row, handed off from
+    a subscriber callback to a processing loop.
+
+    The rows live in a preallocated ring of N = max_height + slack slots
+    which is mirrored: slot s is written at rows s and s + N of a (2N, ...)
+    array, so the latest max_height rows are always contiguous and the
+    window is a view, oldest row first, without any copy.
+
+    The writer can append slack rows before it overwrites the rows of a
+    window taken by the reader, which checks with valid(count) that the
+    window it worked on is still intact.
+    '''
+
+    def __init__(self, max_height, beams, slack=None):
+
+        '''
+        max_height: number of rows of the window
+        beams: number of beams per row
+        slack: appends a window survives, max_height by default
+        '''
+
+        self.max_height = max_height
+        self.slack = max_height if slack is None else slack
+        self.n_slots = max_height + self.slack
+
+        self.waterfall = np.zeros((2 * self.n_slots, beams), dtype=np.float32)
+        self.pings = np.zeros((2 * self.n_slots, beams, 3))
+        # [x, y, z, qx, qy, qz, qw] of the AUV
+        self.poses = np.zeros((2 * self.n_slots, 7))
+
+        # total number of rows appended, the head is count % n_slots
+        self.count = 0
+        self.cond = threading.Condition()
+
+    def append(self, row, pings, pose):
+
+        '''
+        row: (beams,) numpy array, waterfall row
+        pings: (beams,3) numpy array, expected beams of the row
+        pose: (7,) numpy array, AUV position and orientation
+        '''
+
+        with self.cond:
+            s = self.count % self.n_slots
+            for data, x in ((self.waterfall, row), (self.pings, pings), (self.poses, pose)):
+                data[s] = x
+                data[s + self.n_slots] = x
+            self.count += 1
+            self.cond.notify_all()
+
+    def wait(self, count, timeout=None):
+
+        '''
+        Blocks until more than count rows have been appended
+        returns:
+            True if there are new rows, False on timeout
+        '''
+
+        with self.cond:
+            return self.cond.wait_for(lambda: self.count > count, timeout)
+
+    def window(self):
+
+        '''
+        Latest rows, oldest first, as views of the buffer
+        returns:
+            count: number of rows appended at the time of the window
+            waterfall: (h,beams) numpy array
+            pings: (h,beams,3) numpy array
+            poses: (h,7) numpy array
+            with h = min(count, max_height)
+        '''
+
+        with self.cond:
+            count = self.count
+        end = (count - 1) % self.n_slots + self.n_slots + 1 if count else 0
+        start = end - min(count, self.max_height)
+
+        return (count, self.waterfall[start:end], self.pings[start:end],
+                self.poses[start:end])
+
+    def valid(self, count):
+        # The window taken at count hasn't been overwritten yet
+        with self.cond:
+            return self.count - count <= self.slack
+
+    def __len__(self):
+        return min(self.count, self.max_height)
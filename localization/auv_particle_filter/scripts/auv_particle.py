@@ -4,7 +4,6 @@
 import math
 import rospy
 import numpy as np
-from scipy.stats import multivariate_normal
 from scipy.ndimage.filters import gaussian_filter
 from scipy.spatial.transform import Rotation as rot
 from scipy.ndimage import gaussian_filter1d
@@ -18,170 +17,68 @@ from tf.transformations import quaternion_matrix, quaternion_from_matrix
 from tf.transformations import rotation_matrix, rotation_from_matrix
 
 
-from sensor_msgs.msg import PointCloud2, PointField
-from std_msgs.msg import Header
-from sensor_msgs import point_cloud2
-import sensor_msgs.point_cloud2 as pc2
-
-
-class Particle(object):
-    def __init__(self, beams_num, p_num, index, mbes_tf_matrix, m2o_matrix,
+# All the particles of the filter as a structure of arrays:
+# poses: (N,6) array of [x, y, z, roll, pitch, yaw] in the odom frame
+# weights: (N,) array of particle weights
+class ParticleSet(object):
+    def __init__(self, p_num, mbes_tf_matrix, m2o_matrix,
                  init_cov=[0.,0.,0.,0.,0.,0.], meas_std=0.01,
                  process_cov=[0.,0.,0.,0.,0.,0.]):
 
         self.p_num = p_num
-        self.index = index
-
-        self.beams_num = beams_num
-        # self.weight = 1.
-        self.p_pose = [0.]*6
+        self.poses = np.zeros((p_num, 6))
+        self.weights = np.full(p_num, 1./p_num)
         self.mbes_tf_mat = mbes_tf_matrix
         self.m2o_tf_mat = m2o_matrix
         self.init_cov = init_cov
-        self.meas_cov = np.diag([meas_std**2]*beams_num)
-        self.exp_meas_cov = np.diag([0]*beams_num)
+        self.meas_std = meas_std
         self.process_cov = np.asarray(process_cov)
-        self.w = 0.
-        self.log_w = 0.
-        #  self.gp_sigmas = np.array([])
 
         self.add_noise(init_cov)
 
     def add_noise(self, noise):
-        noise_cov =np.diag(noise)
-        current_pose = np.asarray(self.p_pose)
-        noisy_pose = current_pose + np.sqrt(noise_cov).dot(np.random.randn(6,1)).T
-        self.p_pose = noisy_pose[0]
+        self.poses += np.sqrt(np.asarray(noise)) * np.random.randn(self.p_num, 6)
 
     def motion_pred(self, odom_t, dt):
-        # Generate noise
-        noise_vec = (np.sqrt(self.process_cov)*np.random.randn(1, 6)).flatten()
+        # Generate noise for all the particles at once
+        noise = np.sqrt(self.process_cov) * np.random.randn(self.p_num, 6)
 
         # Angular motion
         vel_rot = np.array([odom_t.twist.twist.angular.x,
                             odom_t.twist.twist.angular.y,
                             odom_t.twist.twist.angular.z])
 
-        rot_t = np.array(self.p_pose[3:6]) + vel_rot * dt + noise_vec[3:6]
-
-        roll_t = (rot_t[0] + np.pi) % (2 * np.pi) - np.pi
-        pitch_t = (rot_t[1] + np.pi) % (2 * np.pi) - np.pi
-        yaw_t = (rot_t[2] + np.pi) % (2 * np.pi) - np.pi
-        self.p_pose[3:6] = [roll_t, pitch_t, yaw_t]
+        rot_t = self.poses[:, 3:6] + vel_rot * dt + noise[:, 3:6]
+        self.poses[:, 3:6] = (rot_t + np.pi) % (2 * np.pi) - np.pi
 
         # Linear motion
         vel_p = np.array([odom_t.twist.twist.linear.x,
-                         odom_t.twist.twist.linear.y,
-                         odom_t.twist.twist.linear.z])
-        
-        rot_mat_t = rot.from_euler("xyz", [roll_t,pitch_t, yaw_t]).as_matrix()
-        step_t = np.matmul(rot_mat_t, vel_p * dt) + noise_vec[0:3]
-
-        self.p_pose[0] += step_t[0]
-        self.p_pose[1] += step_t[1]
+                          odom_t.twist.twist.linear.y,
+                          odom_t.twist.twist.linear.z])
+
+        rot_mat_t = rot.from_euler("xyz", self.poses[:, 3:6]).as_matrix()
+        step_t = np.matmul(rot_mat_t, vel_p * dt) + noise[:, 0:3]
+
+        self.poses[:, 0:2] += step_t[:, 0:2]
         # Seems to be a problem when integrating depth from Ping vessel, so we just read it
-        self.p_pose[2] = odom_t.pose.pose.position.z
-
-    def compute_weight(self, exp_mbes, real_mbes_ranges):
-        # Predict mbes ping given current particle pose and m 
-        exp_mbes_ranges = self.list2ranges(exp_mbes)
-        #  exp_mbes_ranges = gaussian_filter1d(exp_mbes_ranges , sigma=10)
-        #  real_mbes_ranges = gaussian_filter1d(real_mbes_ranges , sigma=10)
-
-        if len(exp_mbes_ranges) > 0:
-            # Update particle weights
-            self.w = self.weight_mv(real_mbes_ranges, exp_mbes_ranges)
-            #  self.w = self.weight_avg(real_mbes_ranges, exp_mbes_ranges)
-            #  self.w = self.weight_grad(real_mbes_ranges, exp_mbes_ranges)
-        else:
-            self.w = 0.0
-            rospy.logwarn("Range of exp meas equals zero")
-    
-    def weight_grad(self, mbes_meas_ranges, mbes_sim_ranges ):
-        if len(mbes_meas_ranges) == len(mbes_sim_ranges):
-            grad_meas = np.gradient(mbes_meas_ranges)
-            grad_expected = np.gradient(mbes_sim_ranges)
-            w_i = multivariate_normal.pdf(grad_expected, mean=grad_meas,
-                                          cov=self.meas_cov)
-        else:
-            rospy.logwarn("missing pings!")
-            w_i = 0.0
-        return w_i
-        
-    def weight_mv(self, mbes_meas_ranges, mbes_sim_ranges ):
-
-        if len(mbes_meas_ranges) == len(mbes_sim_ranges):
-            w_i = multivariate_normal.pdf(mbes_sim_ranges, mean=mbes_meas_ranges,
-                                          cov=self.meas_cov + self.exp_meas_cov)
-        else:
-            rospy.logwarn("missing pings!")
-            w_i = 0.0
-        return w_i
-      
-    def weight_avg(self, mbes_meas_ranges, mbes_sim_ranges ):
-        if len(mbes_meas_ranges) == len(mbes_sim_ranges):
-            #  w_i = 1./self.p_num
-            #  for i in range(len(mbes_sim_ranges)):
-            w_i = math.exp(-(((mbes_sim_ranges
-                               - mbes_meas_ranges)**2).mean())/(2*self.meas_cov[0,0]))
-        else:
-            rospy.logwarn("missing pings!")
-            #  w_i = 1./self.p_num
-            w_i = 0.0
-        return w_i
-    
-    def get_p_mbes_pose(self):
-        # Find particle's mbes_frame pose in the map frame 
-        t_particle = translation_matrix(self.p_pose[0:3])
-        r_particle = rot.from_euler('xyz', self.p_pose[3:6], degrees=False)
-        q_particle = quaternion_matrix(r_particle.as_quat())
-        mat = np.dot(t_particle, q_particle)
-        
-        trans_mat = self.m2o_tf_mat.dot(mat.dot(self.mbes_tf_mat))
-        self.p = trans_mat[0:3, 3]
-        self.R = trans_mat[0:3, 0:3]
-        
-        return (self.p, self.R)
-
-    # Extract the z coordinate from exp pings (in map frame)
-    def list2ranges(self, points):
-        ranges = []
-        for p in points:
-            ranges.append(p[2])
-
-        return np.asarray(ranges)
+        self.poses[:, 2] = odom_t.pose.pose.position.z
+
+    def get_p_mbes_pose(self, poses=None):
+        # Find all the particles' mbes_frame poses in the map frame
+        # poses: optional (N,6) snapshot of the particles to use instead of the current ones
+        if poses is None:
+            poses = self.poses
+        mat = np.tile(np.eye(4), (len(poses), 1, 1))
+        mat[:, 0:3, 0:3] = rot.from_euler('xyz', poses[:, 3:6], degrees=False).as_matrix()
+        mat[:, 0:3, 3] = poses[:, 0:3]
+
+        # No state is kept: it runs on the PF update thread, concurrently with odom
+        trans_mat = np.matmul(self.m2o_tf_mat, np.matmul(mat, self.mbes_tf_mat))
+        return (trans_mat[:, 0:3, 3], trans_mat[:, 0:3, 0:3])
+
+    def reassign_poses(self, lost, dupes):
+        self.poses[lost] = self.poses[dupes]
 
-    
-# Extract the z coordinate from real pings (in map frame)
-def pcloud2ranges(point_cloud, p_map_mbes_z):
-    ranges = []
-    for p in pc2.read_points(point_cloud, 
-                             field_names = ("x", "y", "z"), skip_nans=True):
-        ranges.append(p_map_mbes_z + p[2])
-
-    return np.asarray(ranges)
-
-def pcloud2ranges_full(point_cloud):
-    ranges = []
-    for p in pc2.read_points(point_cloud, 
-                             field_names = ("x", "y", "z"), skip_nans=True):
-        ranges.append(p)
-
-    return np.asarray(ranges)
-
-# Create PointCloud2 msg out of ping    
-def pack_cloud(frame, mbes):
-    mbes_pcloud = PointCloud2()
-    header = Header()
-    header.stamp = rospy.Time.now()
-    header.frame_id = frame
-    fields = [PointField('x', 0, PointField.FLOAT32, 1),
-              PointField('y', 4, PointField.FLOAT32, 1),
-              PointField('z', 8, PointField.FLOAT32, 1)]
-
-    mbes_pcloud = point_cloud2.create_cloud(header, fields, mbes)
-
-    return mbes_pcloud 
 
 def matrix_from_pose(pose):
     trans = np.array([pose.position.x, 
@@ -19,20 +19,21 @@ from rospy.numpy_msg import numpy_msg
 from tf.transformations import quaternion_from_euler, euler_from_quaternion, rotation_matrix
 
 from sensor_msgs.msg import PointCloud2, PointField
-import sensor_msgs.point_cloud2 as pc2
 from visualization_msgs.msg import Marker, MarkerArray
 
 # For sim mbes action client
-from auv_particle import Particle, matrix_from_tf, pcloud2ranges, pack_cloud, pcloud2ranges_full, matrix_from_pose
-from resampling import residual_resample, naive_resample, systematic_resample, stratified_resample
-
-# Auvlib
-from auvlib.bathy_maps import base_draper
-from auvlib.data_tools import csv_data
+from auv_particle import ParticleSet, matrix_from_tf, matrix_from_pose
+from auv_utils.ping_codec import decode_cloud, encode_cloud
+from auv_utils.likelihood import log_likelihood, normalize_log_weights
+from auv_utils.resampling import residual_resample, systematic_resample, stratified_resample, copy_map
+from auv_utils.raycaster import MeshRaycaster
 
 from scipy.ndimage.filters import gaussian_filter
 
 import time 
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import pathlib
 import tempfile
 import os
@@ -81,8 +82,6 @@ class auv_pf(object):
         self.pred_odom = None
         self.n_eff_filt = 0.
         self.n_eff_mask = [self.pc]*3
-        self.latest_mbes = PointCloud2()
-        self.prev_mbes = PointCloud2()
         self.poses = PoseArray()
         self.poses.header.frame_id = self.odom_frame
         self.avg_pose = PoseWithCovarianceStamped()
@@ -112,49 +111,33 @@ class auv_pf(object):
         if not self.gp_meas_model:
             print("PF loading mesh")
 
-            svp_path = rospy.get_param('~sound_velocity_prof')
             mesh_path = rospy.get_param('~mesh_path')
-            
-            if svp_path.split('.')[1] != 'cereal':
-                sound_speeds = csv_data.csv_asvp_sound_speed.parse_file(svp_path)
-            else:
-                sound_speeds = csv_data.csv_asvp_sound_speed.read_data(svp_path)  
-
             data = np.load(mesh_path + "mesh.npz")
-            V, F, bounds = data['V'], data['F'], data['bounds'] 
 
-            # Create draper
-            self.draper = base_draper.BaseDraper(V, F, bounds, sound_speeds)
-            self.draper.set_ray_tracing_enabled(False)            
+            # Straight beams (no ray bending with the SVP) cast for all the particles at once
+            self.raycaster = MeshRaycaster(data['V'], data['F'])
             data = None
-            V = None
-            F = None
-            bounds = None 
-            sound_speeds = None
-            print("draper created")
-            print("Size of draper: ", sys.getsizeof(self.draper))        
+            print("raycaster created")
  
         # # Load GP
         if self.gp_meas_model:
             gp_path = rospy.get_param("~gp_path", 'gp.path')
-            # gpytorch
-            from gp_mapping import gp
-            rospy.loginfo("Loading GPtorch GP model")
-            self.gp = gp.SVGP.load(1000, gp_path)
-            # toggle evaluation mode
-            self.gp.eval()
-            self.gp.likelihood.eval()
+            # Rasterized posterior of the GP built offline with gp_mapping/tile_map.py
+            tile_map_path = rospy.get_param("~gp_tile_map", '')
+            if tile_map_path:
+                from gp_mapping.tile_map import GPTileMap
+                rospy.loginfo("Loading GP tile map")
+                self.gp = GPTileMap(tile_map_path)
+            else:
+                # gpytorch
+                from gp_mapping import gp
+                rospy.loginfo("Loading GPtorch GP model")
+                self.gp = gp.SVGP.load(1000, gp_path)
+                # toggle evaluation mode and precompute the frozen posterior
+                self.gp.cache_posterior()
             
             print("Size of GP: ", sys.getsizeof(self.gp))
 
-        # Subscription to real/sim mbes pings 
-        mbes_pings_top = rospy.get_param("~mbes_pings_topic", 'mbes_pings')
-        rospy.Subscriber(mbes_pings_top, PointCloud2, self.mbes_cb, queue_size=100)
-        
-        # Establish subscription to odometry message (intentionally last)
-        odom_top = rospy.get_param("~odometry_topic", 'odom')
-        rospy.Subscriber(odom_top, Odometry, self.odom_callback, queue_size=100)
-
         # Create expected MBES beams directions
         angle_step = self.mbes_angle/self.beams_num
         self.beams_dir = []
@@ -189,12 +172,10 @@ class auv_pf(object):
         except:
             rospy.loginfo("ERROR: Could not lookup transform from base_link to mbes_link")
 
-        # Initialize list of particles
-        self.particles = np.empty(self.pc, dtype=object)
-        for i in range(self.pc):
-            self.particles[i] = Particle(self.beams_num, self.pc, i, self.base2mbes_mat,
-                                         self.m2o_mat, init_cov=init_cov, meas_std=meas_std,
-                                         process_cov=motion_cov)
+        # Initialize set of particles
+        self.particles = ParticleSet(self.pc, self.base2mbes_mat, self.m2o_mat,
+                                     init_cov=init_cov, meas_std=meas_std,
+                                     process_cov=motion_cov)
       
         # Topic to signal end of survey
         finished_top = rospy.get_param("~survey_finished_top", '/survey_finished')
@@ -206,15 +187,26 @@ class auv_pf(object):
         self.old_time = rospy.Time.now().to_sec()
 
         # Create particle to compute DR
-        self.dr_particle = Particle(self.beams_num, self.pc, self.pc+1, self.base2mbes_mat,
-                                    self.m2o_mat, init_cov=[0.]*6, meas_std=meas_std,
-                                    process_cov=motion_cov)
-
-        # Main timer for PF
+        self.dr_particle = ParticleSet(1, self.base2mbes_mat, self.m2o_mat,
+                                       init_cov=[0.]*6, meas_std=meas_std,
+                                       process_cov=motion_cov)
+
+        # PF update pipeline: pings are handed by mbes_cb to the update thread, which
+        # spreads the meas model of the particles over a pool of workers. Only the
+        # latest ping is kept, so that it's scored against near-current poses, the
+        # ones arriving during an update replace it and count as skipped.
+        # The particles are only locked to snapshot them and to commit the resampling,
+        # so the motion prediction runs during the updates
         self.mission_finished = False
         self.odom_latest = Odometry()
-        pf_period = rospy.get_param("~pf_period")
-        rospy.Timer(rospy.Duration(pf_period), self.pf_update, oneshot=False)
+        self.ping_queue = queue.Queue(maxsize=1)
+        self.n_workers = rospy.get_param("~pf_workers", 4)
+        self.pf_workers = ThreadPoolExecutor(max_workers=self.n_workers)
+        self.particles_lock = threading.Lock()
+        self.processed_pings = 0
+        self.skipped_pings = 0
+        pipeline_top = rospy.get_param("~pf_pipeline_stats_top", '/pf/pipeline_stats')
+        self.pipeline_pub = rospy.Publisher(pipeline_top, numpy_msg(Floats), queue_size=10)
 
         # For active localization PF simulation
         self.enable_pf_update = rospy.get_param("~enable_pf_update")
@@ -231,6 +223,15 @@ class auv_pf(object):
         # To run the PFs in a loop
         self.synch_loop_pub = rospy.Publisher("/gt/pf_finished", Bool, queue_size=10)
 
+        # Subscription to real/sim mbes pings, once the PF update pipeline
+        # they feed has been created
+        mbes_pings_top = rospy.get_param("~mbes_pings_topic", 'mbes_pings')
+        rospy.Subscriber(mbes_pings_top, PointCloud2, self.mbes_cb, queue_size=100)
+        
+        # Establish subscription to odometry message (intentionally last)
+        odom_top = rospy.get_param("~odometry_topic", 'odom')
+        rospy.Subscriber(odom_top, Odometry, self.odom_callback, queue_size=100)
+
         # PF filter created. Start auv_2_ros survey playing
         rospy.loginfo("Particle filter class successfully created")
 
@@ -238,6 +239,10 @@ class auv_pf(object):
         synch_top = rospy.get_param("~synch_topic", '/pf_synch')
         self.srv_server = rospy.Service(synch_top, Empty, self.empty_srv)
 
+        update_thread = threading.Thread(target=self.pf_update_loop)
+        update_thread.daemon = True
+        update_thread.start()
+
         rospy.spin()
 
     def enable_updates(self, msg):
@@ -253,135 +258,171 @@ class auv_pf(object):
         self.synch_loop_pub.publish(True)
         # rospy.signal_shutdown("Survey finished")
 
-    def gptorch_meas_model(self, real_mbes_all, real_mbes_ranges):
+    def gptorch_meas_model(self, real_mbes_full, real_mbes_ranges, p_part, r_mbes):
+
+        # Particles mbes_frame to map frame transforms
+        # To transform from base to mbes
+        R = self.base2mbes_mat.transpose()[0:3,0:3]
+        r_base = np.matmul(r_mbes, R) # The GP sampling uses the base_link orientation 
+        real_mbes_all = np.einsum('nij,bj->nbi', r_base, real_mbes_full)
+        real_mbes_all += p_part[:, np.newaxis, :]
+        real_mbes_all = real_mbes_all.reshape(-1, 3)
 
+        # All the particles' beams in a single GP query. Same call for the tile map,
+        # which returns NaN for the beams out of the map (particle missed the meas)
         mu_all, sigma_all = self.gp.sample(real_mbes_all[:, 0:2])
-        mu_all_array = np.array([mu_all])
-        sigma_array = np.array([sigma_all])
-        
-        # Compute weights
-        weights = []
-        for i in range(0, self.pc):
-            mbes_gp = np.concatenate((np.asarray(real_mbes_all[i*self.beams_num:(i*self.beams_num)+self.beams_num])[:, 0:2],
-                                      mu_all_array.T[i*self.beams_num:(i*self.beams_num)+self.beams_num]), axis=1)
-            self.particles[i].exp_meas_cov = np.diag(sigma_array)
+        exp_mbes = np.column_stack((real_mbes_all[:, 0:2], mu_all))
 
-            # For visualization
-            mbes_pcloud = pack_cloud(self.map_frame, mbes_gp)
-            self.pcloud_pub.publish(mbes_pcloud)
+        mu_all = mu_all.reshape(len(p_part), self.beams_num)
+        sigma_all = sigma_all.reshape(len(p_part), self.beams_num)
 
-            self.particles[i].compute_weight(mbes_gp, real_mbes_ranges)
-            weights.append(self.particles[i].w)
+        # Compute log-weights
+        log_weights = log_likelihood(mu_all, real_mbes_ranges,
+                                     self.particles.meas_std**2 + sigma_all)
 
-        return weights
+        return log_weights, exp_mbes
 
-    def mbes_cb(self, msg):
-        if not self.mission_finished:
-            self.latest_mbes = msg
+    def mesh_meas_model(self, real_mbes_full, real_mbes_ranges, p_part, r_mbes):
+
+        exp_mbes = self.raycaster.project_mbes(p_part, r_mbes,
+                                               self.beams_num, self.mbes_angle)
+        exp_mbes = exp_mbes[:, ::-1] # Reverse beams for same order as real pings
 
-    def pf_update(self, event):
+        # Particles that missed beams get NaN ranges and zero weight
+        # Uncertainty of expected meas from raytracing: leave equal to that of real MBES
+        log_weights = log_likelihood(exp_mbes[:, :, 2], real_mbes_ranges,
+                                     2. * self.particles.meas_std**2)
+
+        hits = exp_mbes.reshape(-1, 3)
+        return log_weights, hits[~np.isnan(hits[:, 0])]
+
+    def mbes_cb(self, msg):
         if not self.mission_finished and self.enable_pf_update:
-            if self.latest_mbes.header.stamp > self.prev_mbes.header.stamp:
-                # Measurement update if new one received
+            # If the update thread is busy, the newest ping replaces the waiting one
+            try:
+                self.ping_queue.put_nowait((msg, self.odom_latest))
+            except queue.Full:
+                try:
+                    self.ping_queue.get_nowait()
+                    self.skipped_pings += 1
+                except queue.Empty:
+                    pass
+                self.ping_queue.put_nowait((msg, self.odom_latest))
+
+    def pf_update_loop(self):
+        while not rospy.is_shutdown():
+            try:
+                real_mbes, odom = self.ping_queue.get(timeout=1.)
+            except queue.Empty:
+                continue
+
+            if self.mission_finished or not self.enable_pf_update:
+                continue
+
+            # An error in an update must not kill the thread, the PF would stop updating
+            try:
                 start = time.time()
-                weights = self.update(self.latest_mbes, self.odom_latest)
-                self.prev_mbes = self.latest_mbes
-                # print(time.time() - start)
-                # Particle resampling
-                self.resample(weights)
+                # Snapshot of the particles for the meas update
+                with self.particles_lock:
+                    poses = np.copy(self.particles.poses)
+
+                log_weights = self.update(real_mbes, odom, poses)
+                if log_weights is None:
+                    self.skipped_pings += 1
+                    continue
+
+                # Commit: the particles have only been moved by the prediction since the
+                # snapshot, so the resampling applies to the current poses
+                with self.particles_lock:
+                    self.resample(log_weights)
+
+                self.processed_pings += 1
+                self.publish_pipeline_stats(time.time() - start)
+            except Exception as e:
+                rospy.logerr("PF update failed: {}".format(e))
+
+    def publish_pipeline_stats(self, update_time):
+        # Pings processed and dropped so far, pings waiting and duration of last update
+        stats = np.array([self.processed_pings,
+                          self.skipped_pings,
+                          self.ping_queue.qsize(),
+                          update_time], dtype=np.float32)
+        self.pipeline_pub.publish(stats)
+
+        if self.skipped_pings:
+            rospy.logwarn_throttle(10., "PF update skipped {} pings, {} queued".format(
+                self.skipped_pings, self.ping_queue.qsize()))
 
     def odom_callback(self, odom_msg):
         self.time = odom_msg.header.stamp.to_sec()
         self.odom_latest = odom_msg
 
         if not self.mission_finished:
-            if self.old_time and self.time > self.old_time:
-                # Motion prediction
-                self.predict(odom_msg)    
+            with self.particles_lock:
+                if self.old_time and self.time > self.old_time:
+                    # Motion prediction
+                    self.predict(odom_msg)    
+                poses_array = np.copy(self.particles.poses)
                 
-            self.update_rviz()
+            self.update_rviz(poses_array)
             self.publish_stats(odom_msg)
 
         self.old_time = self.time
 
     def predict(self, odom_t):
         dt = self.time - self.old_time
-        for i in range(0, self.pc):
-            self.particles[i].motion_pred(odom_t, dt)
+        self.particles.motion_pred(odom_t, dt)
 
         # Predict DR
         self.dr_particle.motion_pred(odom_t, dt)
 
     
-    def update(self, real_mbes, odom):
+    def update(self, real_mbes, odom, poses):
+        # Log-weights of the particles given the ping, None if it has no valid beams
         # Compute AUV MBES ping ranges in the map frame
         # We only work with z, so we transform them mbes --> map
-        #  real_ranges = pcloud2ranges(real_mbes, self.m2o_mat[2,3] + odom.pose.pose.position.z)
 
         # Beams in real mbes frame
-        real_mbes_full = pcloud2ranges_full(real_mbes)
+        real_mbes_full = decode_cloud(real_mbes)
+        real_mbes_full = real_mbes_full[~np.isnan(real_mbes_full).any(axis=1)]
+        if not len(real_mbes_full):
+            rospy.logwarn("Ping without valid beams, skipped")
+            return None
 
         # Processing of real pings here
         idx = np.round(np.linspace(0, len(real_mbes_full)-1,
                                            self.beams_num)).astype(int)
-        #  real_mbes_ranges = real_ranges[idx]
         real_mbes_full = real_mbes_full[idx]
         # Transform depths from mbes to map frame
         real_mbes_ranges = real_mbes_full[:,2] + self.m2o_mat[2,3] + odom.pose.pose.position.z
-        
-        # The sensor frame on IGL needs to have the z axis pointing 
-        # opposite from the actual sensor direction. However the gp ray tracing
-        # needs the opposite.
-        R_flip = rotation_matrix(np.pi, (1,0,0))[0:3, 0:3]
-        
-        # To transform from base to mbes
-        R = self.base2mbes_mat.transpose()[0:3,0:3]
 
-        # Measurement update of each particle
-        real_mbes_full_all = []
-        weights = []
-        for i in range(0, self.pc):
-            # Current particle pose in the map frame
-            p_part, r_mbes = self.particles[i].get_p_mbes_pose()
-            
-            # For raytracing on mesh meas model
-            if not self.gp_meas_model:
-                exp_mbes = self.draper.project_mbes(np.asarray(p_part), r_mbes,
-                                                    self.beams_num, self.mbes_angle)
-                exp_mbes = exp_mbes[::-1] # Reverse beams for same order as real pings
-
-                # For visualization
-                mbes_pcloud = pack_cloud(self.map_frame, exp_mbes)
-                self.pcloud_pub.publish(mbes_pcloud)
-
-                # Uncertainty of expected meas from raytracing: leave equal to that of real MBES
-                self.particles[i].exp_meas_cov = self.particles[i].meas_cov
-                # Compute particle weight
-                self.particles[i].compute_weight(exp_mbes, real_mbes_ranges)
-                weights.append(self.particles[i].w)
-            
-            # For both GP-based meas models
-            if self.gp_meas_model:
-                # Compute particle mbes_frame to map frame transform
-                r_base = r_mbes.dot(R) # The GP sampling uses the base_link orientation 
-                real_mbes = np.dot(r_base, real_mbes_full.T)
-                real_mbes = np.add(real_mbes.T, p_part)
-                real_mbes_full_all.append(real_mbes)
-            
-        if self.gp_meas_model:
-            real_mbes_full_all = np.vstack(real_mbes_full_all)            
-            # Gpytorch GP meas model
-            weights = self.gptorch_meas_model(
-                real_mbes_full_all, real_mbes_ranges)
+        # Snapshot particles' mbes_frame poses in the map frame
+        p_part, r_mbes = self.particles.get_p_mbes_pose(poses)
+
+        # Raytracing on the mesh or GP-based meas models
+        if not self.gp_meas_model:
+            meas_model = self.mesh_meas_model
+        else:
+            meas_model = self.gptorch_meas_model
+
+        # Split the particles among the workers
+        chunks = np.array_split(np.arange(self.pc), self.n_workers)
+        results = list(self.pf_workers.map(
+            lambda i: meas_model(real_mbes_full, real_mbes_ranges, p_part[i], r_mbes[i]),
+            [i for i in chunks if len(i)]))
+        log_weights = np.concatenate([r[0] for r in results])
+
+        # For visualization: the expected pings of all the particles in one cloud
+        exp_mbes = np.concatenate([r[1] for r in results])
+        self.pcloud_pub.publish(encode_cloud(self.map_frame, exp_mbes))
 
         # Number of particles that missed some beams 
         # (if too many it would mess up the resampling)
-        self.miss_meas = weights.count(0.0)
-        weights_array = np.asarray(weights)
-        # Add small non-zero value to avoid hitting zero
-        weights_array += 1.e-200
+        self.miss_meas = np.count_nonzero(np.isneginf(log_weights))
+        if not self.gp_meas_model and self.miss_meas:
+            rospy.logwarn("missing pings!")
 
-        return weights_array
+        return log_weights
     
     def publish_stats(self, gt_odom):
         # Send statistics for visualization
@@ -399,7 +440,7 @@ class auv_pf(object):
             self.avg_pose.pose.pose.orientation.w)
         euler_pf = euler_from_quaternion(quaternion)
 
-        p_odom = self.dr_particle.p_pose
+        p_odom = self.dr_particle.poses[0]
 
         stats = np.array([self.n_eff_filt,
                           self.pc/2.,
@@ -426,27 +467,19 @@ class auv_pf(object):
         self.stats_full = np.hstack((self.stats_full, stats.reshape(self.datagram_size,1)))
 
 
-    def ping2ranges(self, point_cloud):
-        ranges = []
-        cnt = 0
-        for p in pc2.read_points(point_cloud, 
-                                 field_names = ("x", "y", "z"), skip_nans=True):
-            ranges.append(np.linalg.norm(p[-2:]))
-        
-        return np.asarray(ranges)
-    
     def moving_average(self, a, n=3) :
         ret = np.cumsum(a, dtype=float)
         ret[n:] = ret[n:] - ret[:-n]
         return ret[n - 1:] / n
 
-    def resample(self, weights):
-        # Normalize weights
-        #  print (weights)
-        weights /= weights.sum()
+    def resample(self, log_weights):
+        # Normalize weights in the log domain
+        weights, log_norm = normalize_log_weights(log_weights)
+        self.particles.log_weights = log_weights
+        self.particles.weights = weights
 
         N_eff = self.pc
-        if weights.sum() == 0.:
+        if np.isneginf(log_norm):
             rospy.loginfo("All weights zero!")
         else:
             N_eff = 1/np.sum(np.square(weights))
@@ -461,26 +494,15 @@ class auv_pf(object):
         if self.n_eff_filt < self.pc/2. and self.miss_meas < self.pc/2.:
         #  if N_eff < self.pc/2. and self.miss_meas < self.pc/2.:
             indices = residual_resample(weights)
-            keep = list(set(indices))
-            lost = [i for i in range(self.pc) if i not in keep]
-            dupes = indices[:].tolist()
-            for i in keep:
-                dupes.remove(i)
+            lost, dupes = copy_map(indices)
 
-            self.reassign_poses(lost, dupes)
+            self.particles.reassign_poses(lost, dupes)
             # Add noise to particles
-            for i in range(self.pc):
-                self.particles[i].add_noise(self.res_noise_cov)
+            self.particles.add_noise(self.res_noise_cov)
 
+    def average_pose(self, poses_array):
 
-    def reassign_poses(self, lost, dupes):
-        for i in range(len(lost)):
-            # Faster to do separately than using deepcopy()
-            self.particles[lost[i]].p_pose = self.particles[dupes[i]].p_pose
-    
-    def average_pose(self, pose_list):
-
-        poses_array = np.array(pose_list)
+        poses_array = np.copy(poses_array)
         ave_pose = poses_array.mean(axis = 0)
         self.avg_pose.pose.pose.position.x = ave_pose[0]
         self.avg_pose.pose.pose.position.y = ave_pose[1]
@@ -489,8 +511,7 @@ class auv_pf(object):
         pitch = ave_pose[4]
 
         # Wrap up yaw between -pi and pi        
-        poses_array[:,5] = [(yaw + np.pi) % (2 * np.pi) - np.pi 
-                             for yaw in  poses_array[:,5]]
+        poses_array[:,5] = (poses_array[:,5] + np.pi) % (2 * np.pi) - np.pi
         yaw = np.mean(poses_array[:,5])
         
         self.avg_pose.pose.pose.orientation = Quaternion(*quaternion_from_euler(roll,
@@ -499,14 +520,8 @@ class auv_pf(object):
         self.avg_pose.header.stamp = rospy.Time.now()
         
         # Calculate covariance
-        self.cov = np.zeros((3, 3))
-        for i in range(self.pc):
-            dx = (poses_array[i, 0:3] - ave_pose[0:3])
-            self.cov += np.diag(dx*dx.T) 
-            self.cov[0,1] += dx[0]*dx[1] 
-            self.cov[0,2] += dx[0]*dx[2] 
-            self.cov[1,2] += dx[1]*dx[2] 
-        self.cov /= self.pc
+        dx = poses_array[:, 0:3] - ave_pose[0:3]
+        self.cov = np.triu(np.matmul(dx.T, dx)) / self.pc
         self.cov[1,0] = self.cov[0,1]
         # print(self.cov)
 
@@ -519,30 +534,28 @@ class auv_pf(object):
 
     # TODO: publish markers instead of poses
     #       Optimize this function
-    def update_rviz(self):
+    def update_rviz(self, poses_array):
         self.poses.poses = []
-        pose_list = []
         for i in range(self.pc):
             pose_i = Pose()
-            pose_i.position.x = self.particles[i].p_pose[0]
-            pose_i.position.y = self.particles[i].p_pose[1]
-            pose_i.position.z = self.particles[i].p_pose[2]
+            pose_i.position.x = poses_array[i, 0]
+            pose_i.position.y = poses_array[i, 1]
+            pose_i.position.z = poses_array[i, 2]
             pose_i.orientation = Quaternion(*quaternion_from_euler(
-                self.particles[i].p_pose[3],
-                self.particles[i].p_pose[4],
-                self.particles[i].p_pose[5]))
+                poses_array[i, 3],
+                poses_array[i, 4],
+                poses_array[i, 5]))
 
             self.poses.poses.append(pose_i)
-            pose_list.append(self.particles[i].p_pose)
         
         # Publish particles with time odometry was received
         self.poses.header.stamp = rospy.Time.now()
-        self.average_pose(pose_list)
+        self.average_pose(poses_array)
 
         # Publish particles as markers
         markerArray = MarkerArray()
         for i in range(self.pc):
-            markerArray.markers.append(self.make_marker(i, self.particles[i].p_pose))
+            markerArray.markers.append(self.make_marker(i, poses_array[i]))
 
         self.markers_pub.publish(markerArray)
         # self.pf_pub.publish(self.poses)
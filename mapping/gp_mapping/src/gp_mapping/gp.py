@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
+import os
 import torch, numpy as np, tqdm, matplotlib.pyplot as plt
+from concurrent.futures import ThreadPoolExecutor
 from gpytorch.models import VariationalGP, ExactGP
 from gpytorch.variational import CholeskyVariationalDistribution, VariationalStrategy
 from gpytorch.means import ConstantMean
@@ -11,8 +13,29 @@ from gpytorch.mlls import VariationalELBO, PredictiveLogLikelihood, ExactMargina
 import gpytorch.settings
 #from convergence import ExpMAStoppingCriterion
 from gp_mapping.convergence import ExpMAStoppingCriterion
+from gp_mapping.minibatch import MinibatchSampler
 import matplotlib.pyplot as plt
 
+def _chol2x2(covariances):
+
+    '''
+    Cholesky factors of a batch of 2x2 covariance matrices in closed form,
+    much cheaper than a batched torch.linalg.cholesky for such small matrices
+    covariances: (n,2,2) tensor
+    returns:
+        L: (n,2,2) lower triangular tensor, L @ L.T = covariances
+    '''
+
+    l11 = covariances[:, 0, 0].clamp(min=0.).sqrt()
+    l21 = covariances[:, 1, 0] / l11.clamp(min=1e-12)
+    l22 = (covariances[:, 1, 1] - l21**2).clamp(min=0.).sqrt()
+    L = torch.zeros_like(covariances)
+    L[:, 0, 0] = l11
+    L[:, 1, 0] = l21
+    L[:, 1, 1] = l22
+    return L
+
+
 # This is not tested
 class RGP(ExactGP):
 
@@ -181,18 +204,61 @@ class SVGP(VariationalGP):
         self.likelihood.to(self.device).float()
         self.to(self.device).float()
 
+        # inducing point quantities of the frozen posterior, see self.cache_posterior
+        self._posterior_cache = None
+
     def forward(self, input):
         m = self.mean(input)
         v = self.cov(input)
         return MultivariateNormal(m, v)
 
+    def train(self, mode=True):
+        # the cached posterior is only valid while the GP is frozen
+        if mode:
+            self._posterior_cache = None
+        return VariationalGP.train(self, mode)
+
+    def cache_posterior(self):
+
+        '''
+        Precomputes the inducing point terms of the posterior once, so that
+        self.sample only needs the kernel between the queries and the inducing points.
+        With L = chol(K_uu), q(v) = N(m, S) the whitened variational distribution:
+            mean(x) = mu(x) + K_xu L^-T m
+            var(x) = k_xx + K_xu L^-T (S - I) L^-1 K_ux + noise
+        Call after load() or training, it toggles evaluation mode.
+        The cache is dropped when the GP is set back to training mode.
+        '''
+
+        self.likelihood.eval()
+        self.eval()
+
+        with torch.no_grad():
+            z = self.variational_strategy.inducing_points
+            vardist = self.variational_strategy._variational_distribution
+            eye = torch.eye(self.m, device=z.device, dtype=z.dtype)
+
+            # K_uu^{-1/2} with the same jitter as the variational strategy
+            jitter = getattr(self.variational_strategy, 'jitter_val', None) or 1e-4
+            L = torch.linalg.cholesky(self.cov(z).to_dense() + jitter * eye)
+            Linv = torch.linalg.solve_triangular(L, eye, upper=False)
+
+            # variational mean projection and variance correction
+            chol_S = vardist.chol_variational_covar.tril()
+            alpha = Linv.t() @ vardist.variational_mean
+            B = Linv.t() @ (chol_S @ chol_S.t() - eye) @ Linv
+
+        self._posterior_cache = (z, alpha, B)
+
     def fit(self, inputs, targets, covariances=None, n_samples=5000, max_iter=10000, 
-            learning_rate=1e-3, rtol=1e-4, n_window=100, auto=True, verbose=True):
+            learning_rate=1e-3, rtol=1e-4, n_window=100, auto=True, verbose=True,
+            warm_start=False):
 
         '''
         Optimises the hyperparameters of the GP kernel and likelihood.
         inputs: (nx2) numpy array
         targets: (n,) numpy array
+        covariances: (n,2,2) numpy array of input covariances for uncertain inputs, or None
         n_samples: number of samples to take from the inputs/targets at every optimisation epoch
         max_iter: maximum number of optimisation epochs
         learning_rate: optimiser step size
@@ -200,15 +266,61 @@ class SVGP(VariationalGP):
         ntol: number of epochs required to maintain rtol in order to terminate if auto==True
         auto: if True terminate based on rtol and ntol, else terminate at max_iter
         verbose: if True show progress bar, else nothing
+        warm_start: if True continue from the current inducing points, variational
+                    distribution and hyperparameters, e.g. to add new data to a trained GP
         '''
 
         # inducing points randomly distributed over data
-        indpts = np.random.choice(inputs.shape[0], self.m, replace=True)
-        self.variational_strategy.inducing_points.data = torch.from_numpy(inputs[indpts]).to(self.device).float()
+        if not warm_start:
+            indpts = np.random.choice(inputs.shape[0], self.m, replace=True)
+            self.variational_strategy.inducing_points.data = torch.from_numpy(inputs[indpts]).to(self.device).float()
+
+        # random samples of the dataset at every epoch, with the Cholesky
+        # factors of the input covariances computed once for all epochs
+        arrays = [inputs, targets]
+        if covariances is not None:
+            arrays.append(_chol2x2(torch.from_numpy(covariances).float()).numpy())
+        sampler = MinibatchSampler(arrays, n_samples, device=self.device)
+        batches = ((b[0], b[1], b[2] if len(b) > 2 else None) for b in sampler)
+
+        print("N window ", n_window)
+        self._optimise(batches, sampler.n, max_iter, learning_rate, 
+                       rtol, n_window, auto, verbose)
+
+    def fit_stream(self, points, covariances=None, n_samples=5000, max_iter=10000, 
+                   learning_rate=1e-3, rtol=1e-4, n_window=100, auto=True, verbose=True,
+                   warm_start=False, block_size=64, prefetch=4):
+
+        '''
+        Same as self.fit, for surveys that don't fit in memory. Only the rows of
+        each minibatch are read, in blocks of consecutive beams, and the next
+        minibatches are read on a background thread while optimising.
+        points: (n,3) numpy array of [x, y, z], typically np.load(..., mmap_mode='r')
+        covariances: (n,3,3) numpy array of point covariances (same), or None
+        block_size: number of consecutive points read together
+        prefetch: number of minibatches read ahead
+        The rest of the arguments are the same as in self.fit.
+        '''
+
+        # inducing points randomly distributed over data, read in order
+        if not warm_start:
+            indpts = np.sort(np.random.choice(points.shape[0], self.m, replace=True))
+            self.variational_strategy.inducing_points.data = torch.from_numpy(
+                np.asarray(points[indpts, 0:2])).to(self.device).float()
+
+        arrays = [points] + ([covariances] if covariances is not None else [])
+        sampler = MinibatchSampler(arrays, n_samples, block_size=block_size, 
+                                   prefetch=prefetch, device=self.device)
+        batches = ((b[0][:, 0:2], b[0][:, 2], _chol2x2(b[1][:, 0:2, 0:2]) if len(b) > 1 else None) 
+                   for b in sampler)
 
-        # number of random samples
-        n = inputs.shape[0]
-        n = n_samples if n >= n_samples else n
+        try:
+            self._optimise(batches, sampler.n, max_iter, learning_rate, 
+                           rtol, n_window, auto, verbose)
+        finally:
+            sampler.close()
+
+    def _optimise(self, batches, n, max_iter, learning_rate, rtol, n_window, auto, verbose):
 
         # objective
         mll = VariationalELBO(self.likelihood, self, n, combine_terms=True)
@@ -218,7 +330,6 @@ class SVGP(VariationalGP):
         # opt = torch.optim.SGD(self.parameters(),lr=learning_rate)
 
         # convergence criterion
-        print("N window ", n_window)
         if auto: criterion = ExpMAStoppingCriterion(rel_tol=rtol, minimize=True, n_window=n_window)
 
         # episode iteratior
@@ -229,20 +340,12 @@ class SVGP(VariationalGP):
         self.train()
         self.likelihood.train()
         self.loss = list()
-        for _ in epochs:
-
-            # randomly sample from the dataset
-            idx = np.random.choice(inputs.shape[0], n, replace=False)
-            
-            ## UI covariance
-            if covariances is None or covariances.shape[1] == 2:
-                input = torch.from_numpy(inputs[idx]).to(self.device).float()
-                target = torch.from_numpy(targets[idx]).to(self.device).float()
+        for _, (input, target, chol) in zip(epochs, batches):
 
-            # if the inputs are distributional, sample them
-            if covariances is not None:
-                covariance = torch.from_numpy(covariances[idx]).to(self.device).float()
-                input = MultivariateNormal(input, covariance).rsample()
+            # if the inputs are distributional, sample them (reparameterised
+            # with the Cholesky factors of their covariances)
+            if chol is not None:
+                input = input + (chol @ torch.randn_like(input).unsqueeze(-1)).squeeze(-1)
 
             # compute loss, compute gradient, and update
             loss = -mll(self(input), target)
@@ -275,6 +378,10 @@ class SVGP(VariationalGP):
         # sanity
         assert len(x.shape) == x.shape[1] == 2
 
+        # frozen posterior: only K_xu times the cached terms
+        if self._posterior_cache is not None:
+            return self._sample_cached(x)
+
         # sample posterior
         # TODO: fast_pred_var activates LOVE. Test performance on PF
         # https://towardsdatascience.com/gaussian-process-regression-using-gpytorch-2c174286f9cc
@@ -283,7 +390,24 @@ class SVGP(VariationalGP):
             dist = self.likelihood(self(x))
             return dist.mean.cpu().numpy(), dist.variance.cpu().numpy()
 
-    def save_posterior(self, n, xlb, xub, ylb, yub, fname, verbose=True):
+    def _sample_cached(self, x, batch_size=10000):
+
+        z, alpha, B = self._posterior_cache
+        noise = self.likelihood.noise
+        mu, sigma = list(), list()
+        with torch.no_grad():
+            # in batches to bound the size of K_xu
+            for xb in np.array_split(x, max(1, int(np.ceil(len(x) / batch_size)))):
+                xb = torch.from_numpy(xb).to(self.device).float()
+                Kxu = self.cov(xb, z).to_dense()
+                mu.append((self.mean(xb) + Kxu @ alpha).cpu().numpy())
+                var = self.cov(xb, diag=True) + ((Kxu @ B) * Kxu).sum(-1) + noise
+                sigma.append(var.cpu().numpy())
+
+        return np.concatenate(mu), np.concatenate(sigma)
+
+    def save_posterior(self, n, xlb, xub, ylb, yub, fname, verbose=True,
+                       block_size=100000, n_workers=4, resume=True):
 
         '''
         Samples the GP posterior on a inform grid over the
@@ -294,46 +418,72 @@ class SVGP(VariationalGP):
         xlb, xub: lower and upper bounds of x sampling locations
         ylb, yub: lower and upper bounds of y sampling locations
         fname: path to save array at (use .npy extension)
+        block_size: approximate number of grid nodes sampled at once
+        n_workers: number of threads sampling blocks in parallel
+        resume: if True and fname is an unfinished export of the same grid
+                (n, bounds and block rows), only the missing blocks are sampled
+
+        The (n²,4) array of [x, y, mean, variance] rows is written block by
+        block to a memory-mapped .npy, so the memory used is that of the
+        blocks in flight. The finished blocks are tracked in fname.progress.npy
+        and the grid they belong to in fname.grid.npy, both removed once the
+        export is complete.
         '''
 
         # sanity
         assert('.npy' in fname)
 
-        # toggle evaluation mode
-        self.likelihood.eval()
-        self.eval()
+        # frozen posterior, toggles evaluation mode
+        self.cache_posterior()
         torch.cuda.empty_cache()
 
-        # posterior sampling locations
-        inputs = [
-            np.linspace(xlb, xub, n),
-            np.linspace(ylb, yub, n)
-        ]
-        inputs = np.meshgrid(*inputs)
-        inputs = [_.flatten() for _ in inputs]
-        inputs = np.vstack(inputs).transpose()
-
-        # split the array into smaller ones for memory
-        inputs = np.split(inputs, 4000, axis=0)
-
-        # compute the posterior for each batch
-        means, variances = list(), list()
-        with torch.no_grad():
-            for i, input in enumerate(inputs):
-                if verbose: print('Batch {}'.format(i))
-                mean, variance = self.sample(input)
-                means.append(mean)
-                variances.append(variance)
-
-        # assemble probabalistic pointcloud
-        cloud = np.hstack((
-            np.vstack(inputs),
-            np.hstack(means).reshape(-1, 1),
-            np.hstack(variances).reshape(-1, 1)
-        ))
-
-        # save it
-        np.save(fname, cloud)
+        # posterior sampling locations, same order as a meshgrid of x and y:
+        # blocks of whole rows of constant y
+        xs = np.linspace(xlb, xub, n)
+        ys = np.linspace(ylb, yub, n)
+        rows = max(1, block_size // n)
+        n_blocks = int(np.ceil(n / rows))
+
+        # output and progress files, reopened if resuming the same export
+        progress_name = fname.replace('.npy', '.progress.npy')
+        grid_name = fname.replace('.npy', '.grid.npy')
+        grid = np.array([n, rows, xlb, xub, ylb, yub], dtype=np.float64)
+        resuming = (resume and all(os.path.exists(f) for f in (fname, progress_name, grid_name))
+                    and np.array_equal(np.load(grid_name), grid)
+                    and np.load(progress_name, mmap_mode='r').shape == (n_blocks,))
+        if resuming:
+            cloud = np.load(fname, mmap_mode='r+')
+            resuming = cloud.shape == (n * n, 4)
+        if resuming:
+            done = np.load(progress_name, mmap_mode='r+')
+        else:
+            cloud = np.lib.format.open_memmap(fname, mode='w+', dtype=np.float64, shape=(n * n, 4))
+            done = np.lib.format.open_memmap(progress_name, mode='w+', dtype=np.bool_, shape=(n_blocks,))
+            np.save(grid_name, grid)
+
+        def sample_block(b):
+            xx, yy = np.meshgrid(xs, ys[b*rows:(b+1)*rows])
+            inputs = np.column_stack((xx.ravel(), yy.ravel()))
+            mean, variance = self.sample(inputs)
+            block = cloud[b*rows*n:b*rows*n + len(inputs)]
+            block[:, 0:2] = inputs
+            block[:, 2] = mean
+            block[:, 3] = variance
+            return b
+
+        todo = np.flatnonzero(~done)
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            for k, b in enumerate(pool.map(sample_block, todo)):
+                if verbose: print('Block {}/{}'.format(k + 1, len(todo)))
+                # data on disk before marking the block as finished
+                cloud.flush()
+                done[b] = True
+                done.flush()
+
+        # complete
+        del cloud, done
+        os.remove(progress_name)
+        os.remove(grid_name)
 
     def plot(self, inputs, targets, fname, n=80, n_contours=50):
 
@@ -429,3 +579,220 @@ class SVGP(VariationalGP):
         gp.load_state_dict(torch.load(fname))
         return gp
 
+
+class BatchSVGP(VariationalGP):
+
+    '''
+    Several independent SVGPs of the same size stacked into one batched model,
+    e.g. the maps of the RBPF particles. The inducing points, variational
+    parameters, kernel hyperparameters and noise of GP i are the i-th entries
+    of the batch dimension, so all the GPs are evaluated and trained with
+    single batched torch calls instead of one small call per GP.
+    Use stack() and unstack() to move the parameters from and to SVGPs.
+    '''
+
+    def __init__(self, n_gps, n_inducing):
+
+        # number of GPs and of inducing points of each
+        assert isinstance(n_gps, int) and isinstance(n_inducing, int)
+        self.n = n_gps
+        self.m = n_inducing
+        batch_shape = torch.Size([self.n])
+
+        # variational distribution and strategy, one per GP
+        vardist = CholeskyVariationalDistribution(self.m, batch_shape=batch_shape)
+        varstra = VariationalStrategy(
+            self,
+            torch.randn((self.n, self.m, 2)),
+            vardist,
+            learn_inducing_locations=True
+        )
+        VariationalGP.__init__(self, varstra)
+
+        # same kernel as SVGP, with batched hyperparameters
+        self.mean = ConstantMean(batch_shape=batch_shape)
+        self.cov = MaternKernel(ard_num_dims=2, batch_shape=batch_shape)
+        self.cov = ScaleKernel(self.cov, ard_num_dims=2, batch_shape=batch_shape)
+
+        # likelihood
+        self.likelihood = GaussianLikelihood(batch_shape=batch_shape)
+
+        # hardware allocation
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.likelihood.to(self.device).float()
+        self.to(self.device).float()
+
+        # see SVGP.cache_posterior
+        self._posterior_cache = None
+
+    forward = SVGP.forward
+    train = SVGP.train
+
+    @classmethod
+    def stack(cls, gps):
+
+        '''
+        Batched model with the parameters of gps
+        gps: list of SVGP with the same number of inducing points
+        '''
+
+        batch = cls(len(gps), gps[0].m)
+        states = [gp.state_dict() for gp in gps]
+        shapes = {k: v.shape for k, v in batch.state_dict().items()}
+
+        # batched entries are stacked, flags and constraint bounds are shared
+        batch.load_state_dict({k: torch.stack([st[k] for st in states])
+                               if shapes[k] == (batch.n,) + v.shape else v
+                               for k, v in states[0].items()})
+        return batch
+
+    def unstack(self, gps):
+
+        '''
+        Copies the parameters of each GP of the batch back to gps
+        gps: list of n_gps SVGP
+        '''
+
+        state = self.state_dict()
+        for i, gp in enumerate(gps):
+            gp.load_state_dict({k: state[k][i] if state[k].shape == (self.n,) + v.shape
+                                else state[k] for k, v in gp.state_dict().items()})
+
+    def cache_posterior(self):
+
+        '''
+        Batched version of SVGP.cache_posterior
+        '''
+
+        self.likelihood.eval()
+        self.eval()
+
+        with torch.no_grad():
+            z = self.variational_strategy.inducing_points
+            vardist = self.variational_strategy._variational_distribution
+            eye = torch.eye(self.m, device=z.device, dtype=z.dtype)
+
+            jitter = getattr(self.variational_strategy, 'jitter_val', None) or 1e-4
+            L = torch.linalg.cholesky(self.cov(z).to_dense() + jitter * eye)
+            Linv = torch.linalg.solve_triangular(L, eye.expand_as(L), upper=False)
+
+            chol_S = vardist.chol_variational_covar.tril()
+            alpha = (Linv.transpose(-1, -2) @ vardist.variational_mean.unsqueeze(-1)).squeeze(-1)
+            B = Linv.transpose(-1, -2) @ (chol_S @ chol_S.transpose(-1, -2) - eye) @ Linv
+
+        self._posterior_cache = (z, alpha, B)
+
+    def sample(self, x):
+
+        '''
+        Samples the posterior of each GP at its own inputs
+        x: (n_gps,n,2) numpy array
+        returns:
+            mu: (n_gps,n) numpy array of predictive mean at x
+            sigma: (n_gps,n) numpy array of predictive variance at x
+        '''
+
+        # sanity
+        assert len(x.shape) == 3 and x.shape[0] == self.n and x.shape[2] == 2
+
+        if self._posterior_cache is None:
+            self.cache_posterior()
+
+        z, alpha, B = self._posterior_cache
+        with torch.no_grad():
+            x = torch.from_numpy(x).to(self.device).float()
+            Kxu = self.cov(x, z).to_dense()
+            mu = self.mean(x) + (Kxu @ alpha.unsqueeze(-1)).squeeze(-1)
+            var = (self.cov(x, diag=True) + ((Kxu @ B) * Kxu).sum(-1)
+                   + self.likelihood.noise)
+
+        return mu.cpu().numpy(), var.cpu().numpy()
+
+    def fit(self, inputs, targets, n_samples=5000, max_iter=10000, learning_rate=1e-3,
+            rtol=1e-4, n_window=100, auto=True, verbose=True, warm_start=False):
+
+        '''
+        Optimises all the GPs of the batch together, see SVGP.fit.
+        inputs: list of n_gps (n_i,2) numpy arrays
+        targets: list of n_gps (n_i,) numpy arrays
+        auto: if True each GP stops at its own convergence (rtol over n_window
+              epochs) and the optimisation ends when all of them have converged
+        The rest of the arguments are the same as in SVGP.fit, with a single
+        optimiser and objective for the batch.
+        '''
+
+        # sanity
+        assert len(inputs) == len(targets) == self.n
+
+        # datasets padded to the largest one
+        sizes = [len(x) for x in inputs]
+        x_all = torch.zeros((self.n, max(sizes), 2), device=self.device)
+        y_all = torch.zeros((self.n, max(sizes)), device=self.device)
+        for i in range(self.n):
+            x_all[i, :sizes[i]] = torch.from_numpy(inputs[i]).float()
+            y_all[i, :sizes[i]] = torch.from_numpy(targets[i]).float()
+        sizes = torch.tensor(sizes, device=self.device)
+
+        # inducing points randomly distributed over each dataset
+        if not warm_start:
+            for i in range(self.n):
+                indpts = np.random.choice(len(inputs[i]), self.m, replace=True)
+                self.variational_strategy.inducing_points.data[i] = x_all[i, indpts]
+
+        # number of random samples, the same for all the GPs
+        n = min(n_samples, int(sizes.min()))
+
+        # objective, with the size of each GP's dataset for its KL term
+        mll = VariationalELBO(self.likelihood, self, sizes.float(), combine_terms=True)
+
+        # stochastic optimiser
+        opt = torch.optim.Adam(self.parameters(), lr=learning_rate)
+
+        # convergence criterion of each GP and mask of the ones still training
+        if auto: criteria = [ExpMAStoppingCriterion(rel_tol=rtol, minimize=True, n_window=n_window)
+                             for _ in range(self.n)]
+        active = torch.ones(self.n, dtype=torch.bool, device=self.device)
+        frozen = {name: p.detach().clone() for name, p in self.named_parameters()}
+
+        # episode iteratior
+        epochs = range(max_iter)
+        epochs = tqdm.tqdm(epochs) if verbose else epochs
+
+        # train
+        self.train()
+        self.likelihood.train()
+        self.loss = list()
+        rows = torch.arange(self.n, device=self.device).unsqueeze(-1)
+        for _ in epochs:
+
+            # randomly sample from each dataset, without replacement
+            keys = torch.rand(x_all.shape[0:2], device=self.device)
+            keys[torch.arange(x_all.shape[1], device=self.device) >= sizes.unsqueeze(-1)] = 2.
+            idx = keys.argsort(dim=1)[:, :n]
+
+            # the converged GPs don't contribute to the gradient
+            loss = -mll(self(x_all[rows, idx]), y_all[rows, idx]) * active
+            opt.zero_grad()
+            loss.sum().backward()
+            opt.step()
+
+            # Adam moments keep moving the converged GPs: put them back
+            with torch.no_grad():
+                for name, p in self.named_parameters():
+                    p[~active] = frozen[name][~active]
+
+            # verbosity and convergence check
+            loss = loss.detach()
+            if verbose:
+                epochs.set_description('Loss {:.4f}'.format(loss[active].mean().item()))
+                self.loss.append(loss.cpu().numpy())
+            if auto:
+                for i in torch.nonzero(active).flatten().tolist():
+                    if criteria[i].evaluate(loss[i]):
+                        active[i] = False
+                        with torch.no_grad():
+                            for name, p in self.named_parameters():
+                                frozen[name][i] = p[i]
+                if not active.any():
+                    break
+
@@ -2,7 +2,8 @@
 
 # from process import process
 import os
-from gp import SVGP
+from gp_mapping.gp import SVGP
+from gp_mapping.tiled_gp import TiledSVGP
 import numpy as np
 from optparse import OptionParser
 import numpy as np
@@ -55,6 +56,51 @@ def train_svgp(gp_inputs_type, survey_name):
                       name + '_post.npy', verbose=False)
 
 
+def train_svgp_stream(gp_inputs_type, survey_dir):
+
+    # Same as train_svgp with the survey memory-mapped instead of loaded: 
+    # survey_dir holds points.npy (n,3) and, for UI, covs.npy (n,3,3)
+    print("Mapping ", survey_dir)
+    points = np.load(os.path.join(survey_dir, 'points.npy'), mmap_mode='r')
+    print("Points ", points.shape)
+
+    if gp_inputs_type == 'di':
+        name = "svgp_di"
+        covariances = None
+    else:
+        covariances = np.load(os.path.join(survey_dir, 'covs.npy'), mmap_mode='r')
+        print("Covariances ", covariances.shape)
+        name = "svgp_ui"
+
+    gp = SVGP(1000)
+    gp.fit_stream(points, covariances=covariances, n_samples=4000, 
+                  max_iter=1000, learning_rate=1e-1, rtol=1e-12, n_window=2000, 
+                  auto=False, verbose=True)
+
+    print("Saving trained GP")
+    gp.save(name + '.pth')
+    gp.plot_loss(name + '_loss.png')
+    np.save(name + '_loss.npy', np.asarray(gp.loss))
+
+
+def train_tiled_svgp(survey_name, tile_size, overlap=None):
+
+    # Local SVGPs over tiles of the survey instead of one global SVGP (DI only)
+    print("Loading ", survey_name)
+    points = np.load(survey_name)['points']
+    inputs = points[:, [0,1]]
+    targets = points[:,2]
+    x = inputs[:,0]
+    y = inputs[:,1]
+
+    gp = TiledSVGP(min(x), max(x), min(y), max(y), tile_size, overlap, n_inducing=100)
+    gp.fit(inputs, targets, n_samples=1000, max_iter=1000, learning_rate=1e-1, 
+           rtol=1e-4, n_window=100, auto=True, verbose=True)
+
+    print("Saving trained GP")
+    gp.save("svgp_tiled.pth")
+
+
 def trace_kernel(gp_path):
 
     gp = SVGP.load(1000, gp_path)
@@ -74,9 +120,19 @@ if __name__ == '__main__':
     parser.add_option("--survey_name", dest="survey_name",
                   default="", help="Name for folder to store results.")
 
+    parser.add_option("--stream", dest="stream", action="store_true",
+                  default=False, help="Memory-map the survey (a folder with points.npy and covs.npy).")
+    parser.add_option("--tile_size", dest="tile_size", type="float",
+                  default=0., help="Train a tiled SVGP with tiles of this size [m].")
+
     (options, args) = parser.parse_args()
     gp_inputs_type = options.gp_inputs
     survey_name = options.survey_name
 
-    train_svgp(gp_inputs_type, survey_name)
+    if options.stream:
+        train_svgp_stream(gp_inputs_type, survey_name)
+    elif options.tile_size > 0.:
+        train_tiled_svgp(survey_name, options.tile_size)
+    else:
+        train_svgp(gp_inputs_type, survey_name)
     # trace_kernel(survey_name)
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+import os
+import numpy as np
+from scipy.ndimage import maximum_filter
+from scipy.signal import fftconvolve
+from scipy.spatial import cKDTree
+from optparse import OptionParser
+
+
+class LocalizabilityMap(object):
+
+    '''
+    Gridded map of how well a MBES ping constrains the horizontal position
+    of the AUV over the bathymetry. At each node, the expected Fisher
+    information of a ping about (x, y) is
+
+        I = n_beams * E_swath[grad(h) grad(h)^T / (meas_std^2 + sigma_h)]
+
+    with h the depth, sigma_h its variance (GP) and E_swath the average over
+    a disk the width of the swath, since the heading of a revisit is not
+    known in advance. The score of a node is the smallest eigenvalue of I:
+    a flat seabed or a long straight ridge only constrains the position
+    along one direction or none.
+
+    The local maxima of the score are precomputed as the candidate revisit
+    cells, sorted by score and indexed with a k-d tree, so that the whole
+    survey area can be ranked at once.
+
+    Layout of the map folder:
+        header.npz: origin (2,), resolution, swath_width, n_beams, meas_std
+        info.npy: (5, ny, nx) float32 array of [Ixx, Ixy, Iyy, curvature, score]
+        candidates.npy: (m, 3) array of [x, y, score] sorted by decreasing score
+    '''
+
+    def __init__(self, path, mmap_mode='r'):
+
+        header = np.load(os.path.join(path, 'header.npz'))
+        self.origin = header['origin']
+        self.resolution = float(header['resolution'])
+        self.swath_width = float(header['swath_width'])
+        self.n_beams = int(header['n_beams'])
+        self.meas_std = float(header['meas_std'])
+        self.info = np.load(os.path.join(path, 'info.npy'), mmap_mode=mmap_mode)
+        self.candidates = np.load(os.path.join(path, 'candidates.npy'))
+        self.tree = cKDTree(self.candidates[:, 0:2])
+
+    def fisher(self, x):
+
+        '''
+        Information matrices of a ping at x, nearest node
+        x: (n,2) numpy array
+        returns:
+            info: (n,2,2) numpy array, zero outside of the map
+        '''
+
+        # sanity
+        assert len(x.shape) == x.shape[1] == 2
+
+        _, ny, nx = self.info.shape
+        i = np.round((x - self.origin) / self.resolution).astype(np.int64)
+        inside = np.all((i >= 0) & (i < [nx, ny]), axis=1)
+        i = np.clip(i, 0, [nx - 1, ny - 1])
+        v = np.asarray(self.info[0:3, i[:, 1], i[:, 0]], dtype=np.float64)
+        v[:, ~inside] = 0.
+
+        info = np.empty((len(x), 2, 2))
+        info[:, 0, 0] = v[0]
+        info[:, 0, 1] = info[:, 1, 0] = v[1]
+        info[:, 1, 1] = v[2]
+        return info
+
+    def score(self, x):
+
+        '''
+        Localizability score at x, nearest node
+        x: (n,2) numpy array
+        returns:
+            score: (n,) numpy array, zero outside of the map
+        '''
+
+        return _min_eig(self.fisher(x))
+
+    def query(self, x, radius, n=None):
+
+        '''
+        Candidate revisit cells within radius of x, by decreasing score
+        x: (2,) numpy array
+        radius: search radius [m]
+        n: max number of cells returned, all by default
+        returns:
+            candidates: (m,3) numpy array of [x, y, score]
+        '''
+
+        # an empty list would index as floats
+        idx = np.sort(np.asarray(self.tree.query_ball_point(x, radius), dtype=np.int64))
+        return self.candidates[idx[:n]]
+
+    @classmethod
+    def build(cls, depth, variance, path, origin, resolution, swath_width,
+              n_beams=512, meas_std=0.01, min_separation=None, min_score=None,
+              verbose=True):
+
+        '''
+        Computes the localizability map of a depth raster and saves it.
+
+        depth: (ny,nx) numpy array of depths, NaN where unknown
+        variance: (ny,nx) numpy array of depth variances, or None (e.g. mesh)
+        path: folder to save the map at
+        origin: (2,) coordinates of depth[0, 0]
+        resolution: grid spacing [m]
+        swath_width: width of the MBES footprint on the seabed [m]
+        n_beams: beams per ping
+        meas_std: std of the MBES depths [m]
+        min_separation: min distance between candidates, swath_width by default
+        min_score: candidates with a lower score are dropped, 1e-3 of the max by default
+        '''
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        depth = np.asarray(depth, dtype=np.float64)
+        known = ~np.isnan(depth)
+        var = meas_std**2 + (0. if variance is None
+                             else np.nan_to_num(np.asarray(variance, dtype=np.float64)))
+
+        # terrain gradient and curvature (trace of the Hessian)
+        gy, gx = np.gradient(np.where(known, depth, 0.), resolution)
+        gyy, _ = np.gradient(gy, resolution)
+        _, gxx = np.gradient(gx, resolution)
+        # the differences across the border of the known area are not terrain
+        border = ~maximum_filter(~known, size=5)
+        terms = np.stack((gx * gx, gx * gy, gy * gy)) / var * border
+
+        # average over the swath footprint, normalised by its known part
+        if verbose: print('Averaging over the swath')
+        r = max(1, int(round(0.5 * swath_width / resolution)))
+        yy, xx = np.mgrid[-r:r+1, -r:r+1]
+        disk = (xx**2 + yy**2 <= r**2).astype(np.float64)
+        count = fftconvolve(border.astype(np.float64), disk, mode='same')
+        with np.errstate(invalid='ignore', divide='ignore'):
+            info = n_beams * np.stack([fftconvolve(t, disk, mode='same') for t in terms]) / count
+        info[:, count < 0.5 * disk.sum()] = 0.
+
+        grid = np.lib.format.open_memmap(os.path.join(path, 'info.npy'), mode='w+',
+                                         dtype=np.float32, shape=(5,) + depth.shape)
+        grid[0:3] = info
+        grid[3] = np.where(border, gxx + gyy, 0.)
+        score = _min_eig(np.stack((np.stack((info[0], info[1]), axis=-1),
+                                   np.stack((info[1], info[2]), axis=-1)), axis=-2))
+        grid[4] = score
+        grid.flush()
+
+        # candidates: local maxima of the score, at least min_separation apart
+        if verbose: print('Extracting candidates')
+        min_separation = swath_width if min_separation is None else min_separation
+        min_score = 1e-3 * score.max() if min_score is None else min_score
+        s = max(1, int(round(min_separation / resolution)))
+        peaks = (score == maximum_filter(score, size=2 * s + 1)) & (score > min_score)
+        iy, ix = np.nonzero(peaks)
+        order = np.argsort(-score[iy, ix], kind='stable')
+        iy, ix = iy[order], ix[order]
+        candidates = np.column_stack((origin[0] + resolution * ix,
+                                      origin[1] + resolution * iy,
+                                      score[iy, ix]))
+        # plateaus give several maxima, keep the first one of each
+        tree = cKDTree(candidates[:, 0:2])
+        keep = np.ones(len(candidates), dtype=bool)
+        for i, j in sorted(tree.query_pairs(min_separation)):
+            if keep[i]:
+                keep[j] = False
+        np.save(os.path.join(path, 'candidates.npy'), candidates[keep])
+
+        np.savez(os.path.join(path, 'header.npz'), origin=np.asarray(origin, dtype=np.float64),
+                 resolution=resolution, swath_width=swath_width, n_beams=n_beams,
+                 meas_std=meas_std)
+
+        return cls(path)
+
+
+def _min_eig(info):
+    # Smallest eigenvalue of (...,2,2) symmetric matrices, in closed form
+    a, b, c = info[..., 0, 0], info[..., 0, 1], info[..., 1, 1]
+    return np.maximum(0.5 * (a + c) - np.sqrt(0.25 * (a - c)**2 + b**2), 0.)
+
+
+def _rasterize_mesh(V, F, xlb, xub, ylb, yub, resolution):
+    # Depth of the mesh on a grid, cast with vertical rays from above
+    from auv_utils.raycaster import MeshRaycaster
+    raycaster = MeshRaycaster(V, F)
+    xs = np.arange(xlb, xub + 0.5 * resolution, resolution)
+    ys = np.arange(ylb, yub + 0.5 * resolution, resolution)
+    xx, yy = np.meshgrid(xs, ys)
+    origins = np.column_stack((xx.ravel(), yy.ravel(),
+                               np.full(xx.size, V[:, 2].max() + 1.)))
+    dirs = np.tile([0., 0., -1.], (len(origins), 1))
+    hits = np.concatenate([raycaster.cast_rays(origins[i:i+100000], dirs[i:i+100000])
+                           for i in range(0, len(origins), 100000)])
+    return hits[:, 2].reshape(xx.shape)
+
+
+if __name__ == '__main__':
+
+    parser = OptionParser()
+    parser.add_option("--tile_map", dest="tile_map",
+                  default="", help="GP tile map folder (tile_map.py) to analyse.")
+    parser.add_option("--mesh_path", dest="mesh_path",
+                  default="", help="Folder of the mesh.npz to analyse instead.")
+    parser.add_option("--output", dest="output",
+                  default="", help="Folder to store the localizability map.")
+    parser.add_option("--resolution", dest="resolution", type="float",
+                  default=1., help="Grid spacing for the mesh [m].")
+    parser.add_option("--swath_width", dest="swath_width", type="float",
+                  default=50., help="Width of the MBES footprint on the seabed [m].")
+    parser.add_option("--n_beams", dest="n_beams", type="int",
+                  default=512, help="Beams per ping.")
+    parser.add_option("--meas_std", dest="meas_std", type="float",
+                  default=0.01, help="Std of the MBES depths [m].")
+
+    (options, args) = parser.parse_args()
+
+    if options.tile_map:
+        from gp_mapping.tile_map import GPTileMap
+        tile_map = GPTileMap(options.tile_map)
+        depth, variance = tile_map.levels[0]
+        origin, resolution = tile_map.origin, tile_map.resolution
+    else:
+        data = np.load(os.path.join(options.mesh_path, 'mesh.npz'))
+        V = data['V']
+        depth = _rasterize_mesh(V, data['F'], V[:, 0].min(), V[:, 0].max(),
+                                V[:, 1].min(), V[:, 1].max(), options.resolution)
+        variance = None
+        origin, resolution = V[:, 0:2].min(axis=0), options.resolution
+
+    LocalizabilityMap.build(depth, variance, options.output, origin, resolution,
+                            options.swath_width, options.n_beams, options.meas_std)
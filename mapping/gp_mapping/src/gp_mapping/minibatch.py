@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import threading, queue
+import numpy as np
+import torch
+
+
+class MinibatchSampler(object):
+
+    '''
+    Endless stream of random minibatches of the rows of some arrays, e.g. the
+    inputs, targets and covariances of a GP. The arrays can be memory-mapped
+    .npy files (np.load(..., mmap_mode='r')), since only the rows of each
+    minibatch are read and a batch costs O(n_samples) whatever the size of
+    the dataset.
+
+    The rows are drawn as random blocks of block_size consecutive rows without
+    replacement, which turns the reads from disk into a few sequential ones.
+    With prefetch > 0 the batches are read on a background thread into a ring
+    of preallocated (pinned, on a GPU host) tensors, so the reads overlap
+    with the optimisation steps.
+    '''
+
+    def __init__(self, arrays, n_samples, block_size=1, prefetch=0,
+                 device=torch.device('cpu')):
+
+        '''
+        arrays: list of numpy arrays (or memmaps) with the same number of rows
+        n_samples: number of rows per batch, at most the rows in whole blocks
+        block_size: number of consecutive rows read together
+        prefetch: number of batches read ahead, 0 to read them on demand
+        device: device of the returned tensors
+        '''
+
+        n_rows = len(arrays[0])
+        assert all(len(a) == n_rows for a in arrays)
+        self.arrays = arrays
+        self.block_size = max(1, min(block_size, n_samples, n_rows))
+        # the tail of the arrays that doesn't fill a block is never drawn
+        self.n_blocks_total = n_rows // self.block_size
+        self.n = min(n_samples, self.n_blocks_total * self.block_size)
+        self.n_blocks = int(np.ceil(self.n / self.block_size))
+        self.prefetch = prefetch
+        self.device = device
+        self.rng = np.random.default_rng()
+
+        # ring of buffers: prefetch batches queued, one being read, one in use
+        pin = device.type == 'cuda'
+        self.buffers = [[torch.empty((self.n,) + a.shape[1:], dtype=torch.float32,
+                                     pin_memory=pin) for a in arrays]
+                        for _ in range(prefetch + 2 if prefetch > 0 else 1)]
+
+        self._queue = None
+        self._stop = threading.Event()
+
+    def _read(self, slot):
+        # O(n_blocks) draw, unlike a permutation of all the rows
+        starts = np.sort(self.rng.choice(self.n_blocks_total, self.n_blocks,
+                                         replace=False)) * self.block_size
+        rows = (starts[:, np.newaxis] + np.arange(self.block_size)).ravel()[:self.n]
+        for a, buf in zip(self.arrays, self.buffers[slot]):
+            buf.copy_(torch.from_numpy(np.asarray(a[rows], dtype=np.float32)))
+        return slot
+
+    def _producer(self):
+        slot = 0
+        while not self._stop.is_set():
+            self._read(slot)
+            while not self._stop.is_set():
+                try:
+                    self._queue.put(slot, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            slot = (slot + 1) % len(self.buffers)
+
+    def __iter__(self):
+        if self.prefetch > 0 and self._queue is None:
+            self._queue = queue.Queue(maxsize=self.prefetch)
+            threading.Thread(target=self._producer, daemon=True).start()
+        return self
+
+    def __next__(self):
+        slot = self._queue.get() if self._queue is not None else self._read(0)
+        return [b.to(self.device, non_blocking=True) for b in self.buffers[slot]]
+
+    def close(self):
+        self._stop.set()
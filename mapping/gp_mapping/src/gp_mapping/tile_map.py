@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+import os
+import numpy as np
+from optparse import OptionParser
+
+
+class GPTileMap(object):
+
+    '''
+    Rasterized posterior of a trained GP map. The predictive mean and
+    variance are evaluated offline on a regular grid and stored as
+    memory-mapped .npy files, one per resolution level, so that a
+    query is a bilinear interpolation over the grid instead of a
+    GP inference call.
+
+    Level 0 has the resolution the map was built with, each following
+    level halves it. The nodes of level k are the even nodes of
+    level k-1, so all levels share the same origin. Along an axis with an
+    even number of nodes, the coarse level gets one more node past the last
+    one, with its value, so that every level covers the whole map.
+
+    Layout of the map folder:
+        header.npz: origin (2,), resolution, shapes (levels, 2) as (ny, nx)
+        level_<k>.npy: (2, ny, nx) float32 array of [mean, variance]
+    '''
+
+    def __init__(self, path, mmap_mode='r'):
+
+        header = np.load(os.path.join(path, 'header.npz'))
+        self.origin = header['origin']
+        self.resolution = float(header['resolution'])
+        self.shapes = header['shapes']
+        self.levels = [np.load(os.path.join(path, 'level_{}.npy'.format(k)),
+                               mmap_mode=mmap_mode)
+                       for k in range(len(self.shapes))]
+
+    def sample(self, x, level=0):
+
+        '''
+        Bilinear interpolation of the rasterized posterior at x
+        x: (n,2) numpy array
+        level: resolution level to query
+        returns:
+            mu: (n,) numpy array of predictive mean at x
+            sigma: (n,) numpy array of predictive variance at x
+        NaN is returned for the points outside of the map
+        '''
+
+        # sanity
+        assert len(x.shape) == x.shape[1] == 2
+
+        grid = self.levels[level]
+        ny, nx = self.shapes[level]
+        res = self.resolution * 2**level
+
+        # continuous grid coordinates, inside the extent of level 0
+        f = (x - self.origin) / res
+        ny0, nx0 = self.shapes[0]
+        inside = np.all((x >= self.origin) &
+                        (x <= self.origin + self.resolution * np.array([nx0 - 1, ny0 - 1])),
+                        axis=1)
+
+        # lower-left node of the cell, the last row/col belongs to the cell before
+        i = np.clip(np.floor(f).astype(np.int64), 0, [nx - 2, ny - 2])
+        t = f - i
+        tx, ty = t[:, 0], t[:, 1]
+        ix, iy = i[:, 0], i[:, 1]
+
+        # gather the 4 corners of each cell for mean and variance at once
+        v00 = grid[:, iy, ix]
+        v01 = grid[:, iy, ix + 1]
+        v10 = grid[:, iy + 1, ix]
+        v11 = grid[:, iy + 1, ix + 1]
+        v = ((v00 * (1. - tx) + v01 * tx) * (1. - ty) +
+             (v10 * (1. - tx) + v11 * tx) * ty)
+
+        v[:, ~inside] = np.nan
+
+        return v[0], v[1]
+
+    @classmethod
+    def build(cls, gp, path, xlb, xub, ylb, yub, resolution, n_levels=4,
+              batch_size=100000, verbose=True):
+
+        '''
+        Evaluates the GP posterior on a regular grid over the rectangular
+        region defined by (xlb, xub) and (ylb, yub) and saves it as a
+        multi-resolution tile map.
+
+        gp: trained GP exposing sample(x) -> (mu, sigma), e.g. SVGP
+        path: folder to save the map at
+        resolution: grid spacing of level 0 [m]
+        n_levels: number of resolution levels
+        batch_size: number of grid nodes per GP query
+        '''
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        nx = int(np.floor((xub - xlb) / resolution)) + 1
+        ny = int(np.floor((yub - ylb) / resolution)) + 1
+        xs = xlb + resolution * np.arange(nx)
+        ys = ylb + resolution * np.arange(ny)
+
+        # level 0 straight from the GP, in blocks of rows to bound the memory
+        grid = np.lib.format.open_memmap(os.path.join(path, 'level_0.npy'),
+                                         mode='w+', dtype=np.float32,
+                                         shape=(2, ny, nx))
+        rows = max(1, batch_size // nx)
+        for r in range(0, ny, rows):
+            if verbose: print('Rows {}/{}'.format(r, ny))
+            xx, yy = np.meshgrid(xs, ys[r:r+rows])
+            mu, sigma = gp.sample(np.column_stack((xx.ravel(), yy.ravel())))
+            grid[0, r:r+rows] = mu.reshape(xx.shape)
+            grid[1, r:r+rows] = sigma.reshape(xx.shape)
+        grid.flush()
+
+        shapes = [(ny, nx)]
+        for k in range(1, n_levels):
+            if min(shapes[-1]) < 3:
+                break
+            grid = cls._downsample(grid, os.path.join(path, 'level_{}.npy'.format(k)),
+                                   batch_size)
+            shapes.append(grid.shape[1:])
+
+        np.savez(os.path.join(path, 'header.npz'), origin=np.array([xlb, ylb]),
+                 resolution=resolution, shapes=np.array(shapes))
+
+        return cls(path)
+
+    @staticmethod
+    def _downsample(grid, fname, batch_size=100000):
+
+        # [1,2,1]/4 smoothing on both axes at the even nodes, the fine nodes
+        # past the border repeat the edge ones. The variance of the coarse
+        # node is that of the mixture of the fine ones
+        _, ny, nx = grid.shape
+        cy, cx = ny // 2 + 1, nx // 2 + 1
+        w = np.array([0.25, 0.5, 0.25])
+        # fine columns around each coarse one
+        jx = np.clip(2 * np.arange(cx)[:, np.newaxis] + [-1, 0, 1], 0, nx - 1)
+
+        coarse = np.lib.format.open_memmap(fname, mode='w+', dtype=np.float32,
+                                           shape=(2, cy, cx))
+
+        # in blocks of coarse rows, read with their fine neighbours
+        rows = max(1, batch_size // nx)
+        for r in range(0, cy, rows):
+            iy = np.clip(2 * np.arange(r, min(r + rows, cy))[:, np.newaxis] + [-1, 0, 1],
+                         0, ny - 1)
+            lo = iy.min()
+            fine = np.asarray(grid[:, lo:iy.max() + 1], dtype=np.float64)
+            iy = iy - lo
+
+            def smooth(a):
+                a = np.tensordot(a[iy], w, axes=([1], [0]))
+                return np.tensordot(a[:, jx], w, axes=([2], [0]))
+
+            mu_s = smooth(fine[0])
+            var_s = smooth(fine[1]) + smooth(fine[0]**2) - mu_s**2
+            coarse[0, r:r+len(iy)] = mu_s
+            coarse[1, r:r+len(iy)] = np.maximum(var_s, 0.)
+        coarse.flush()
+
+        return coarse
+
+
+if __name__ == '__main__':
+
+    parser = OptionParser()
+    parser.add_option("--gp_path", dest="gp_path",
+                  default="", help="Trained SVGP (.pth).")
+    parser.add_option("--survey_name", dest="survey_name",
+                  default="", help="Survey (.npz) whose extent the map covers.")
+    parser.add_option("--output", dest="output",
+                  default="", help="Folder to store the tile map.")
+    parser.add_option("--resolution", dest="resolution", type="float",
+                  default=1., help="Grid spacing of the finest level [m].")
+    parser.add_option("--levels", dest="levels", type="int",
+                  default=4, help="Number of resolution levels.")
+
+    (options, args) = parser.parse_args()
+
+    from gp_mapping.gp import SVGP
+    gp = SVGP.load(1000, options.gp_path)
+    gp.cache_posterior()
+
+    points = np.load(options.survey_name)['points']
+    x = points[:, 0]
+    y = points[:, 1]
+    GPTileMap.build(gp, options.output, min(x), max(x), min(y), max(y),
+                    options.resolution, options.levels)
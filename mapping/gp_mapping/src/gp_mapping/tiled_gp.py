@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import torch
+from gp_mapping.gp import SVGP, BatchSVGP
+
+
+class TiledSVGP(object):
+
+    '''
+    Spatially local GP map for large surveys. The region is split into a
+    regular grid of square tiles, each with its own small SVGP trained on
+    the points of the tile plus an overlap band around it. A query only
+    involves the tiles around it, and the predictions of neighbouring tiles
+    are blended over the overlap bands so the map is continuous across
+    tile borders. Training and prediction costs depend on the local density
+    of the data instead of the size of the survey.
+
+    The blending weight of a tile decreases linearly from 1 inside of it
+    to 0 at the outer edge of its overlap band, so it is 0.5 on its border
+    and the weights of the tiles covering a point add up to 1.
+    '''
+
+    def __init__(self, xlb, xub, ylb, yub, tile_size, overlap=None, n_inducing=100):
+
+        '''
+        xlb, xub, ylb, yub: bounds of the mapped region
+        tile_size: side of the tiles [m]
+        overlap: width of the band around each tile used for training and
+                 blending, a quarter of the tile by default, at most half
+        n_inducing: number of inducing points of each tile's SVGP
+        '''
+
+        self.origin = np.array([xlb, ylb], dtype=np.float64)
+        self.tile_size = float(tile_size)
+        self.overlap = 0.25 * self.tile_size if overlap is None else float(overlap)
+        assert 0. < self.overlap <= 0.5 * self.tile_size
+        self.n_inducing = n_inducing
+        self.n_tiles = (np.floor((np.array([xub, yub]) - self.origin) / self.tile_size)
+                        .astype(np.int64) + 1)
+
+        # trained tiles by flat index (iy * nx + ix)
+        self.tiles = dict()
+
+    def _tile_pairs(self, x):
+
+        # All the (point, tile) pairs of tiles whose overlap band contains the
+        # points, with the blending weight of the tile at the point
+        f = (x - self.origin) / self.tile_size
+        c = np.clip(np.floor(f).astype(np.int64), 0, self.n_tiles - 1)
+        points, tiles, weights = list(), list(), list()
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                t = c + [dx, dy]
+                # distance to the outer edge of the band, in tile units
+                d = np.minimum(f - t, t + 1. - f) + self.overlap / self.tile_size
+                w = np.clip(d / (2. * self.overlap / self.tile_size), 0., 1.).prod(axis=1)
+                valid = np.flatnonzero(np.all((t >= 0) & (t < self.n_tiles), axis=1) & (w > 0.))
+                points.append(valid)
+                tiles.append(t[valid, 1] * self.n_tiles[0] + t[valid, 0])
+                weights.append(w[valid])
+
+        return np.concatenate(points), np.concatenate(tiles), np.concatenate(weights)
+
+    def fit(self, inputs, targets, min_points=None, batch_tiles=64, verbose=True, **fit_args):
+
+        '''
+        Trains the SVGP of every tile with enough data in its band.
+        The tiles are trained batch_tiles at a time as a BatchSVGP, grouped
+        by size so that they draw the same number of samples per epoch.
+        inputs: (n,2) numpy array
+        targets: (n,) numpy array
+        min_points: tiles with fewer points are left empty, n_inducing by default
+        batch_tiles: number of tiles trained together
+        fit_args: arguments of BatchSVGP.fit
+        '''
+
+        # sanity
+        assert inputs.shape[0] == targets.shape[0]
+        assert inputs.shape[1] == 2
+        min_points = self.n_inducing if min_points is None else min_points
+
+        # points in the band of each tile
+        points, tiles, _ = self._tile_pairs(inputs)
+        order = np.argsort(tiles, kind='stable')
+        points, tiles = points[order], tiles[order]
+        ids, starts, counts = np.unique(tiles, return_index=True, return_counts=True)
+        keep = counts >= min_points
+        ids, starts, counts = ids[keep], starts[keep], counts[keep]
+
+        # batches of tiles of similar size
+        by_size = np.argsort(counts)
+        for b in range(0, len(by_size), batch_tiles):
+            group = by_size[b:b+batch_tiles]
+            if verbose: print('Tiles {}-{}/{}'.format(b, b + len(group), len(by_size)))
+            idx = [points[starts[k]:starts[k]+counts[k]] for k in group]
+            batch = BatchSVGP(len(group), self.n_inducing)
+            batch.fit([inputs[i] for i in idx], [targets[i] for i in idx],
+                      verbose=False, **fit_args)
+
+            gps = [SVGP(self.n_inducing) for _ in group]
+            batch.unstack(gps)
+            for k, gp in zip(group, gps):
+                gp.cache_posterior()
+                self.tiles[int(ids[k])] = gp
+
+    def sample(self, x):
+
+        '''
+        Samples the posterior at x, blending the tiles around each point
+        x: (n,2) numpy array
+        returns:
+            mu: (n,) numpy array of predictive mean at x
+            sigma: (n,) numpy array of predictive variance at x
+        NaN is returned for the points without any trained tile around
+        '''
+
+        # sanity
+        assert len(x.shape) == x.shape[1] == 2
+
+        points, tiles, weights = self._tile_pairs(x)
+        trained = np.isin(tiles, list(self.tiles))
+        points, tiles, weights = points[trained], tiles[trained], weights[trained]
+
+        # each tile sampled once at all its points
+        mu_t = np.empty(len(points))
+        var_t = np.empty(len(points))
+        order = np.argsort(tiles, kind='stable')
+        ids, starts = np.unique(tiles[order], return_index=True)
+        for k, (tile, start) in enumerate(zip(ids, starts)):
+            sel = order[start:starts[k+1] if k + 1 < len(starts) else len(order)]
+            mu_t[sel], var_t[sel] = self.tiles[int(tile)].sample(x[points[sel]])
+
+        # normalized blend, the variance being that of the mixture of the tiles
+        w_sum = np.bincount(points, weights, minlength=len(x))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mu = np.bincount(points, weights * mu_t, minlength=len(x)) / w_sum
+            m2 = np.bincount(points, weights * (var_t + mu_t**2), minlength=len(x)) / w_sum
+        sigma = np.maximum(m2 - mu**2, 0.)
+        sigma[w_sum == 0.] = np.nan
+
+        return mu, sigma
+
+    def save(self, fname):
+        torch.save({'origin': self.origin.tolist(), 'tile_size': self.tile_size,
+                    'overlap': self.overlap, 'n_inducing': self.n_inducing,
+                    'n_tiles': self.n_tiles.tolist(),
+                    'tiles': {k: gp.state_dict() for k, gp in self.tiles.items()}},
+                   fname)
+
+    @classmethod
+    def load(cls, fname):
+        data = torch.load(fname)
+        origin = np.array(data['origin'])
+        ub = origin + data['tile_size'] * (np.array(data['n_tiles']) - 0.5)
+        tgp = cls(origin[0], ub[0], origin[1], ub[1],
+                  data['tile_size'], data['overlap'], data['n_inducing'])
+        for k, state in data['tiles'].items():
+            gp = SVGP(tgp.n_inducing)
+            gp.load_state_dict(state)
+            gp.cache_posterior()
+            tgp.tiles[k] = gp
+        return tgp
@@ -3,33 +3,24 @@
 import rospy
 from nav_msgs.msg import Odometry
 from sensor_msgs.msg import PointCloud2
-import sensor_msgs.point_cloud2 as pc2
 from std_msgs.msg import Bool
 import tf2_ros
 from tf.transformations import translation_matrix, quaternion_matrix 
 import tf
 
-from sympy import *
 import matplotlib.pyplot as plt
 import numpy as np
 import math
-from barfoot_utils import create_rot_sym
 from barfoot_utils_np import *
 from auvlib.data_tools import std_data, all_data
 from optparse import OptionParser
 from scipy.spatial.transform import Rotation as Rot
+from auv_utils.ping_codec import decode_cloud
+from unscented import sigmapoints_cov_batch
+from motion_model import motion_model, motion_jacobian
 import os
 
 
-def pcloud2ranges_full(point_cloud):
-    ranges = []
-    for p in pc2.read_points(point_cloud, 
-                             field_names = ("x", "y", "z"), skip_nans=True):
-        ranges.append(p)
-
-    return np.asarray(ranges)
-
-
 def matrix_from_tf(transform):
     if transform._type == 'geometry_msgs/TransformStamped':
         transform = transform.transform
@@ -61,6 +52,8 @@ class auv_ui(object):
         self.mbes_frame = rospy.get_param('~mbes_link', 'mbes_link') # mbes frame_id
         self.base_frame = rospy.get_param('~base_link', 'base_link')
         self.survey_name = rospy.get_param('~dataset', 'survey')
+        # Beams per ping to propagate the uncertainty of, 0 for all of them
+        self.ui_beams = rospy.get_param('~num_beams_ui', 100)
         
         # Transforms from auv_2_ros
         tfBuffer = tf2_ros.Buffer()
@@ -98,23 +91,6 @@ class auv_ui(object):
         except:
             rospy.loginfo("ERROR: Could not lookup transform from base_link to mbes_link")
 
-        ## Symbols
-        # State
-        x, y, z, rho, phi, theta = symbols('x y z rho phi theta', real=True)
-        # Control input
-        vx, vy, vz, wx, wy, wz = symbols('vx vy vz wx wy wz', real=True)
-        dt = Symbol('dt', real=True)
-        # Vehicle state
-        self.X = Matrix([x,y,z, rho, phi, theta])
-        V = Matrix([vx,vy,vz, wx, wy, wz])
-
-        # Rotation matrices
-        self.Rxyz = create_rot_sym(self.X[3:6])
-
-        # 3D motion model and Jacobian
-        self.g = sym.lambdify([self.X, V, dt], self.motion_model(self.X,V,dt), "numpy")
-        self.G = sym.lambdify([self.X, V, dt], self.motion_model(self.X, V, dt).jacobian(self.X), "numpy")
-
         # Signal to end survey and save data
         finished_top = rospy.get_param("~survey_finished_top", '/survey_finished')
         self.synch_pub = rospy.Subscriber(finished_top, Bool, self.synch_cb)
@@ -173,19 +149,17 @@ class auv_ui(object):
         dt_real = self.time - self.old_time 
         # dt_real = 0.2
         
-        # Turn off np warning
-        np.warnings.filterwarnings('ignore', category=np.VisibleDeprecationWarning) 
         vt = np.array([odom_msg.twist.twist.linear.x,
                        odom_msg.twist.twist.linear.y,
                        odom_msg.twist.twist.linear.z,
                     #    odom_msg.twist.twist.angular.x + np.random.normal(0, 0.001, 1),
                        odom_msg.twist.twist.angular.x,
                        odom_msg.twist.twist.angular.y,
-                    #    odom_msg.twist.twist.angular.z], dtype=object)
-                       odom_msg.twist.twist.angular.z + np.random.normal(0, 0.002, 1)], dtype=object)
+                    #    odom_msg.twist.twist.angular.z])
+                       odom_msg.twist.twist.angular.z + np.random.normal(0, 0.002)])
 
         ## Prediction
-        mu_hat_t = np.concatenate(self.g(self.mu_t, vt, dt_real), axis=0)
+        mu_hat_t = motion_model(self.mu_t, vt, dt_real)
         for i in range(3,6): # Wrap angles
             mu_hat_t[i] = (mu_hat_t[i] + np.pi) % (2 * np.pi) - np.pi
         
@@ -207,8 +181,7 @@ class auv_ui(object):
             self.pose_t[i] = (self.pose_t[i] + np.pi) % (2 * np.pi) - np.pi
         # print(self.pose_t - mu_hat_t)
         
-        Gt = np.concatenate(np.array(self.G(self.mu_t, vt, dt_real)).astype(np.float64), 
-                            axis=0).reshape(6,6)
+        Gt = motion_jacobian(self.mu_t, vt, dt_real)
         sigma_hat_t = Gt @ self.sigma_t @ Gt.T + self.R
 
         ## Update
@@ -232,98 +205,34 @@ class auv_ui(object):
         Covt = self.compound_covs(self.sigma_t, self.Q_3d)
 
         # Ping as array in homogeneous coordinates
-        beams_mbes = pcloud2ranges_full(mbes_ping)
+        beams_mbes = decode_cloud(mbes_ping)
         beams_mbes = np.hstack((beams_mbes, np.ones((len(beams_mbes), 1))))
 
         # Use only N beams
-        N = 100
+        N = self.ui_beams if self.ui_beams > 0 else len(beams_mbes)
         idx = np.round(np.linspace(0, len(beams_mbes)-1, N)).astype(int)
         beams_mbes_filt = beams_mbes[idx]
         print("UI ping ", self.pings_num, " with: ", len(beams_mbes), " beams")
         
-        for n in range(len(beams_mbes_filt)):
-        # for n in range(len(beams_mbes)):
-            # Create landmark as expected patch of seabed to be hit (in map frame)
-            beam_map = np.matmul(Tm2mbes, beams_mbes_filt[n])
-            # beam_map = np.matmul(Tm2mbes, beams_mbes[n])
-            # print(beam_map[0:3])
+        # Create landmarks as expected patches of seabed to be hit (in map frame)
+        beams_map = np.matmul(Tm2mbes, beams_mbes_filt.T).T
+
+        ## Sigma points cov calculation at time t in vehicle domain, all beams at once
+        ysp, yspcov = sigmapoints_cov_batch(Tm2mbes, Covt, beams_map)
         
-            # Expected measurement to beam_map as 3D coordinates
-            ht_3d = self.meas_model_3D(Tm2mbes, Tm2mbes, beam_map)
-            
-            ## Sigma points cov calculation at time t in vehicle domain
-            ysp, yspcov = self.sigmapoints_cov(Tm2mbes, Covt, beam_map, ht_3d)
-            
-            # Save results for plotting
-            self.ysp_vec.append(ysp)
-            self.yspcov_vec.append(yspcov[0:3,0:3])
-            self.m_vec.append(beam_map[0:3])
+        # Save results for plotting
+        self.ysp_vec.extend(ysp)
+        self.yspcov_vec.extend(yspcov[:,0:3,0:3])
+        self.m_vec.extend(beams_map[:,0:3])
 
-            # Store real MBES beams and approximated covariances
-            self.covs_all.append(yspcov[0:3,0:3])
-            self.means_all.append(beam_map[0:3])
+        # Store real MBES beams and approximated covariances
+        self.covs_all.extend(yspcov[:,0:3,0:3])
+        self.means_all.extend(beams_map[:,0:3])
 
         self.pings_num += 1
         # # Plotting
         # self.visualize()
 
-    # Motion model in 3D
-    def motion_model(self, X, V, dt):
-        g_r = Matrix([X[3:6]]) + Matrix([V[3:6]]).multiply(dt)
-        g_p = Matrix(X[0:3]) + self.Rxyz.subs([(X[3], X[3]),
-                                               (X[4], X[4]), 
-                                               (X[5], X[5])]).multiply(
-                                                   Matrix([V[0:3]]).T).multiply(dt)
-        g = Matrix(BlockMatrix([[g_p], [g_r.T]]))
-        
-        return g
-
-    # MBES meas model in 3D: z = [x,y,z] in map frame
-    def meas_model_3D(self, T, Tnoisy, mnoisy):
-        Tinv_noisy = transInv(Tnoisy)
-        h_auv = np.matmul(Tinv_noisy,mnoisy)
-        h_map = np.matmul(T, h_auv)
-
-        map_mat = np.array([[1,0,0,0],
-                              [0,1,0,0],
-                              [0,0,1,0],
-                              [0,0,0,0]])
-
-        h = np.matmul(map_mat, h_map)
-        return h_map
-
-
-    def sigmapoints_cov(self, T, Cov, m, ylin):
-        Q = np.array([[1, 0, 0], [0, 1, 0], [0, 0, 1], [0, 0, 0]])
-        kappa = 0.
-        L = 9
-
-        # Make sure Cov remains positive-semidefinite
-        Cov = np.where(Cov>=0., Cov,0.)
-        S = np.linalg.cholesky(Cov)
-        spoint = np.block([np.zeros((L, 1)),
-                           S * np.sqrt(L+kappa),
-                           -S * np.sqrt(L+kappa)])
-        yspsample = []
-        yspsample.append(ylin)
-        ysp = yspsample[0] * (kappa/(kappa+L))
-
-        # Sampled mean
-        for n in range(1,2*L+1):
-            Tsample = np.matmul(vec2tran(spoint[0:6,n]), T)
-            msample = m + np.matmul(Q, spoint[6:9,n])
-            h = self.meas_model_3D(T, Tsample, msample)
-
-            yspsample.append(h)
-            ysp += yspsample[n] * (1/(2*(L+kappa)))
-
-        # Sampled covariance
-        yspcov = np.matmul((yspsample[0] - ysp).reshape(4,1), (yspsample[0]-ysp).reshape(1,4)) * (kappa/(kappa + L))
-        for n in range(1,2*L+1):
-            yspcov += np.matmul((yspsample[n]-ysp).reshape(4,1), (yspsample[n]-ysp).reshape(1,4)) * (1/(2*(kappa + L)))
-
-        return ysp, yspcov
-
 
     def compound_covs(self, sigma, Q):
         return np.block([[sigma, np.zeros((6,3))], [np.zeros((3,6)), Q]])
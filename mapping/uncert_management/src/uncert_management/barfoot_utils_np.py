@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 
-import sympy as sym
 import numpy as np
 import math
 from scipy.spatial.transform import Rotation as rot
@@ -177,7 +176,7 @@ def vec2jac(vec):
             Jsmall = vec2jac(phi)
             Q = vec2Q(vec)
             J = np.block([[Jsmall, Q],
-                          [sym.zeros(3), Jsmall]])
+                          [np.zeros((3,3)), Jsmall]])
 
     return J
 
@@ -236,7 +235,7 @@ def vec2Q(vec):
 def curlyhat(vec):
     phihat = hat(vec[3:6])
     veccurlyhat = np.block([[phihat, hat(vec[0:3])],
-                            [sym.zeros(3), phihat]])
+                            [np.zeros((3,3)), phihat]])
 
     return veccurlyhat
 
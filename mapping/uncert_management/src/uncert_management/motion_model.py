@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+
+# Constant velocity AUV motion model in 3D, closed form of the sympy model
+# that auv_ui used to lambdify:
+#     p_t = p_t-1 + R(rpy_t-1) v dt
+#     rpy_t = rpy_t-1 + w dt
+# with X = [x, y, z, roll, pitch, yaw], V = [vx, vy, vz, wx, wy, wz] and
+# R = Rz(yaw) Ry(pitch) Rx(roll). All the functions take batches of states
+# and inputs along the leading dimensions: X, V (...,6), dt scalar or (...,)
+
+def _rot_factors(rpy):
+    c = np.cos(rpy)
+    s = np.sin(rpy)
+    one = np.ones_like(c[..., 0])
+    zero = np.zeros_like(c[..., 0])
+
+    Rx = np.stack([one, zero, zero,
+                   zero, c[..., 0], -s[..., 0],
+                   zero, s[..., 0], c[..., 0]], axis=-1).reshape(rpy.shape[:-1] + (3, 3))
+    Ry = np.stack([c[..., 1], zero, s[..., 1],
+                   zero, one, zero,
+                   -s[..., 1], zero, c[..., 1]], axis=-1).reshape(rpy.shape[:-1] + (3, 3))
+    Rz = np.stack([c[..., 2], -s[..., 2], zero,
+                   s[..., 2], c[..., 2], zero,
+                   zero, zero, one], axis=-1).reshape(rpy.shape[:-1] + (3, 3))
+
+    # Derivatives of each factor wrt its angle
+    dRx = np.stack([zero, zero, zero,
+                    zero, -s[..., 0], -c[..., 0],
+                    zero, c[..., 0], -s[..., 0]], axis=-1).reshape(rpy.shape[:-1] + (3, 3))
+    dRy = np.stack([-s[..., 1], zero, c[..., 1],
+                    zero, zero, zero,
+                    -c[..., 1], zero, -s[..., 1]], axis=-1).reshape(rpy.shape[:-1] + (3, 3))
+    dRz = np.stack([-s[..., 2], -c[..., 2], zero,
+                    c[..., 2], -s[..., 2], zero,
+                    zero, zero, zero], axis=-1).reshape(rpy.shape[:-1] + (3, 3))
+
+    return (Rx, Ry, Rz), (dRx, dRy, dRz)
+
+def rot_xyz(rpy):
+
+    '''
+    Rotation matrices R = Rz(yaw) Ry(pitch) Rx(roll)
+    rpy: (...,3) numpy array of [roll, pitch, yaw]
+    returns:
+        R: (...,3,3) numpy array
+    '''
+
+    (Rx, Ry, Rz), _ = _rot_factors(np.asarray(rpy, dtype=np.float64))
+    return Rz @ Ry @ Rx
+
+def motion_model(X, V, dt):
+
+    '''
+    Predicted states
+    returns:
+        X_t: (...,6) numpy array
+    '''
+
+    X = np.asarray(X, dtype=np.float64)
+    V = np.asarray(V, dtype=np.float64)
+    dt = np.asarray(dt, dtype=np.float64)[..., np.newaxis]
+
+    R = rot_xyz(X[..., 3:6])
+    p = X[..., 0:3] + (R @ V[..., 0:3, np.newaxis])[..., 0] * dt
+    rpy = X[..., 3:6] + V[..., 3:6] * dt
+
+    return np.concatenate((p, rpy), axis=-1)
+
+def motion_jacobian(X, V, dt):
+
+    '''
+    Jacobians of motion_model wrt the states
+    returns:
+        G: (...,6,6) numpy array
+    '''
+
+    X = np.asarray(X, dtype=np.float64)
+    V = np.asarray(V, dtype=np.float64)
+    dt = np.asarray(dt, dtype=np.float64)[..., np.newaxis]
+
+    (Rx, Ry, Rz), (dRx, dRy, dRz) = _rot_factors(X[..., 3:6])
+    v = V[..., 0:3, np.newaxis]
+
+    G = np.zeros(X.shape[:-1] + (6, 6))
+    G[..., :, :] = np.eye(6)
+    # d p_t / d [roll, pitch, yaw]
+    G[..., 0:3, 3] = (Rz @ Ry @ dRx @ v)[..., 0] * dt
+    G[..., 0:3, 4] = (Rz @ dRy @ Rx @ v)[..., 0] * dt
+    G[..., 0:3, 5] = (dRz @ Ry @ Rx @ v)[..., 0] * dt
+
+    return G
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+import numpy as np
+from barfoot_utils_np import vec2tran, transInv
+
+
+def sigmapoints_cov_batch(T, Cov, m, kappa=0.):
+
+    '''
+    Unscented transform of all the beams of a ping at once: the sigma points
+    of the compound covariance perturb the pose T (first 6 dims) and the
+    landmark m (last 3) and go through the 3D MBES measurement model
+    h = T Tsample^-1 msample, the beam in map frame.
+    The covariance is the same for all the beams, so it's factorized once,
+    and so are the transforms of the sigma points. Only the landmarks change
+    from beam to beam, which turns the model into one (B,2L+1,4) product.
+    T: (4,4) numpy array, map to mbes transform
+    Cov: (L,L) numpy array, compound covariance of pose and landmark
+    m: (B,4) numpy array of beams in map frame, homogeneous coordinates
+    kappa: weight of the central sigma point
+    returns:
+        ysp: (B,4) numpy array of sigma points means
+        yspcov: (B,4,4) numpy array of sigma points covariances
+    '''
+
+    L = Cov.shape[0]
+
+    # Make sure Cov remains positive-semidefinite
+    Cov = np.where(Cov>=0., Cov, 0.)
+    S = np.linalg.cholesky(Cov)
+    spoint = np.hstack((S, -S)) * np.sqrt(L+kappa)
+
+    # Pose part: T Tsample^-1 for each sigma point, shared by all the beams
+    E = np.stack([np.matmul(T, transInv(np.matmul(vec2tran(spoint[0:6,n]), T))) 
+                  for n in range(2*L)])
+    # Landmark part: perturbation of each sigma point, in homogeneous coordinates
+    dm = np.vstack((spoint[6:9], np.zeros((1, 2*L)))).T
+
+    # Measurement of every beam and sigma point, the first one unperturbed
+    y = np.empty((len(m), 2*L+1, 4))
+    y[:,0] = np.matmul(np.matmul(T, transInv(T)), m.T).T
+    y[:,1:] = np.einsum('sij,bsj->bsi', E, m[:,np.newaxis,:] + dm[np.newaxis])
+
+    # Sampled mean and covariance
+    w = np.full(2*L+1, 1/(2*(L+kappa)))
+    w[0] = kappa/(kappa+L)
+    ysp = np.einsum('s,bsi->bi', w, y)
+    d = y - ysp[:,np.newaxis,:]
+    yspcov = np.einsum('s,bsi,bsj->bij', w, d, d)
+
+    return ysp, yspcov
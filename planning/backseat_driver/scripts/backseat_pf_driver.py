@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
 import numpy as np
+import threading, queue
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 from nav_msgs.msg import Path
@@ -13,7 +15,6 @@ import tf2_ros
 from std_msgs.msg import Float64, Header, Bool
 import math
 from geometry_msgs.msg import Pose, PoseArray, PoseWithCovarianceStamped, Point
-import roslaunch
 
 # from tf.transformations import quaternion_from_euler, euler_from_quaternion
 from tf.transformations import translation_matrix, translation_from_matrix
@@ -21,6 +22,11 @@ from tf.transformations import quaternion_matrix, quaternion_from_matrix
 # from tf.transformations import rotation_matrix, rotation_from_matrix
 from scipy.spatial.transform import Rotation as rot
 
+from whatif_pf import WhatIfPF
+
+# States of the mission loop
+TRACKING, DECIDING, CLOSING_LOOP = range(3)
+
 class BackseatDriver(object):
 
     # create messages that are used to publish feedback/result
@@ -35,16 +41,24 @@ class BackseatDriver(object):
         self.path_topic = rospy.get_param('~path_topic')
         self.map_frame = rospy.get_param('~map_frame', 'map')
         self.base_frame = rospy.get_param('~base_frame', 'base_link')
+        self.mbes_frame = rospy.get_param('~mbes_link', 'mbes_link')
         self.odom_frame = rospy.get_param('~odom_frame', 'odom')
         self.avg_pose_top = rospy.get_param("~average_pose_topic", '/average_pose')
         self.cov_threshold = rospy.get_param("~cov_threshold", 50)
         self.wp_topic = rospy.get_param('~wp_topic')
         self.goal_tolerance = rospy.get_param('~goal_tolerance', 5.)
-        self.enable_pf_update_topic = rospy.get_param("~enable_pf_update_topic")
-        self.sim_pf_launch = rospy.get_param('~auv_pf_launch_file', "particle.launch") 
-        self.mission_launch = rospy.get_param('~mission_launch_file', "particle.launch") 
-        self.sim_path_topic = rospy.get_param('~sim_path_topic')
         self.relocalize_topic = rospy.get_param('~relocalize_topic')
+        # Restart a decision if the PF trace grows by this factor meanwhile
+        self.replan_ratio = rospy.get_param('~replan_ratio', 1.5)
+        # Localizability map built offline with gp_mapping/localizability.py.
+        # If given, its candidate cells replace the LC waypoints below
+        loc_map_path = rospy.get_param('~localizability_map', '')
+        self.revisit_pings = rospy.get_param('~revisit_pings', 50)
+        self.revisit_radius = rospy.get_param('~revisit_radius', 1000.)
+        self.loc_map = None
+        if loc_map_path:
+            from gp_mapping.localizability import LocalizabilityMap
+            self.loc_map = LocalizabilityMap(loc_map_path)
 
         self.listener = tf.TransformListener()
         
@@ -58,16 +72,23 @@ class BackseatDriver(object):
         rospy.Subscriber(self.path_topic, Path, self.path_cb, queue_size=1)
         self.latest_path = Path()
 
+        # Mission state machine, driven by the events of the PF callback
+        # and of the decision tasks
+        self.state = TRACKING
+        self.events = queue.Queue()
+        # Latest (pose, cov) of the PF, replaced as a whole by pf_cb
+        self.pf_state = None
+        self.trc = 0.
+        self.new_wp = PoseStamped()
+        # Revisit decision running in the background, cancellable
+        self.decider = ThreadPoolExecutor(max_workers=1)
+        self.decision = None
+        self.decision_trc = 0.
+        self.cancel_decision = threading.Event()
+
         # The PF filter state
         rospy.Subscriber(self.avg_pose_top, PoseWithCovarianceStamped,
                          self.pf_cb, queue_size=1)
-        self.closing_loop = False
-        self.new_wp = PoseStamped()
-
-        # The SIM PF filter state
-        rospy.Subscriber('/pf_sim/pf/avg_pose', PoseWithCovarianceStamped, self.sigma_k_cb)
-        self.e_mbes_pub = rospy.Publisher(self.enable_pf_update_topic, Bool, queue_size=1)
-        self.sim_path_pub = rospy.Publisher(self.sim_path_topic, Path, queue_size=1)
 
         # The LC waypoints, as a path
         self.lc_waypoints = Path()
@@ -99,54 +120,156 @@ class BackseatDriver(object):
             self.m2o_mat = matrix_from_tf(m2o_tf)
             rospy.loginfo("Got map to odom")
 
+            mbes_tf = tfBuffer.lookup_transform(self.base_frame, self.mbes_frame,
+                                                rospy.Time(0), rospy.Duration(35))
+            self.base2mbes_mat = matrix_from_tf(mbes_tf)
+            rospy.loginfo("Got base to mbes")
+
         except:
             rospy.loginfo("ERROR: Could not lookup transform from base_link to mbes_link")
         # rospy.spin()
 
-        self.trc = 0.
-        # This has to be in the main thread to be able to use roslaunch
+        # What-if PF for the LC waypoints, with the same settings as the real one
+        if self.loc_map is None:
+            cov_string = rospy.get_param('~motion_covariance')
+            motion_cov = list(map(float, cov_string.replace('[', '').replace(']', '').split(',')))
+            cov_string = rospy.get_param('~resampling_noise_covariance')
+            res_noise_cov = list(map(float, cov_string.replace('[', '').replace(']', '').split(',')))
+            config = {'mesh_path': rospy.get_param('~mesh_path'),
+                      'gp_meas_model': rospy.get_param('~gp_meas_model', False),
+                      'gp_path': rospy.get_param('~gp_path', 'gp.path'),
+                      'tile_map_path': rospy.get_param('~gp_tile_map', ''),
+                      'm2o_mat': self.m2o_mat,
+                      'base2mbes_mat': self.base2mbes_mat,
+                      'particle_count': rospy.get_param('~particle_count', 50),
+                      'beams_num': rospy.get_param('~num_beams_sim', 20),
+                      'mbes_angle': rospy.get_param('~mbes_open_angle', np.pi/180. * 60.),
+                      'meas_std': float(rospy.get_param('~measurement_std', 0.01)),
+                      'motion_cov': motion_cov,
+                      'res_noise_cov': res_noise_cov,
+                      'speed': rospy.get_param('~sim_speed', 2.),
+                      'ping_period': rospy.get_param('~sim_ping_period', 0.2),
+                      # How far from the revisit area activate the MBES of the sim filter
+                      'mbes_radius': self.goal_tolerance * 5.,
+                      'goal_tolerance': self.goal_tolerance}
+            self.whatif = WhatIfPF(config, rospy.get_param('~whatif_workers', 4))
+            rospy.on_shutdown(self.whatif.close)
+
+        self.run()
+
+    def run(self):
+        # Mission loop: sleeps until an event comes and handles it
         while not rospy.is_shutdown():
-
-            print("Current PF trace ", self.trc)
-            if self.trc > self.cov_threshold and not self.closing_loop:
-                # Pose uncertainty too high, closing the loop to relocalize
-                rospy.loginfo("Uncertainty over threshold. Looking for best revisit")
-
-                # Pause current mission after reaching current wp
-                self.pause_mission_pub.publish(True)
-
-                # Choose which WP to revisit
-                sigmas = []
-                gains = []
-                for wp in self.lc_waypoints.poses:
-                    # Run the simulated PF to that WP and compute expected uncertainty
-                    sigma_k = self.sim_sigma(wp)
-                    # Compute gain as inverse of distance to area
-                    gain_k = 1./self.calculate_gain(wp)    
-                    print("Sigma_k ", np.sum(np.diag(sigma_k)))            
-                    print("Gain_k ", gain_k)            
-                    sigmas.append(np.sum(np.diag(sigma_k)))
-                    gains.append(gain_k)
-
-                # Utility WP_k: normalize sigmas and gains and compute utilities
-                alpha = 0.5
-                sigmas /= np.max(sigmas)
-                gains /= np.max(gains)
-                u = (1-alpha)* np.asarray(gains) - alpha * np.asarray(sigmas)
-                print("Utilities ", u)
-
-                # Choose WP_k with max utility and send to mission planner
-                k = max(range(len(u)), key=u.__getitem__)
-                print("Chosen revisit area ", k)
-                self.new_wp = self.lc_waypoints.poses[k]
-                self.wp_pub.publish(self.new_wp)
-
-                # Let mission planner continue
+            try:
+                event, data = self.events.get(timeout=1.)
+            except queue.Empty:
+                continue
+            self.handle(event, data)
+
+        self.cancel()
+        self.decider.shutdown(wait=False)
+
+    def handle(self, event, data):
+        # Transitions of the state machine. The events are posted from other
+        # threads and may be stale, so each one is checked against the state
+
+        if event == 'cov_high' and self.state == TRACKING:
+            # Pose uncertainty too high, closing the loop to relocalize
+            rospy.loginfo("Uncertainty over threshold. Looking for best revisit")
+            # Pause current mission after reaching current wp
+            self.pause_mission_pub.publish(True)
+            self.state = DECIDING
+            self.start_decision()
+
+        elif event == 'cov_spike' and self.state == DECIDING:
+            rospy.loginfo("PF trace went up to %f while deciding, restarting", data)
+            self.cancel()
+            self.start_decision()
+
+        elif event == 'cov_low' and self.state == DECIDING:
+            rospy.loginfo("PF relocalized while deciding, resuming the mission")
+            self.cancel()
+            self.pause_mission_pub.publish(False)
+            self.state = TRACKING
+
+        elif event == 'decided' and self.state == DECIDING:
+            decision, wp = data
+            if decision is not self.decision:
+                return
+            self.decision = None
+            if wp is None:
+                # Failed decision, the next PF update over the threshold retries
                 self.pause_mission_pub.publish(False)
-                rospy.loginfo("Sent LC waypoint")
-                self.closing_loop = True
-            
-            rospy.Rate(1).sleep()
+                self.state = TRACKING
+                return
+            # Send to mission planner and let it continue
+            self.new_wp = wp
+            self.wp_pub.publish(self.new_wp)
+            self.pause_mission_pub.publish(False)
+            rospy.loginfo("Sent LC waypoint")
+            self.state = CLOSING_LOOP
+
+        elif event == 'loop_closed' and self.state == CLOSING_LOOP:
+            rospy.loginfo("Loop closed!")
+            self.state = TRACKING
+
+    def start_decision(self):
+        # Snapshot of the PF state the decision is made on
+        pf_pose, cov = self.pf_state
+        self.decision_trc = self.trc
+        self.cancel_decision = threading.Event()
+        self.decision = self.decider.submit(self.decide, pf_pose, cov,
+                                            self.cancel_decision)
+        self.decision.add_done_callback(self.decision_done)
+
+    def decision_done(self, decision):
+        if decision.cancelled():
+            return
+        try:
+            wp = decision.result()
+        except Exception as e:
+            rospy.logwarn("Revisit decision failed: %s", e)
+            wp = None
+        self.events.put(('decided', (decision, wp)))
+
+    def cancel(self):
+        if self.decision is not None:
+            self.cancel_decision.set()
+            self.decision.cancel()
+            self.decision = None
+
+    def decide(self, pf_pose, cov, cancel):
+
+        if self.loc_map is not None:
+            # Rank all the revisit cells of the survey area at once
+            return self.rank_revisit_cells(cov)
+
+        # Choose which WP to revisit.
+        # Run the simulated PF to all the WPs and compute expected uncertainty
+        sigmas_k = self.whatif_sigmas(self.lc_waypoints.poses, pf_pose, cov, cancel)
+        if sigmas_k is None:
+            return None
+        sigmas = []
+        gains = []
+        for k, wp in enumerate(self.lc_waypoints.poses):
+            # Compute gain as inverse of distance to area
+            gain_k = 1./self.calculate_gain(wp)
+            print("Sigma_k ", np.sum(np.diag(sigmas_k[k])))
+            print("Gain_k ", gain_k)
+            sigmas.append(np.sum(np.diag(sigmas_k[k])))
+            gains.append(gain_k)
+
+        # Utility WP_k: normalize sigmas and gains and compute utilities
+        alpha = 0.5
+        sigmas /= np.max(sigmas)
+        gains /= np.max(gains)
+        u = (1-alpha)* np.asarray(gains) - alpha * np.asarray(sigmas)
+        print("Utilities ", u)
+
+        # Choose WP_k with max utility
+        k = max(range(len(u)), key=u.__getitem__)
+        print("Chosen revisit area ", k)
+        return self.lc_waypoints.poses[k]
 
 
     def path_cb(self, path_msg):
@@ -157,108 +280,85 @@ class BackseatDriver(object):
 
     def pf_cb(self, pf_msg):
         # Reconstruct PF pose and covariance 
-        self.cov = np.zeros((6, 6))
+        cov = np.zeros((6, 6))
         for i in range(3):
             for j in range(3):
-                self.cov[i, j] = pf_msg.pose.covariance[i*3 + j]
-        self.pf_pose = pf_msg.pose.pose
+                cov[i, j] = pf_msg.pose.covariance[i*3 + j]
+        self.pf_state = (pf_msg.pose.pose, cov)
         
-        # Monitor trace. If too high, start revisit place selection in main thread
-        self.trc = np.sum(np.diag(self.cov))
+        # Monitor trace and post the events of the state machine
+        self.trc = np.sum(np.diag(cov))
         # print("Trace ", self.trc)
 
+        if self.state == TRACKING and self.trc > self.cov_threshold:
+            self.events.put(('cov_high', self.trc))
+
+        elif self.state == DECIDING:
+            # Keep tracking the PF while deciding
+            if self.trc < self.cov_threshold:
+                self.events.put(('cov_low', self.trc))
+            elif self.trc > self.replan_ratio * self.decision_trc:
+                self.decision_trc = self.trc
+                self.events.put(('cov_spike', self.trc))
+
         # Closing loop
-        if self.closing_loop:
+        elif self.state == CLOSING_LOOP:
             rospy.loginfo("Going for a loop closure!")
             dist = self.distance_wp_frame(self.new_wp, self.base_frame)
             rospy.loginfo("BS driver diff " + str(dist))
             # Stop loop closure when revisit area reached
             # or filter cov already under threshold
-            if dist < self.goal_tolerance or self.trc < self.cov_threshold:
+            if (dist is not None and dist < self.goal_tolerance) or self.trc < self.cov_threshold:
                 # Goal reached
-                rospy.loginfo("Loop closed!")
-                self.closing_loop = False
+                self.events.put(('loop_closed', self.trc))
+
+
+    def rank_revisit_cells(self, cov):
+
+        # Current position in the map frame
+        (trans, _) = self.listener.lookupTransform(self.map_frame, self.base_frame,
+                                                   rospy.Time(0))
+        cells = self.loc_map.query(np.array(trans[0:2]), self.revisit_radius)
+        if not len(cells):
+            cells = self.loc_map.candidates
+        rospy.loginfo("Ranking %d revisit cells", len(cells))
+
+        # Expected PF covariance after revisiting each cell, fusing the
+        # information of its pings with the current one
+        R = self.m2o_mat[0:2, 0:2]
+        cov = R.dot(cov[0:2, 0:2]).dot(R.T) + 1e-6 * np.eye(2)
+        info = np.linalg.inv(cov) + self.revisit_pings * self.loc_map.fisher(cells[:, 0:2])
+        sigmas = np.trace(np.linalg.inv(info), axis1=1, axis2=2)
+        # Gain as inverse of distance to area
+        gains = 1. / np.maximum(np.linalg.norm(cells[:, 0:2] - trans[0:2], axis=1),
+                                self.goal_tolerance)
+
+        # Utility of each cell: normalize sigmas and gains as for the LC waypoints
+        alpha = 0.5
+        u = (1-alpha) * gains / np.max(gains) - alpha * sigmas / np.max(sigmas)
+        k = np.argmax(u)
+        print("Chosen revisit cell ", cells[k], " sigma ", sigmas[k])
+
+        wp = PoseStamped()
+        wp.header.frame_id = self.map_frame
+        wp.pose.position.x = cells[k, 0]
+        wp.pose.position.y = cells[k, 1]
+        wp.pose.orientation.w = 1
+        return wp
+
+    def whatif_sigmas(self, wps, pf_pose, cov, cancel):
+
+        # PF state in the odom frame
+        quaternion = (pf_pose.orientation.x, pf_pose.orientation.y,
+                      pf_pose.orientation.z, pf_pose.orientation.w)
+        euler_odom = tf.transformations.euler_from_quaternion(quaternion)
+        pose = np.array([pf_pose.position.x, pf_pose.position.y,
+                         pf_pose.position.z] + list(euler_odom))
 
+        waypoints = np.array([[wp.pose.position.x, wp.pose.position.y,
+                               wp.pose.position.z] for wp in wps])
 
-    def sim_sigma(self, wp_k):
-        
-        # Launch simulation k with current state of the real PF
-        # Transform PF pose to map frame
-        quaternion = (self.pf_pose.orientation.x, self.pf_pose.orientation.y, 
-                        self.pf_pose.orientation.z, self.pf_pose.orientation.w)
-        euler_odom = tf.transformations.euler_from_quaternion(quaternion)
-        r_particle = rot.from_euler('xyz', euler_odom, degrees=False)
-        q_particle = quaternion_matrix(r_particle.as_quat())
-        t_particle = translation_matrix([self.pf_pose.position.x, self.pf_pose.position.y, self.pf_pose.position.z])
-        mat = np.dot(t_particle, q_particle)
-        pf_pose_map = self.m2o_mat.dot(mat)
-        # print(pf_pose_map)
-        euler_map = rot.from_matrix(pf_pose_map[0:3, 0:3]).as_euler('xyz')
-
-        cli_args = [self.sim_pf_launch ,'namespace:=pf_sim', 'x:=' + str(pf_pose_map[0,3]), 
-        'y:=' + str(pf_pose_map[1,3]), 'z:=' + str(pf_pose_map[2,3]), 
-        'roll:=' + str(euler_map[0]), 'pitch:=' + str(euler_map[1]),'yaw:=' + str(euler_map[2]),
-        'init_covariance:= ' + str([self.cov[0,0], self.cov[1,1],0.,0.,0.,self.cov[5,5]]), 
-        'enable_pf_update:=' + str(False)]
-        roslaunch_args = cli_args[1:]
-        roslaunch_file = [(roslaunch.rlutil.resolve_launch_arguments(cli_args)[0], roslaunch_args)]
-        uuid = roslaunch.rlutil.get_or_generate_uuid(None, False)
-        # roslaunch.configure_logging(uuid)
-        parent_pf = roslaunch.parent.ROSLaunchParent(uuid, roslaunch_file)
-        parent_pf.start()
-        rospy.loginfo("Sim PF launched")
-
-        # Launch simulation mission planner
-        cli_args = [self.mission_launch ,'namespace:=pf_sim', 'manual_control:=False',
-        'max_throttle:=' + str(8.0)]
-        roslaunch_args = cli_args[1:]
-        roslaunch_file = [(roslaunch.rlutil.resolve_launch_arguments(cli_args)[0], roslaunch_args)]
-        uuid = roslaunch.rlutil.get_or_generate_uuid(None, False)
-        # roslaunch.configure_logging(uuid)
-        parent_mp = roslaunch.parent.ROSLaunchParent(uuid, roslaunch_file)
-        parent_mp.start()
-        rospy.loginfo("Sim planner launched")
-        rospy.sleep(4)
-
-        # Send WP_k to sim w2w_mission_planner
-        sim_path = Path()
-        sim_path.poses.append(wp_k)
-        self.sim_path_pub.publish(sim_path)
-
-        # Wait for sim AUV PF to reach WP k
-        sim_finished = False
-        thres_eps = 5.0 # How far from the actual revisit area activate the MBES of the sim filter
-        while not rospy.is_shutdown() and not sim_finished:
-            # rospy.loginfo("Sim moving to WP!")
-            dist = self.distance_wp_frame(wp_k, 'pf_sim/base_link')
-
-            if dist < self.goal_tolerance*thres_eps:
-                if thres_eps != 5.0:
-                    # Goal reached. Finished simulation
-                    sim_finished = True
-                    # self.e_mbes_pub.publish(False)
-
-                rospy.loginfo("Sim has reached WP!")
-                # When wp_k reached, enable MBES pings and wait 
-                self.e_mbes_pub.publish(True)
-                thres_eps = 1.0
-                
-            rospy.Rate(5).sleep()
-
-        # When the PF has converged, store output and kill launch file
-        sigma_k = self.cov_k
-        print("Sim finished")
-        parent_pf.shutdown()
-        parent_mp.shutdown()
-
-        return sigma_k
-
-    def sigma_k_cb(self, sim_pf_msg):
-        # Reconstruct covariance 
-        self.cov_k = np.zeros((6, 6))
-        for i in range(3):
-            for j in range(3):
-                self.cov_k[i, j] = sim_pf_msg.pose.covariance[i*3 + j]
+        return self.whatif.evaluate(pose, cov, waypoints, cancel)
 
     def calculate_gain(self, wp_k):
 
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+# Faster than real time "what-if" particle filter for the revisit selection of
+# the backseat driver. The current PF state is cloned and rolled forward along a
+# straight line to each candidate waypoint, with the pings of the simulated AUV
+# raycast on the mesh and weighted with the same mesh/GP measurement models as
+# auv_pf_gp.py. The candidates run concurrently on a process pool whose workers
+# load the maps once. A cancelled evaluation bumps a shared generation counter,
+# which stops its simulations at their next step so they free the workers.
+
+import numpy as np
+import multiprocessing as mp
+from scipy.spatial.transform import Rotation as rot
+
+from auv_utils.likelihood import log_likelihood, normalize_log_weights
+from auv_utils.resampling import residual_resample, copy_map
+from auv_utils.raycaster import MeshRaycaster
+
+
+# Maps and settings of this worker process, set by _init_worker
+_worker = {}
+
+def _init_worker(config, generation):
+    # One core per worker, the pool parallelizes over the candidates
+    import torch
+    torch.set_num_threads(1)
+
+    # The pings of the simulated AUV always come from the mesh, like with auv_2_ros
+    data = np.load(config['mesh_path'] + "mesh.npz")
+    _worker['raycaster'] = MeshRaycaster(data['V'], data['F'])
+    data = None
+
+    _worker['gp'] = None
+    if config['gp_meas_model']:
+        if config['tile_map_path']:
+            from gp_mapping.tile_map import GPTileMap
+            _worker['gp'] = GPTileMap(config['tile_map_path'])
+        else:
+            from gp_mapping import gp
+            _worker['gp'] = gp.SVGP.load(1000, config['gp_path'])
+            _worker['gp'].cache_posterior()
+
+    _worker['config'] = config
+    _worker['generation'] = generation
+
+def _cancelled(job):
+    # The evaluation of the job has been cancelled since it was submitted
+    return _worker['generation'].value != job['generation']
+
+def _mbes_poses(poses, m2o_mat, base2mbes_mat):
+    # MBES poses in the map frame of (N,6) odom poses, as ParticleSet.get_p_mbes_pose
+    mat = np.tile(np.eye(4), (len(poses), 1, 1))
+    mat[:, 0:3, 0:3] = rot.from_euler('xyz', poses[:, 3:6]).as_matrix()
+    mat[:, 0:3, 3] = poses[:, 0:3]
+    trans_mat = np.matmul(m2o_mat, np.matmul(mat, base2mbes_mat))
+    return trans_mat[:, 0:3, 3], trans_mat[:, 0:3, 0:3]
+
+def _update(particles, auv, config):
+    # Log-weights of the particles given the ping of the simulated AUV,
+    # None if the AUV is out of the mesh
+    raycaster = _worker['raycaster']
+    m2o, b2m = config['m2o_mat'], config['base2mbes_mat']
+
+    p_auv, r_auv = _mbes_poses(auv[np.newaxis], m2o, b2m)
+    hits = raycaster.project_mbes(p_auv, r_auv, config['beams_num'],
+                                  config['mbes_angle'])[0, ::-1]
+    if np.isnan(hits).any():
+        return None
+    real_ranges = hits[:, 2] + config['meas_std'] * np.random.randn(len(hits))
+
+    p_part, r_mbes = _mbes_poses(particles, m2o, b2m)
+    if _worker['gp'] is None:
+        exp_mbes = raycaster.project_mbes(p_part, r_mbes, config['beams_num'],
+                                          config['mbes_angle'])[:, ::-1]
+        return log_likelihood(exp_mbes[:, :, 2], real_ranges,
+                              2. * config['meas_std']**2)
+
+    # Ping in the frame the GP meas model expects, so that the true pose
+    # maps it back onto the hits
+    R = b2m.transpose()[0:3, 0:3]
+    ping = np.matmul(hits - p_auv, np.matmul(r_auv[0], R))
+    r_base = np.matmul(r_mbes, R)
+    points = np.einsum('nij,bj->nbi', r_base, ping) + p_part[:, np.newaxis, :]
+    mu, sigma = _worker['gp'].sample(points.reshape(-1, 3)[:, 0:2])
+    return log_likelihood(mu.reshape(len(particles), -1), real_ranges,
+                          config['meas_std']**2 + sigma.reshape(len(particles), -1))
+
+def _simulate(job):
+    '''
+    Runs the what-if PF of one candidate
+    job: dict with the PF pose (6,) and covariance (6,6) in the odom frame,
+         the waypoint (3,) in the odom frame, a random seed and the generation
+         of the evaluation
+    returns:
+        cov: (6,6) numpy array, covariance of the particles at the waypoint,
+             None if the evaluation was cancelled
+    '''
+    config = _worker['config']
+    if _cancelled(job):
+        return None
+    np.random.seed(job['seed'])
+    p_num = config['particle_count']
+
+    # The true AUV starts at the PF mean and the particles are drawn around it
+    auv = np.array(job['pose'], dtype=np.float64)
+    particles = auv + np.random.multivariate_normal(np.zeros(6), job['cov'], p_num,
+                                                    check_valid='ignore')
+
+    # Heading to the waypoint, the particles turn as their compass tells them
+    wp = np.asarray(job['wp'])
+    dyaw = np.arctan2(wp[1] - auv[1], wp[0] - auv[0]) - auv[5]
+    auv[5] += dyaw
+    particles[:, 5] += dyaw
+
+    step = config['speed'] * config['ping_period']
+    motion_std = np.sqrt(np.asarray(config['motion_cov']))
+    res_noise_std = np.sqrt(np.asarray(config['res_noise_cov']))
+    dist = np.linalg.norm(wp[0:2] - auv[0:2])
+    n_steps = int(np.ceil(dist / step))
+    for _ in range(n_steps):
+        if _cancelled(job):
+            return None
+        # Straight line at constant speed, the depth is read as in the PF
+        auv[0:2] += step * np.array([np.cos(auv[5]), np.sin(auv[5])])
+        noise = motion_std * np.random.randn(p_num, 6)
+        particles[:, 3:6] = (particles[:, 3:6] + noise[:, 3:6] + np.pi) % (2 * np.pi) - np.pi
+        rot_mat = rot.from_euler('xyz', particles[:, 3:6]).as_matrix()
+        particles[:, 0:2] += (rot_mat[:, 0:2, 0] * step + noise[:, 0:2])
+        particles[:, 2] = auv[2]
+
+        # MBES updates only close to the revisit area
+        dist = np.linalg.norm(wp[0:2] - auv[0:2])
+        if dist > config['mbes_radius']:
+            continue
+        log_weights = _update(particles, auv, config)
+        if log_weights is not None:
+            weights, log_norm = normalize_log_weights(log_weights)
+            miss_meas = np.count_nonzero(np.isneginf(log_weights))
+            n_eff = p_num if np.isneginf(log_norm) else 1. / np.sum(np.square(weights))
+            if n_eff < p_num / 2. and miss_meas < p_num / 2.:
+                lost, dupes = copy_map(residual_resample(weights))
+                particles[lost] = particles[dupes]
+                particles += res_noise_std * np.random.randn(p_num, 6)
+
+        if dist < config['goal_tolerance']:
+            break
+
+    # Positional covariance, as published by the PF
+    cov = np.zeros((6, 6))
+    cov[0:3, 0:3] = np.cov(particles[:, 0:3], rowvar=False, bias=True)
+    return cov
+
+
+class WhatIfPF(object):
+
+    '''
+    Pool of processes simulating the PF to candidate revisit waypoints.
+    config: dict with
+        mesh_path: folder of the mesh.npz of the survey area
+        gp_meas_model: weight the particles with the GP instead of the mesh
+        gp_path, tile_map_path: GP map, as in auv_pf_gp.py
+        m2o_mat: (4,4) map to odom transform
+        base2mbes_mat: (4,4) base_link to mbes_link transform
+        particle_count, beams_num, mbes_angle, meas_std: as in the PF
+        motion_cov, res_noise_cov: (6,) diagonal covariances, as in the PF
+        speed: AUV speed [m/s]
+        ping_period: time between pings [s]
+        mbes_radius: distance to the waypoint at which the pings start [m]
+        goal_tolerance: distance at which the waypoint is reached [m]
+    n_workers: number of processes, one core each
+    '''
+
+    def __init__(self, config, n_workers=4):
+        # forkserver: the workers don't inherit the node's threads
+        ctx = mp.get_context('forkserver')
+        self.generation = ctx.Value('i', 0)
+        self.pool = ctx.Pool(n_workers, initializer=_init_worker,
+                             initargs=(config, self.generation))
+        self.m2o_mat = config['m2o_mat']
+
+    def evaluate(self, pose, cov, waypoints, cancel=None):
+
+        '''
+        Expected covariance of the PF at each of the waypoints
+        pose: (6,) numpy array, PF mean [x, y, z, roll, pitch, yaw] in the odom frame
+        cov: (6,6) numpy array, PF covariance
+        waypoints: (K,3) numpy array of waypoints in the map frame
+        cancel: optional threading.Event to stop the simulations
+        returns:
+            covs: list of K (6,6) numpy arrays, None if cancelled
+        '''
+
+        # Waypoints to the odom frame, where the particles live
+        wps = np.column_stack((np.asarray(waypoints).reshape(-1, 3),
+                               np.ones(len(waypoints))))
+        wps = np.linalg.solve(self.m2o_mat, wps.T).T[:, 0:3]
+
+        seeds = np.random.randint(0, 2**31 - 1, len(wps))
+        generation = self.generation.value
+        jobs = [{'pose': pose, 'cov': cov, 'wp': wp, 'seed': seed,
+                 'generation': generation}
+                for wp, seed in zip(wps, seeds)]
+
+        result = self.pool.map_async(_simulate, jobs)
+        while not result.ready():
+            if cancel is not None and cancel.is_set():
+                self.cancel()
+                return None
+            result.wait(0.1)
+        covs = result.get()
+        return None if any(c is None for c in covs) else covs
+
+    def cancel(self):
+        # Stops the simulations submitted so far
+        with self.generation.get_lock():
+            self.generation.value += 1
+
+    def close(self):
+        self.pool.terminate()
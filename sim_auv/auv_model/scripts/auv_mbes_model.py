@@ -10,9 +10,7 @@ import numpy as np
 from tf.transformations import quaternion_matrix
 from tf.transformations import rotation_matrix
 
-from sensor_msgs.msg import PointCloud2, PointField
-from std_msgs.msg import Header
-from sensor_msgs import point_cloud2
+from auv_utils.ping_codec import encode_cloud
 from scipy.ndimage import gaussian_filter1d
 
 # For sim mbes action client
@@ -94,27 +92,12 @@ class mbes_model(object):
 
 
         # Pack result
-        mbes_cloud = self.pack_cloud(self.mbes_frame, mbes)
+        mbes_cloud = encode_cloud(self.mbes_frame, mbes)
         result = MbesSimResult()
         result.sim_mbes = mbes_cloud
         self.as_ping.set_succeeded(result)
 
 
-    # Create PointCloud2 msg out of ping
-    def pack_cloud(self, frame, mbes):
-        mbes_pcloud = PointCloud2()
-        header = Header()
-        header.stamp = rospy.Time.now()
-        header.frame_id = frame
-        fields = [PointField('x', 0, PointField.FLOAT32, 1),
-                PointField('y', 4, PointField.FLOAT32, 1),
-                PointField('z', 8, PointField.FLOAT32, 1)]
-
-        mbes_pcloud = point_cloud2.create_cloud(header, fields, mbes)
-
-        return mbes_pcloud
-
-
 if __name__ == '__main__':
 
     rospy.init_node('auv_mbes_model', disable_signals=False)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+# Process pool backend for the particle maps of the RBPF.
+# The ping history lives in shared memory and the particles' trajectories are
+# written to a shared block per training round, so the fit jobs only carry the
+# GP parameters and a few indices. The workers are stateless: the particle maps
+# stay in the RBPF node and travel as state dicts. The weights are computed in
+# the node, with the batched GP of all the trained maps (rbpf_slam.batch_maps).
+
+import threading
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import torch
+
+from gp_mapping import gp
+
+
+# Growable (T,...) history like rbpf_particle.ArrayHistory, backed by shared memory
+# so that the workers can read it without copies. The block is replaced when full,
+# the jobs carry the name of the current one. The blocks replaced while a round of
+# jobs is in flight (hold/release) are only unlinked once it has finished
+class SharedArrayHistory(object):
+    def __init__(self, shape, capacity=1000):
+        self.shape = tuple(shape)
+        self.size = 0
+        self.lock = threading.Lock()
+        self.holds = 0
+        self.retired = []
+        self._alloc(capacity)
+
+    def _alloc(self, capacity):
+        shm = shared_memory.SharedMemory(create=True,
+                                         size=8 * capacity * int(np.prod(self.shape)))
+        data = np.ndarray((capacity,) + self.shape, dtype=np.float64, buffer=shm.buf)
+        if self.size:
+            data[:self.size] = self.data[:self.size]
+            self.data = None
+            self.retired.append(self.shm)
+            if not self.holds:
+                self._unlink_retired()
+        self.shm = shm
+        self.data = data
+
+    def _unlink_retired(self):
+        for shm in self.retired:
+            shm.close()
+            shm.unlink()
+        self.retired = []
+
+    def append(self, x):
+        with self.lock:
+            if self.size == len(self.data):
+                self._alloc(2 * len(self.data))
+            self.data[self.size] = x
+            self.size += 1
+
+    def array(self):
+        return self.data[:self.size]
+
+    def hold(self):
+        # Handle of the current block, kept alive until release()
+        with self.lock:
+            self.holds += 1
+            return (self.shm.name, self.data.shape)
+
+    def release(self):
+        with self.lock:
+            self.holds -= 1
+            if not self.holds:
+                self._unlink_retired()
+
+    def close(self):
+        with self.lock:
+            self.data = None
+            self.retired.append(self.shm)
+            self._unlink_retired()
+
+    def __len__(self):
+        return self.size
+
+
+# Shared memory blocks attached by this worker process, by name
+_attached = {}
+
+def _attach(*handles):
+    # Views of the blocks of a job. The ones of previous jobs, which may have
+    # been replaced or unlinked since, are detached
+    names = [h[0] for h in handles]
+    for name in [n for n in _attached if n not in names]:
+        _attached.pop(name).close()
+    views = []
+    for name, shape in handles:
+        if name not in _attached:
+            _attached[name] = shared_memory.SharedMemory(name=name)
+        views.append(np.ndarray(shape, dtype=np.float64, buffer=_attached[name].buf))
+    return views
+
+def _init_worker():
+    # One core per worker, the pool parallelizes over the particles
+    torch.set_num_threads(1)
+
+def _load_gp(n_inducing, state):
+    svgp = gp.SVGP(n_inducing)
+    if state is not None:
+        svgp.load_state_dict({k: torch.from_numpy(v) for k, v in state.items()})
+    return svgp
+
+def _dump_gp(svgp):
+    return {k: v.detach().cpu().numpy() for k, v in svgp.state_dict().items()}
+
+def _fit_job(job):
+    # Transform the pings [start, end) with the particle trajectory and train its GP
+    pings, poses = _attach(job['pings'], job['poses'])
+    pings = pings[job['start']:job['end']]
+    poses = poses[job['offset']:job['offset'] + len(pings)]
+    p_part = poses[:, 0:3]
+    r_base = np.matmul(poses[:, 3:12].reshape(-1, 3, 3), job['R'])
+    points = (np.einsum('tij,tbj->tbi', r_base, pings) + p_part[:, np.newaxis, :]).reshape(-1, 3)
+
+    train = np.vstack((points, job['replay']))
+    svgp = _load_gp(job['n_inducing'], job['state'])
+    svgp.fit(train[:, 0:2], train[:, 2], warm_start=job['start'] > 0, **job['fit_args'])
+
+    return job['particle'], _dump_gp(svgp), points
+
+
+class MapWorkerPool(object):
+
+    '''
+    Pool of processes training the particles' GP maps in parallel.
+    n_workers: number of processes, one core each
+    n_beams: beams per ping of the history
+    '''
+
+    def __init__(self, n_workers, n_beams):
+        # forkserver: the workers don't inherit the node's threads or torch state
+        self.pool = mp.get_context('forkserver').Pool(n_workers, initializer=_init_worker)
+        self.mbes_history = SharedArrayHistory((n_beams, 3))
+
+    def fit(self, maps, trajectories, starts, R, replays, fit_args):
+
+        '''
+        Trains the maps on the pings from starts[i] on, transformed with the
+        trajectories, plus the replay points. Each map uses as many pings as
+        its trajectory has poses, the history may have grown since. The maps
+        are updated in place, the ones trained from a start > 0 are warm-started.
+        maps: list of ParticleMap
+        trajectories: list of (positions (T_i,3), orientations (T_i,3,3)) from starts[i]
+        starts: first ping of each trajectory
+        R: base to mbes rotation
+        replays: list of (n_i,3) numpy arrays of points already in the maps
+        fit_args: arguments of SVGP.fit
+        returns:
+            points: list of the new map points of each map
+        '''
+
+        lengths = [len(t[0]) for t in trajectories]
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+
+        # Trajectories of all the particles for this round in one shared block
+        shm = shared_memory.SharedMemory(create=True, size=8 * 12 * max(offsets[-1], 1))
+        poses = np.ndarray((max(offsets[-1], 1), 12), dtype=np.float64, buffer=shm.buf)
+        for i, (pos, rots) in enumerate(trajectories):
+            poses[offsets[i]:offsets[i+1], 0:3] = pos
+            poses[offsets[i]:offsets[i+1], 3:12] = rots.reshape(-1, 9)
+
+        pings = self.mbes_history.hold()
+        jobs = [{'particle': i, 'pings': pings,
+                 'poses': (shm.name, poses.shape), 'offset': offsets[i],
+                 'start': starts[i], 'end': starts[i] + lengths[i], 'R': R,
+                 'replay': replays[i],
+                 'n_inducing': maps[i].gp.m,
+                 'state': _dump_gp(maps[i].gp) if maps[i].gp_trained else None,
+                 'fit_args': fit_args} for i in range(len(maps))]
+
+        points = [None] * len(maps)
+        try:
+            for i, state, new_points in self.pool.imap_unordered(_fit_job, jobs):
+                maps[i].gp.load_state_dict({k: torch.from_numpy(v) for k, v in state.items()})
+                points[i] = new_points
+        finally:
+            poses = None
+            shm.close()
+            shm.unlink()
+            self.mbes_history.release()
+
+        return points
+
+    def close(self):
+        self.pool.terminate()
+        self.mbes_history.close()
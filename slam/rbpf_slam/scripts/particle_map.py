@@ -2,7 +2,7 @@
 import rospy
 from bathy_gps.gp import SVGP # GP
 from sensor_msgs.msg import PointCloud2
-import sensor_msgs.point_cloud2 as pc2
+from auv_utils.ping_codec import decode_cloud
 
 from slam_msgs.msg import PlotPosteriorResult, PlotPosteriorAction
 from slam_msgs.msg import SamplePosteriorResult, SamplePosteriorAction
@@ -46,13 +46,7 @@ class particle_map(object):
 
     def sample_posterior(self, goal):
 
-        beams = []
-        for p in pc2.read_points(goal.ping, 
-                                field_names = ("x", "y", "z"), skip_nans=True):
-            beams.append(p)
-
-        beams = np.asarray(beams)
-        beams = np.reshape(beams, (-1,3)) 
+        beams = decode_cloud(goal.ping)
 
         while self.training:
             rospy.Rate(1).sleep()
@@ -75,13 +69,7 @@ class particle_map(object):
             rospy.Rate(1).sleep()
             print("GP ", self.particle_number, " waiting for training before plotting")
 
-        beams = []
-        for p in pc2.read_points(goal.pings, 
-                                field_names = ("x", "y", "z"), skip_nans=True):
-            beams.append(p)
-
-        beams = np.asarray(beams)
-        beams = np.reshape(beams, (-1,3)) 
+        beams = decode_cloud(goal.pings)
 
         # Plot posterior and save it to image
         print("Plotting GP ", self.particle_number)
@@ -104,13 +92,7 @@ class particle_map(object):
         # If plotting, the mission has ended
         if not self.plotting:
             
-            beams = []
-            for p in pc2.read_points(pings_msg, 
-                                    field_names = ("x", "y", "z"), skip_nans=True):
-                beams.append(p)
-
-            beams = np.asarray(beams)
-            beams = np.reshape(beams, (-1,3))  
+            beams = decode_cloud(pings_msg)
 
             print("Training GP ", self.particle_number)
             self.training = True
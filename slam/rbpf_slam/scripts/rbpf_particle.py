@@ -4,7 +4,6 @@
 import math
 import rospy
 import numpy as np
-from scipy.stats import multivariate_normal
 from scipy.ndimage.filters import gaussian_filter
 from scipy.spatial.transform import Rotation as rot
 from scipy.ndimage import gaussian_filter1d
@@ -17,19 +16,122 @@ from tf.transformations import translation_matrix, translation_from_matrix
 from tf.transformations import quaternion_matrix, quaternion_from_matrix
 # from tf.transformations import rotation_matrix, rotation_from_matrix
 
-from sensor_msgs.msg import PointCloud2
-import sensor_msgs.point_cloud2 as pc2
-
-from sensor_msgs.msg import PointCloud2, PointField
-from std_msgs.msg import Header
-from sensor_msgs import point_cloud2
 from gp_mapping import gp  # GP
 
 
+# Growable stack of arrays of the same shape (e.g. one per ping), preallocated 
+# with a capacity that doubles when full. array() is a view of the filled part
+class ArrayHistory(object):
+    def __init__(self, shape, capacity=1000):
+        self.data = np.empty((capacity,) + tuple(shape))
+        self.size = 0
+
+    def append(self, x):
+        if self.size == len(self.data):
+            self.data = np.concatenate((self.data, np.empty_like(self.data)))
+        self.data[self.size] = x
+        self.size += 1
+
+    def prepend(self, x):
+        self.data = np.concatenate((x, self.array(), 
+                                    np.empty((max(len(x), 1),) + self.data.shape[1:])))
+        self.size += len(x)
+
+    def array(self):
+        return self.data[:self.size]
+
+    def __len__(self):
+        return self.size
+
+
+class atree(): # ancestry tree
+    # A node holds the segment of trajectory (poses at each ping, from ping start on)
+    # shared by all the particles descending from it. Particles point to leaves and
+    # only append to their own leaf, resampling branches the tree instead of copying.
+    # Internal nodes always have 2+ children: dead branches are pruned and single
+    # children absorb their parent's segment
+    def __init__(self, ID, parent, start):
+        self.ID = ID
+        self.parent = parent
+        self.start = start
+        self.positions = ArrayHistory((3,), capacity=100)
+        self.rotations = ArrayHistory((3, 3), capacity=100)
+        self.children = []
+        if parent is not None:
+            parent.children.append(self)
+
+    def end(self):
+        return self.start + len(self.positions)
+
+    def lineage(self):
+        # Nodes from the root down to this one
+        nodes = []
+        node = self
+        while node is not None:
+            nodes.append(node)
+            node = node.parent
+        return nodes[::-1]
+
+    def trajectory(self, start=0):
+        # Positions (T,3) and orientations (T,3,3) of the lineage from ping start on
+        nodes = [n for n in self.lineage() if n.end() > start]
+        pos = [n.positions.array()[max(start - n.start, 0):] for n in nodes]
+        rots = [n.rotations.array()[max(start - n.start, 0):] for n in nodes]
+        if len(nodes) == 1:
+            return pos[0], rots[0]
+        return (np.concatenate(pos) if pos else np.zeros((0, 3)), 
+                np.concatenate(rots) if rots else np.zeros((0, 3, 3)))
+
+    def branch(self, ID):
+        return atree(ID, self, self.end())
+
+    def prune(self):
+        # Called on a leaf no particle points to anymore
+        node = self
+        while node.parent is not None and not node.children:
+            parent = node.parent
+            parent.children.remove(node)
+            node.parent = None
+            node = parent
+
+        # Merge a node left with a single child into it
+        if len(node.children) == 1:
+            child = node.children[0]
+            child.positions.prepend(node.positions.array())
+            child.rotations.prepend(node.rotations.array())
+            child.start = node.start
+            child.parent = node.parent
+            if node.parent is not None:
+                siblings = node.parent.children
+                siblings[siblings.index(node)] = child
+            node.parent = None
+            node.children = []
+
+
+# GP map of a particle with the map points it has been trained on. Shared by the
+# particles of the same lineage after resampling, copied before being retrained
+class ParticleMap(object):
+    def __init__(self):
+        self.gp = gp.SVGP(50)
+        # Pings already transformed to the map frame with the particle's trajectory
+        # and number of pings they come from (for incremental map training)
+        self.map_points = np.zeros((0, 3))
+        self.pings_mapped = 0
+        self.gp_trained = False
+
+    def copy(self):
+        new_map = ParticleMap()
+        new_map.gp.load_state_dict(self.gp.state_dict())
+        new_map.map_points = self.map_points
+        new_map.pings_mapped = self.pings_mapped
+        new_map.gp_trained = self.gp_trained
+        return new_map
+
+
 class Particle(object):
     def __init__(self, beams_num, p_num, index, mbes_tf_matrix, m2o_matrix,
                  init_cov=[0.,0.,0.,0.,0.,0.], meas_std=0.01,
-                 process_cov=[0.,0.,0.,0.,0.,0.]):
+                 process_cov=[0.,0.,0.,0.,0.,0.], p_map=None, node=None):
 
         self.p_num = p_num
         self.index = index
@@ -60,8 +162,10 @@ class Particle(object):
         self.ctr = 0
 
         # Nacho
-        self.gp = gp.SVGP(50)
-        self.pose_history = []
+        self.map = ParticleMap() if p_map is None else p_map
+        # Leaf of the ancestry tree with the latest segment of the particle trajectory:
+        # positions and base_link orientations in the map frame at each ping
+        self.node = atree(index, None, 0) if node is None else node
 
 
     def add_noise(self, noise):
@@ -99,83 +203,16 @@ class Particle(object):
         # Seems to be a problem when integrating depth from Ping vessel, so we just read it
         self.p_pose[2] = odom_t.pose.pose.position.z
 
-    def compute_weight(self, exp_mbes, real_mbes):
-        # Compare only absolute z values of real and expected measurements 
-        exp_mbes_z = self.list2ranges(exp_mbes)
-        #  exp_mbes_ranges = gaussian_filter1d(exp_mbes_ranges , sigma=10)
-        #  real_mbes_ranges = gaussian_filter1d(real_mbes_ranges , sigma=10)
-        
-        if len(exp_mbes_z) > 0:
-            # Update particle weights
-            self.w = self.weight_mv(real_mbes, exp_mbes_z)
-            #  self.w = self.weight_avg(real_mbes_ranges, exp_mbes_ranges)
-            #  self.w = self.weight_grad(real_mbes_ranges, exp_mbes_ranges)
-        else:
-            self.w = 1.e-50 #0.0
-            rospy.logwarn("Range of exp meas equals zero")
-    
-
-    # def weight_gps(self, mbes_meas_ranges, mbes_sim_ranges, real_mbes_GP_pred):
-    #     if len(mbes_meas_ranges) == len(mbes_sim_ranges): # Double safety check
-
-    #         # time_start = time.time()
-
-    #         # Run gpytorch regression on sim data
-    #         print("\nTraining GP on particle: ", self.index)
-    #         observed_pred_sim = mbes_gpytorch_regression(mbes_sim_ranges)
-    #         # print("\nsim train time (s): ", time.time() - train_sim_start, "\n")
-
-    #         # Calculate KL divergence
-    #         kl_div = KLgp_div(real_mbes_GP_pred, observed_pred_sim)
-    #         w_i = 1. / kl_div
-
-    #         # print("\nTotal weight time (s): ", time.time() - time_start, "\n")
-    #         print('kl_div:    {}'.format(kl_div, precision=3))
-    #         print('gp weight: {}'.format(w_i, precision=3))
-    #     else:
-    #         rospy.logwarn("missing pings!")
-    #         w_i = 1.e-50
-
-    #     return w_i
-
-    def weight_grad(self, mbes_meas_ranges, mbes_sim_ranges ):
-        if len(mbes_meas_ranges) == len(mbes_sim_ranges):
-            grad_meas = np.gradient(mbes_meas_ranges)
-            grad_expected = np.gradient(mbes_sim_ranges)
-            w_i = multivariate_normal.pdf(grad_expected, mean=grad_meas,
-                                          cov=self.meas_cov)
-        else:
-            rospy.logwarn("missing pings!")
-            w_i = 0.0
-        return w_i
-        
-    def weight_mv(self, mbes_meas_ranges, mbes_sim_ranges ):
-        if len(mbes_meas_ranges) == len(mbes_sim_ranges):
-            w_i = multivariate_normal.pdf(mbes_sim_ranges, mean=mbes_meas_ranges,
-                                          cov=self.meas_cov)
-        else:
-            rospy.logwarn("missing pings!")
-            w_i = 1.e-50 #0.0
-        return w_i
-      
-    def weight_avg(self, mbes_meas_ranges, mbes_sim_ranges ):
-        if len(mbes_meas_ranges) == len(mbes_sim_ranges):
-            #  w_i = 1./self.p_num
-            #  for i in range(len(mbes_sim_ranges)):
-            w_i = math.exp(-(((mbes_sim_ranges
-                               - mbes_meas_ranges)**2).mean())/(2*self.meas_cov[0,0]))
-        else:
-            rospy.logwarn("missing pings!")
-            #  w_i = 1./self.p_num
-            w_i = 0.0
-        return w_i
-
     def update_pose_history(self):
         # For particle i, get its all its trajectory in the map frame
         R = self.mbes_tf_mat.transpose()[0:3,0:3]
         p_part, r_mbes = self.get_p_mbes_pose()
         r_base = r_mbes.dot(R) # The GP sampling uses the base_link orientation 
-        self.pose_history.append((p_part, r_base))
+        self.node.positions.append(p_part)
+        self.node.rotations.append(r_base)
+
+    def trajectory(self, start=0):
+        return self.node.trajectory(start)
     
     def get_p_mbes_pose(self):
         # Find particle's mbes_frame pose in the map frame 
@@ -190,46 +227,6 @@ class Particle(object):
         
         return (self.p, self.R)
 
-    # Extract the z coordinate from exp pings (in map frame)
-    def list2ranges(self, points):
-        ranges = []
-        for p in points:
-            ranges.append(p[2])
-
-        return np.asarray(ranges)
-
-    
-# Extract the z coordinate from real pings (in map frame)
-def pcloud2ranges(point_cloud, p_map_mbes_z):
-    ranges = []
-    for p in pc2.read_points(point_cloud, 
-                             field_names = ("x", "y", "z"), skip_nans=True):
-        ranges.append(p_map_mbes_z + p[2])
-
-    return np.asarray(ranges)
-
-def pcloud2ranges_full(point_cloud):
-    ranges = []
-    for p in pc2.read_points(point_cloud, 
-                             field_names = ("x", "y", "z"), skip_nans=True):
-        ranges.append(p)
-
-    return np.asarray(ranges)
-
-# Create PointCloud2 msg out of ping    
-def pack_cloud(frame, mbes):
-    mbes_pcloud = PointCloud2()
-    header = Header()
-    header.stamp = rospy.Time.now()
-    header.frame_id = frame
-    fields = [PointField('x', 0, PointField.FLOAT32, 1),
-              PointField('y', 4, PointField.FLOAT32, 1),
-              PointField('z', 8, PointField.FLOAT32, 1)]
-
-    mbes_pcloud = point_cloud2.create_cloud(header, fields, mbes)
-
-    return mbes_pcloud 
-
 def matrix_from_pose(pose):
     trans = np.array([pose.position.x, 
              pose.position.y,
@@ -8,6 +8,7 @@ from numpy.core.fromnumeric import shape
 import rospy
 import random
 import sys
+import threading
 import numpy as np
 import tf2_ros
 from scipy.spatial.transform import Rotation as rot
@@ -27,14 +28,18 @@ from tf.transformations import quaternion_matrix, quaternion_from_matrix
 from tf.transformations import rotation_matrix, rotation_from_matrix
 
 from sensor_msgs.msg import PointCloud2, PointField
-import sensor_msgs.point_cloud2 as pc2
 from cv_bridge import CvBridge
 
 # For sim mbes action client
 import actionlib
 from auv_2_ros.msg import MbesSimGoal, MbesSimAction, MbesSimResult
-from rbpf_particle import Particle, matrix_from_tf, pcloud2ranges, pack_cloud, pcloud2ranges_full, matrix_from_pose
-from resampling import residual_resample, naive_resample, systematic_resample, stratified_resample
+from rbpf_particle import Particle, ParticleMap, ArrayHistory, matrix_from_tf, matrix_from_pose
+from map_workers import MapWorkerPool
+from gp_mapping.gp import BatchSVGP
+from collections import Counter
+from auv_utils.ping_codec import decode_cloud, encode_cloud
+from auv_utils.likelihood import log_likelihood, normalize_log_weights
+from auv_utils.resampling import residual_resample, systematic_resample, stratified_resample, copy_map
 
 # Auvlib
 from auvlib.bathy_maps import base_draper
@@ -46,20 +51,9 @@ from scipy.ndimage.filters import gaussian_filter
 
 from rospy.numpy_msg import numpy_msg
 
-# For large numbers 
-from mpmath import mpf
-
 from slam_msgs.msg import PlotPosteriorGoal, PlotPosteriorAction
 from slam_msgs.msg import SamplePosteriorGoal, SamplePosteriorAction
 
-class atree(): # ancestry tree
-    def __init__(self, ID, parent, trajectory, observations):
-        self.ID = ID
-        self.parent = parent
-        self.trajectory = trajectory
-        self.observations = observations
-        self.children = []
-
 class rbpf_slam(object):
 
     def __init__(self):
@@ -81,6 +75,7 @@ class rbpf_slam(object):
         
         # Read covariance values
         meas_std = float(rospy.get_param('~measurement_std', 0.01))
+        self.meas_std = meas_std
         cov_string = rospy.get_param('~motion_covariance')
         cov_string = cov_string.replace('[','')
         cov_string = cov_string.replace(']','')
@@ -103,7 +98,26 @@ class rbpf_slam(object):
         self.pred_odom = None
         self.n_eff_filt = 0.
         self.n_eff_mask = [self.pc]*3
-        self.mbes_history = []
+        # Particles' maps as a batched GP for the weights, see self.batch_maps
+        self.batch_gp = None
+        self.batch_gp_key = None
+        # Training of the particles' GPs, same in this node and in the pool:
+        # each GP stops at its own convergence
+        self.gp_fit_args = dict(n_samples=100, max_iter=200, learning_rate=1e-1,
+                                rtol=1e-4, n_window=100, auto=True, verbose=False)
+        # Process pool training the particles' maps, 0 to train them in this node
+        self.n_map_workers = rospy.get_param("~map_workers", 0)
+        self.map_pool = None
+        # (T,beams,3) pings in vehicle mbes frame, in shared memory for the pool
+        if self.n_map_workers > 0:
+            self.map_pool = MapWorkerPool(self.n_map_workers, self.beams_num)
+            rospy.on_shutdown(self.map_pool.close)
+            self.mbes_history = self.map_pool.mbes_history
+        else:
+            self.mbes_history = ArrayHistory((self.beams_num, 3))
+        # The ping history and the particles' pose histories are appended by
+        # mbes_real_cb and read by the rbpf_update timer: both under this lock
+        self.history_lock = threading.Lock()
         self.latest_mbes = PointCloud2()
         self.count_pings = 0
         self.prev_mbes = PointCloud2()
@@ -116,7 +130,6 @@ class rbpf_slam(object):
         self.one_time = True
         self.time2resample = False
         self.count_training = 0
-        self.pw = [1.e-50] * self.pc # Start with almost zero weight
         # for ancestry tree
         self.observations = np.zeros((1,3)) 
         self.mapping= np.zeros((1,3)) 
@@ -129,6 +142,10 @@ class rbpf_slam(object):
         # Nacho
         self.pings_since_training = 0
         self.map_updates = 0
+        # Incremental map training: warm-start the particles' GPs with the new pings
+        # plus a random replay of the points they have already been trained on
+        self.incremental_training = rospy.get_param("~incremental_map_training", True)
+        self.replay_size = rospy.get_param("~map_replay_size", 1000)
 
         # Initialize particle poses publisher
         pose_array_top = rospy.get_param("~particle_poses_topic", '/particle_poses')
@@ -227,19 +244,20 @@ class rbpf_slam(object):
         except:
             rospy.loginfo("ERROR: Could not lookup transform from base_link to mbes_link")
 
-        # Initialize list of particles
+        # Initialize list of particles. They all start with the same empty map
+        init_map = ParticleMap()
         self.particles = np.empty(self.pc, dtype=object)
         for i in range(self.pc-1):
             self.particles[i] = Particle(self.beams_num, self.pc, i, self.base2mbes_mat,
                                          self.m2o_mat, init_cov=init_cov, meas_std=meas_std,
-                                         process_cov=motion_cov)
+                                         process_cov=motion_cov, p_map=init_map)
             self.particles[i].ID = self.p_ID
             self.p_ID += 1
         
         # Create one particle on top of vehicle for tests with very few
         self.particles[i+1] = Particle(self.beams_num, self.pc, i+1, self.base2mbes_mat,
                                          self.m2o_mat, init_cov=[0.]*6, meas_std=meas_std,
-                                         process_cov=[0.]*6)
+                                         process_cov=[0.]*6, p_map=init_map)
         self.particles[i].ID = self.p_ID
         self.p_ID += 1
         
@@ -297,12 +315,16 @@ class rbpf_slam(object):
     def mbes_real_cb(self, msg):
         if not self.mission_finished:
             # Beams in vehicle mbes frame
-            real_mbes_full = pcloud2ranges_full(msg)
+            real_mbes_full = decode_cloud(msg)
             # Selecting only self.beams_num of beams in the ping
             idx = np.round(np.linspace(0, len(real_mbes_full)-1,
                                             self.beams_num)).astype(int)
-            # Store in pings history
-            self.mbes_history.append(real_mbes_full[idx])
+            # Store in pings history, with the particles' poses at the time of the ping
+            with self.history_lock:
+                self.mbes_history.append(real_mbes_full[idx])
+                for i in range(self.pc):
+                    self.particles[i].update_pose_history()
+                self.pings_since_training += 1
             
             # Store latest mbes msg for timing
             self.latest_mbes = msg
@@ -311,8 +333,6 @@ class rbpf_slam(object):
             for i in range(self.pc):
                 self.particles[i].ctr += 1
 
-            self.pings_since_training += 1
-
     def rbpf_update(self, event):
         if not self.mission_finished:
             if self.latest_mbes.header.stamp > self.prev_mbes.header.stamp:    
@@ -323,9 +343,9 @@ class rbpf_slam(object):
                 # If potential LC detected
                 if(self.lc_detected ):
                     # Recompute weights
-                    weights = self.update_particles_weights(self.latest_mbes, self.odom_latest)
+                    log_weights = self.update_particles_weights(self.latest_mbes, self.odom_latest)
                     # Particle resampling
-                    self.resample(weights)
+                    self.resample(log_weights)
                     self.lc_detected = False
 
 
@@ -347,7 +367,6 @@ class rbpf_slam(object):
 
     def plot_gp_maps(self):
         print("------ Plot final maps --------")
-        R = self.base2mbes_mat.transpose()[0:3,0:3]
 
         # For sequential plotting on this node
         # Wait until GP training is done to not overload GPU. 
@@ -361,27 +380,18 @@ class rbpf_slam(object):
             #                                         PlotPosteriorAction)
             # ac_plot.wait_for_server()
 
-            part_ping_map = []
-            for j in range(0, len(self.mbes_history)): 
-                # For particle i, get all its trajectory in the map frame
-                p_part, r_mbes = self.particles[i].pose_history[j]
-                r_base = r_mbes.dot(R) # The GP sampling uses the base_link orientation 
-
-                part_i_ping_map = np.dot(r_base, self.mbes_history[j].T)
-                part_ping_map.append(np.add(part_i_ping_map.T, p_part)) 
-            # As array
-            pings_i = np.asarray(part_ping_map)
-            pings_i = np.reshape(pings_i, (-1,3))   
+            with self.history_lock:
+                pings_i = self.particle_map_points(i)
 
             # For sequential plotting on this node
-            self.particles[i].gp.plot(pings_i[:, 0:2], pings_i[:, 2],
+            self.particles[i].map.gp.plot(pings_i[:, 0:2], pings_i[:, 2],
                 self.storage_path + 'particle_' + str(i) 
                 + '_training_' + str(self.count_training) + '.png',
                 n=100, n_contours=100 )        
                 
             # For parallel plotting on secondary node 
             # Send to GP particle server
-            # mbes_pcloud = pack_cloud(self.map_frame, pings_i)
+            # mbes_pcloud = encode_cloud(self.map_frame, pings_i)
             # goal = PlotPosteriorGoal(mbes_pcloud)
             # ac_plot.send_goal(goal)
             # ac_plot.wait_for_result()
@@ -393,7 +403,6 @@ class rbpf_slam(object):
         dt = self.time - self.old_time
         for i in range(0, self.pc):
             self.particles[i].motion_pred(odom_t, dt)
-            self.particles[i].update_pose_history()
 
         # Predict DR
         self.dr_particle.motion_pred(odom_t, dt)
@@ -402,7 +411,7 @@ class rbpf_slam(object):
     def update_particles_weights(self, mbes_ping, odom):
 
         # Latest ping in vehicle mbes frame
-        latest_mbes = pcloud2ranges_full(mbes_ping)
+        latest_mbes = decode_cloud(mbes_ping)
         # Selecting only self.beams_num of beams in the ping
         idx = np.round(np.linspace(0, len(latest_mbes)-1,
                                            self.beams_num)).astype(int)
@@ -414,106 +423,186 @@ class rbpf_slam(object):
 
         # Calculate expected meas from the particles GP
         R = self.base2mbes_mat.transpose()[0:3,0:3]
-        for i in range(0, self.pc):
-            # AS for particle i
-            # ac_sample = actionlib.SimpleActionClient("/particle_" + str(i) + self.sample_gp_server, 
-            #                                         SamplePosteriorAction)
-            # ac_sample.wait_for_server()
-
-            # Convert ping from particle MBES to map frame
-            p_part, r_mbes = self.particles[i].pose_history[-1]
-            r_base = r_mbes.dot(R) # The GP sampling uses the base_link orientation 
-            latest_mbes_map = np.dot(r_base, latest_mbes.T)
-            latest_mbes_map = np.add(latest_mbes_map.T, p_part)
-
-            # As array
-            beams_i = np.asarray(latest_mbes_map)
-            beams_i = np.reshape(beams_i, (-1,3))         
-            mu, sigma = self.particles[i].gp.sample(np.asarray(beams_i)[:, 0:2])
-            
-            # mbes_pcloud = pack_cloud(self.map_frame, pings_i)
-            # goal = SamplePosteriorGoal(mbes_pcloud)
-
-            # # Send to as and wait
-            # ac_sample.send_goal(goal)
-            # ac_sample.wait_for_result()
-            # result = ac_sample.get_result()  
-
-            # Sample GP with the ping in map frame
-            # mu, sigma = result.mu, result.sigma
-            
-            mu_array = np.array([mu])
+        beams = []
+        with self.history_lock:
+            # Particles' poses at the latest ping of the history
+            last = len(self.mbes_history) - 1
+            for i in range(0, self.pc):
+                # Convert ping from particle MBES to map frame
+                p_part, r_mbes = self.particles[i].trajectory(last)
+                p_part, r_mbes = p_part[0], r_mbes[0]
+                r_base = r_mbes.dot(R) # The GP sampling uses the base_link orientation 
+                latest_mbes_map = np.dot(r_base, latest_mbes.T)
+                beams.append(np.add(latest_mbes_map.T, p_part)[:, 0:2])
 
-            # TODO: use the sigmas from the GP on the weight calculation
-            sigma_array = np.array([sigma])
+        # Sample each particle's GP with its ping in map frame:
+        # all the particles' maps evaluated in one batched call
+        exp_mbes_z, _ = self.batch_maps().sample(np.stack(beams))
+        # TODO: use the sigmas from the GP on the weight calculation
 
-            # Concatenate sampling points x,y with sampled z
-            exp_mbes = np.concatenate((np.asarray(latest_mbes_map)[:, 0:2], mu_array.T), axis=1)
+        # Compute all the particles log-weights at once
+        log_weights = log_likelihood(exp_mbes_z, latest_mbes_z, self.meas_std**2)
 
-            # Compute particles weight
-            self.particles[i].compute_weight(exp_mbes, latest_mbes_z)
-        
-        weights = []
-        for i in range(self.pc):
-            weights.append(self.particles[i].w) 
         # Number of particles that missed some beams 
         # (if too many it would mess up the resampling)
-        self.miss_meas = weights.count(0.0)
-        weights_array = np.asarray(weights)
-        # Add small non-zero value to avoid hitting zero
-        weights_array += 1.e-200
-        return weights_array
+        self.miss_meas = np.count_nonzero(np.isneginf(log_weights))
+        return log_weights
+
+
+    def batch_maps(self):
+        # Particles' GPs stacked in a BatchSVGP, rebuilt when they have been
+        # retrained or reassigned since the last call
+        key = (self.count_training, tuple(id(p.map) for p in self.particles))
+        if self.batch_gp is None or self.batch_gp_key != key:
+            self.batch_gp = BatchSVGP.stack([p.map.gp for p in self.particles])
+            self.batch_gp.cache_posterior()
+            self.batch_gp_key = key
+        return self.batch_gp
+
+    def particle_map_points(self, i, start=0, end=None):
+        # Transform the MBES pings in vehicle frame from start onwards 
+        # to particle i's trajectory (result in map frame)
+        return self.map_points(start, [i], end)[0]
+
+    def map_points(self, start=0, particles=None, end=None):
+        # Same for several particles at once: (particles, pings*beams, 3) array
+        # Pings [start, end), all of them by default. Call with history_lock held
+        if particles is None:
+            particles = range(self.pc)
+        if end is None:
+            end = len(self.mbes_history)
+        R = self.base2mbes_mat.transpose()[0:3,0:3]
+        pings = self.mbes_history.array()[start:end]
+        trajectories = [self.particles[i].trajectory(start) for i in particles]
+        p_part = np.stack([t[0][:end - start] for t in trajectories])
+        r_mbes = np.stack([t[1][:end - start] for t in trajectories])
+        r_base = np.matmul(r_mbes, R) # The GP sampling uses the base_link orientation 
 
+        points = np.einsum('ntij,tbj->ntbi', r_base, pings) + p_part[:, :, np.newaxis, :]
+        return points.reshape(len(particles), -1, 3)
 
     def update_maps(self, real_mbes, odom):
              
-        # To transform from base to mbes
-        R = self.base2mbes_mat.transpose()[0:3,0:3]
-        
         # If time to retrain GP map
         if self.pings_since_training > 50:
             self.map_updates += 1
-            for i in range(0, self.pc):           
-                # Transform each MBES ping in vehicle frame to the particle trajectory 
-                # (result in map frame)
-                part_ping_map = []
-                for j in range(0, len(self.mbes_history)): 
-                    # For particle i, get all its trajectory in the map frame
-                    p_part, r_mbes = self.particles[i].pose_history[j]
-                    r_base = r_mbes.dot(R) # The GP sampling uses the base_link orientation 
-
-                    part_i_ping_map = np.dot(r_base, self.mbes_history[j].T)
-                    part_ping_map.append(np.add(part_i_ping_map.T, p_part)) 
-                # As array
-                pings_i = np.asarray(part_ping_map)
-                pings_i = np.reshape(pings_i, (-1,3))     
-                print(pings_i)       
-                    
+            if self.map_pool is not None:
+                self.update_maps_pool()
+                return
+            # Number of particles sharing each map since the last resampling
+            map_users = Counter(id(p.map) for p in self.particles)
+            inputs, targets = [], []
+            # The maps are trained on the pings up to here, the ones arriving
+            # meanwhile go to the next round
+            with self.history_lock:
+                end = len(self.mbes_history)
+                for i in range(0, self.pc):           
+                    # Copy-on-write: a shared map is copied before being retrained
+                    if map_users[id(self.particles[i].map)] > 1:
+                        map_users[id(self.particles[i].map)] -= 1
+                        self.particles[i].map = self.particles[i].map.copy()
+                    p_map = self.particles[i].map
+
+                    if self.incremental_training and p_map.gp_trained:
+                        # Only the pings since the last training need to be transformed
+                        new_points = self.particle_map_points(i, p_map.pings_mapped, end)
+                        # Replay of old points to keep the map where there are no new pings
+                        n_replay = min(self.replay_size, len(p_map.map_points))
+                        replay = p_map.map_points[np.random.choice(len(p_map.map_points), 
+                                                                   n_replay, replace=False)]
+                        p_map.map_points = np.vstack((p_map.map_points, new_points))
+                        pings_i = np.vstack((new_points, replay))
+                    else:
+                        p_map.map_points = self.particle_map_points(i, end=end)
+                        pings_i = p_map.map_points
+                    p_map.pings_mapped = end
+
+                    inputs.append(pings_i[:,0:2])
+                    targets.append(pings_i[:,2])
+
+            for i in range(0, self.pc):
+                p_map = self.particles[i].map
                 # Publish (for visualization)
-                mbes_pcloud = pack_cloud(self.map_frame, pings_i)
+                mbes_pcloud = encode_cloud(self.map_frame, p_map.map_points)
 
                 self.pcloud_pub = rospy.Publisher("/particle_" + str(i) + self.mbes_pc_top, PointCloud2, queue_size=10)
                 self.pcloud_pub.publish(mbes_pcloud)
 
-                # Retrain the particle's GP
-                print("Training GP ", i)
-                # n_samples = a fourth of the total number of beams
-                self.particles[i].gp.fit(pings_i[:,0:2], pings_i[:,2], n_samples= 100, 
-                                         max_iter=200, learning_rate=1e-1, rtol=1e-4, 
-                                         ntol=100, auto=False, verbose=False)
-                # # Plot posterior
-                # self.particles[i].gp.plot(pings_i[:,0:2], pings_i[:,2], 
-                #                           self.storage_path + 'gp_result/' + 'particle_' + str(i) 
-                #                           + '_training_' + str(self.count_training) + '.png',
-                #                           n=100, n_contours=100 )
-                
-                print("GP trained ", i)
-
-            # Reset pings for training
+            # Retrain all the particles' GPs as one batched model, each one
+            # stopping at its own convergence
+            print("Training GPs")
+            warm_start = self.incremental_training and all(p.map.gp_trained for p in self.particles)
+            gps = [p.map.gp for p in self.particles]
+            batch_gp = BatchSVGP.stack(gps)
+            batch_gp.fit(inputs, targets, warm_start=warm_start, **self.gp_fit_args)
+            batch_gp.unstack(gps)
+            for p in self.particles:
+                p.map.gp_trained = True
+                # Frozen until next training: precompute its posterior
+                p.map.gp.cache_posterior()
+            print("GPs trained")
+
+            # Reset pings for training, keeping those that arrived meanwhile
             self.count_training += 1
-            self.pings_since_training = 0
+            with self.history_lock:
+                self.pings_since_training = len(self.mbes_history) - end
+
+            # The trained batch is also the one used for the weights
+            batch_gp.cache_posterior()
+            self.batch_gp = batch_gp
+            self.batch_gp_key = (self.count_training, tuple(id(p.map) for p in self.particles))
+
+    def update_maps_pool(self):
+
+        # Same as update_maps, with all the particles' GPs trained in parallel by the pool
+        map_users = Counter(id(p.map) for p in self.particles)
+        maps, trajectories, starts, replays = [], [], [], []
+        with self.history_lock:
+            end = len(self.mbes_history)
+            for i in range(0, self.pc):
+                if map_users[id(self.particles[i].map)] > 1:
+                    map_users[id(self.particles[i].map)] -= 1
+                    self.particles[i].map = self.particles[i].map.copy()
+                p_map = self.particles[i].map
+
+                start = 0
+                replay = np.zeros((0, 3))
+                if self.incremental_training and p_map.gp_trained:
+                    start = p_map.pings_mapped
+                    n_replay = min(self.replay_size, len(p_map.map_points))
+                    replay = p_map.map_points[np.random.choice(len(p_map.map_points), 
+                                                               n_replay, replace=False)]
+                maps.append(p_map)
+                # Poses up to the snapshot, copied as the leaves keep growing
+                pos, rots = self.particles[i].trajectory(start)
+                trajectories.append((pos[:end - start].copy(), rots[:end - start].copy()))
+                starts.append(start)
+                replays.append(replay)
+
+        print("Training GPs in the map workers")
+        R = self.base2mbes_mat.transpose()[0:3,0:3]
+        points = self.map_pool.fit(maps, trajectories, starts, R, replays, self.gp_fit_args)
+
+        for i, p_map in enumerate(maps):
+            if starts[i] > 0:
+                p_map.map_points = np.vstack((p_map.map_points, points[i]))
+            else:
+                p_map.map_points = points[i]
+            p_map.pings_mapped = end
+            p_map.gp_trained = True
+            p_map.gp.cache_posterior()
+
+            # Publish (for visualization)
+            mbes_pcloud = encode_cloud(self.map_frame, p_map.map_points)
+            self.pcloud_pub = rospy.Publisher("/particle_" + str(i) + self.mbes_pc_top, PointCloud2, queue_size=10)
+            self.pcloud_pub.publish(mbes_pcloud)
+        print("GPs trained")
+
+        # Reset pings for training, keeping those that arrived meanwhile
+        self.count_training += 1
+        with self.history_lock:
+            self.pings_since_training = len(self.mbes_history) - end
 
-   
     def publish_stats(self, gt_odom):
         # Send statistics for visualization
         p_odom = self.dr_particle.p_pose
@@ -538,26 +627,17 @@ class rbpf_slam(object):
         self.stats.publish(stats) 
 
 
-    def ping2ranges(self, point_cloud):
-        ranges = []
-        cnt = 0
-        for p in pc2.read_points(point_cloud, 
-                                 field_names = ("x", "y", "z"), skip_nans=True):
-            ranges.append(np.linalg.norm(p[-2:]))
-        
-        return np.asarray(ranges)
-    
     def moving_average(self, a, n=3) :
         ret = np.cumsum(a, dtype=float)
         ret[n:] = ret[n:] - ret[:-n]
         return ret[n - 1:] / n
 
-    def resample(self, weights):
-        # Normalize weights
-        weights /= weights.sum()
+    def resample(self, log_weights):
+        # Normalize weights in the log domain
+        weights, log_norm = normalize_log_weights(log_weights)
         N_eff = self.pc
 
-        if weights.sum() == 0.:
+        if np.isneginf(log_norm):
             rospy.loginfo("All weights zero!")
         else:
             N_eff = 1/np.sum(np.square(weights))
@@ -580,22 +660,36 @@ class rbpf_slam(object):
             rospy.loginfo('resampling')
             print ("Missed meas ", self.miss_meas)
             indices = residual_resample(weights)
-            keep = list(set(indices))
-            lost = [i for i in range(self.pc) if i not in keep]
-            dupes = indices[:].tolist()
-            for i in keep:
-                dupes.remove(i)
+            lost, dupes = copy_map(indices)
 
-            self.reassign_poses(lost, dupes)
+            # The ancestry tree can't change under mbes_real_cb's appends
+            with self.history_lock:
+                self.reassign_poses(lost, dupes)
             
             # Add noise to particles
             # for i in range(self.pc):
             #     self.particles[i].add_noise(self.res_noise_cov)
 
     def reassign_poses(self, lost, dupes):
-        for i in range(len(lost)):
-            # Faster to do separately than using deepcopy()
-            self.particles[lost[i]].p_pose = self.particles[dupes[i]].p_pose
+        # The lost particles continue the lineage of their dupes: the dupe and its
+        # copies branch from its node of the ancestry tree and share its map, so 
+        # neither the trajectory nor the GP are copied
+        old_leaves = [self.particles[l].node for l in lost]
+        branched = {}
+        for l, d in zip(lost, dupes):
+            dupe = self.particles[d]
+            if d not in branched:
+                branched[d] = dupe.node
+                dupe.node = branched[d].branch(self.p_ID)
+                self.p_ID += 1
+            self.particles[l].node = branched[d].branch(self.p_ID)
+            self.p_ID += 1
+            self.particles[l].p_pose = np.copy(dupe.p_pose)
+            self.particles[l].map = dupe.map
+
+        # Free the trajectories of the lineages that died out
+        for leaf in old_leaves:
+            leaf.prune()
     
     def average_pose(self, pose_list):
         poses_array = np.array(pose_list)
@@ -14,7 +14,7 @@ import tf2_ros
 from rbpf_particle import matrix_from_tf
 from sensor_msgs.msg import PointCloud2
 import message_filters
-import sensor_msgs.point_cloud2 as pc2
+from auv_utils.ping_codec import decode_cloud
 
 class PFStatsVisualization(object):
     
@@ -131,21 +131,14 @@ class PFStatsVisualization(object):
 
 
     def ping_cb(self, real_ping, pf_ping):
-        real_meas = self.ping_to_array(real_ping)
-        pf_meas = self.ping_to_array(pf_ping)
+        real_meas = decode_cloud(real_ping)
+        pf_meas = decode_cloud(pf_ping)
         
         idx = np.round(np.linspace(0, np.size(real_meas, 0)-1,
                                    np.size(pf_meas, 0))).astype(int)
         real_meas = real_meas[idx, :]
         self.pings_vec = np.hstack((real_meas, pf_meas))
 
-    def ping_to_array(self, point_cloud):
-        ranges = []
-        for p in pc2.read_points(point_cloud, 
-                                 field_names = ("x", "y", "z"), skip_nans=True):
-            ranges.append(p)
-        return np.asarray(ranges)
-
     def synch_cb(self, finished_msg):
         self.survey_finished = finished_msg.data
         np.savez(self.result_path+".npz", full_dataset=self.filt_vec.tolist())
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+
+import numpy as np
+from scipy.special import logsumexp
+
+
+def log_likelihood(exp_ranges, real_ranges, var):
+
+    '''
+    Gaussian log-likelihood of a real ping given the expected pings of all
+    the particles. The beams are independent, so the covariance is diagonal.
+    exp_ranges: (N,beams) numpy array of expected depths, NaN for missed beams
+    real_ranges: (beams,) numpy array of measured depths
+    var: scalar, (beams,) or (N,beams) numpy array of variances per beam
+    returns:
+        log_w: (N,) numpy array of log-weights, -inf if the particle missed beams
+    '''
+
+    exp_ranges = np.atleast_2d(exp_ranges)
+    var = np.broadcast_to(var, exp_ranges.shape)
+
+    # residuals of all the particles at once
+    res = exp_ranges - np.asarray(real_ranges)
+    log_w = -0.5 * np.sum(res**2 / var + np.log(2. * np.pi * var), axis=1)
+
+    # a particle with missing beams can't be compared to the real ping
+    log_w[np.isnan(log_w)] = -np.inf
+
+    return log_w
+
+
+def normalize_log_weights(log_w):
+
+    '''
+    Normalises log-weights with the log-sum-exp trick to avoid underflows.
+    log_w: (N,) numpy array of log-weights
+    returns:
+        weights: (N,) numpy array of normalised weights, uniform if all are -inf
+        log_norm: log of the normaliser, -inf if all the weights are zero
+    '''
+
+    log_norm = logsumexp(log_w)
+    if not np.isfinite(log_norm):
+        return np.full(len(log_w), 1./len(log_w)), log_norm
+
+    return np.exp(log_w - log_norm), log_norm
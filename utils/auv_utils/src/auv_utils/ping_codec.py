@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import rospy
+from sensor_msgs.msg import PointCloud2, PointField
+from std_msgs.msg import Header
+
+
+# PointField datatypes to numpy types
+_DATATYPES = {PointField.INT8: 'i1', PointField.UINT8: 'u1',
+              PointField.INT16: 'i2', PointField.UINT16: 'u2',
+              PointField.INT32: 'i4', PointField.UINT32: 'u4',
+              PointField.FLOAT32: 'f4', PointField.FLOAT64: 'f8'}
+
+_XYZ_FIELDS = [PointField('x', 0, PointField.FLOAT32, 1),
+               PointField('y', 4, PointField.FLOAT32, 1),
+               PointField('z', 8, PointField.FLOAT32, 1)]
+
+
+def cloud_dtype(point_cloud, field_names=("x", "y", "z")):
+
+    '''
+    Structured numpy dtype of one point of a PointCloud2, restricted to
+    field_names but keeping the offsets and point_step of the message
+    '''
+
+    fields = {f.name: f for f in point_cloud.fields}
+    endian = '>' if point_cloud.is_bigendian else '<'
+
+    return np.dtype({'names': list(field_names),
+                     'formats': [endian + _DATATYPES[fields[n].datatype]
+                                 for n in field_names],
+                     'offsets': [fields[n].offset for n in field_names],
+                     'itemsize': point_cloud.point_step})
+
+
+def decode_cloud(point_cloud, field_names=("x", "y", "z"), skip_nans=True):
+
+    '''
+    Reads the points of a PointCloud2 without iterating over them. The
+    message buffer is viewed with the structured dtype of its fields, only
+    the requested fields are copied out.
+    point_cloud: PointCloud2 msg
+    field_names: fields to read, in order
+    skip_nans: drop the points with a NaN in any of the fields
+    returns:
+        points: (n,len(field_names)) numpy array
+    '''
+
+    view = np.ndarray(shape=(point_cloud.height, point_cloud.width),
+                      dtype=cloud_dtype(point_cloud, field_names),
+                      buffer=point_cloud.data,
+                      strides=(point_cloud.row_step, point_cloud.point_step))
+
+    points = np.empty((point_cloud.height * point_cloud.width, len(field_names)))
+    for i, name in enumerate(field_names):
+        points[:, i] = view[name].ravel()
+
+    if skip_nans:
+        points = points[~np.isnan(points).any(axis=1)]
+
+    return points
+
+
+def ping_ranges(point_cloud):
+
+    '''
+    Ranges of the beams of a MBES ping in the sensor frame (norm over y-z)
+    point_cloud: PointCloud2 msg
+    returns:
+        ranges: (n,) numpy array
+    '''
+
+    return np.linalg.norm(decode_cloud(point_cloud)[:, 1:3], axis=1)
+
+
+def encode_cloud(frame, points, stamp=None):
+
+    '''
+    Creates a PointCloud2 msg with float32 x, y, z fields out of a ping
+    by serializing the array in one go
+    frame: frame_id of the msg
+    points: (n,3) numpy array
+    stamp: time stamp of the msg, now by default
+    returns:
+        point_cloud: PointCloud2 msg
+    '''
+
+    points = np.ascontiguousarray(points, dtype='<f4').reshape(-1, 3)
+
+    header = Header()
+    header.stamp = rospy.Time.now() if stamp is None else stamp
+    header.frame_id = frame
+
+    return PointCloud2(header=header, height=1, width=len(points),
+                       fields=_XYZ_FIELDS, is_bigendian=False,
+                       point_step=12, row_step=12 * len(points),
+                       data=points.tobytes(), is_dense=False)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+
+def mbes_beam_dirs(n_beams, beam_width):
+
+    '''
+    Beam directions of a MBES in its own frame, same convention as the
+    auvlib draper: the swath lies on the y-z plane and points along -z.
+    n_beams: number of beams
+    beam_width: opening angle of the swath [rad]
+    returns:
+        dirs: (beams,3) numpy array of unit vectors
+    '''
+
+    angles = -0.5 * beam_width + beam_width / n_beams * np.arange(n_beams)
+    return np.column_stack((np.zeros(n_beams), np.sin(angles), -np.cos(angles)))
+
+
+# Row-wise products of (3,M) arrays, cheaper than np.cross/einsum on (M,3) ones
+def _cross(a, b):
+    return np.stack((a[1] * b[2] - a[2] * b[1],
+                     a[2] * b[0] - a[0] * b[2],
+                     a[0] * b[1] - a[1] * b[0]))
+
+def _dot(a, b):
+    return a[0] * b[0] + a[1] * b[1] + a[2] * b[2]
+
+
+class MeshRaycaster(object):
+
+    '''
+    Casts the straight beams of simulated MBES pings from many sensor poses
+    at once against a triangle mesh (the V, F arrays in mesh.npz).
+
+    Bathymetry meshes are 2.5D, so the triangles are binned on a uniform
+    grid over the x-y plane. Each ray is clipped to the bounding box of the
+    mesh and only tested against the triangles of the cells its x-y
+    footprint overlaps, with a vectorized Moller-Trumbore intersection.
+    '''
+
+    def __init__(self, V, F, cell_size=None, eps=1e-9):
+
+        V = np.asarray(V, dtype=np.float64)
+        F = np.asarray(F, dtype=np.int64)
+        self.eps = eps
+
+        # Per triangle terms of the intersection test
+        self.v0 = V[F[:, 0]]
+        self.e1 = V[F[:, 1]] - self.v0
+        self.e2 = V[F[:, 2]] - self.v0
+
+        self.lb = V.min(axis=0)
+        self.ub = V.max(axis=0)
+
+        tri_lb = np.minimum(np.minimum(V[F[:, 0]], V[F[:, 1]]), V[F[:, 2]])[:, 0:2]
+        tri_ub = np.maximum(np.maximum(V[F[:, 0]], V[F[:, 1]]), V[F[:, 2]])[:, 0:2]
+
+        # Cells about one triangle wide by default
+        if cell_size is None:
+            cell_size = np.median(np.max(tri_ub - tri_lb, axis=1))
+        self.cell_size = max(float(cell_size), eps)
+        self.n_cells = (np.floor((self.ub[0:2] - self.lb[0:2]) / self.cell_size)
+                        .astype(np.int64) + 1)
+
+        # Bin each triangle in all the cells its bounding box overlaps
+        c_lb = self._cell(tri_lb)
+        c_ub = self._cell(tri_ub)
+        span = c_ub - c_lb + 1
+        tri_idx, cell_idx = self._expand(c_lb, span)
+
+        # CSR layout: triangles of cell c are tri_ids[cell_start[c]:cell_start[c+1]]
+        order = np.argsort(cell_idx, kind='stable')
+        self.tri_ids = tri_idx[order]
+        counts = np.bincount(cell_idx, minlength=np.prod(self.n_cells))
+        self.cell_start = np.concatenate(([0], np.cumsum(counts)))
+
+        # Depth range of each cell, to skip the cells a ray passes above or below
+        tri_z = V[F, 2]
+        self.cell_zmin = np.full(len(counts), np.inf)
+        self.cell_zmax = np.full(len(counts), -np.inf)
+        np.minimum.at(self.cell_zmin, cell_idx, tri_z.min(axis=1)[tri_idx])
+        np.maximum.at(self.cell_zmax, cell_idx, tri_z.max(axis=1)[tri_idx])
+
+    def _cell(self, xy):
+        c = np.floor((xy - self.lb[0:2]) / self.cell_size).astype(np.int64)
+        return np.clip(c, 0, self.n_cells - 1)
+
+    def _expand(self, c_lb, span):
+
+        # All the (owner, cell) pairs of the rectangles of cells c_lb + [0, span)
+        n = span[:, 0] * span[:, 1]
+        owner = np.repeat(np.arange(len(c_lb)), n)
+        k = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        cx = c_lb[owner, 0] + k % span[owner, 0]
+        cy = c_lb[owner, 1] + k // span[owner, 0]
+
+        return owner, cy * self.n_cells[0] + cx
+
+    def cast_rays(self, origins, dirs):
+
+        '''
+        Closest intersection of each ray with the mesh
+        origins: (M,3) numpy array of ray origins
+        dirs: (M,3) numpy array of ray directions
+        returns:
+            hits: (M,3) numpy array of hit points, NaN for the rays that miss
+        '''
+
+        # Clip the rays to the bounding box of the mesh (slab method)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ta = (self.lb - origins) / dirs
+            tb = (self.ub - origins) / dirs
+        # Rays parallel to a slab: inside it for all t or never
+        parallel = dirs == 0.
+        outside = parallel & ((origins < self.lb) | (origins > self.ub))
+        ta[parallel] = -np.inf
+        tb[parallel] = np.inf
+        t0 = np.maximum(np.max(np.minimum(ta, tb), axis=1), 0.)
+        t1 = np.min(np.maximum(ta, tb), axis=1)
+        valid = np.flatnonzero((t0 <= t1) & ~np.any(outside, axis=1))
+
+        hits = np.full(origins.shape, np.nan)
+        if len(valid) == 0:
+            return hits
+
+        o = origins[valid]
+        d = dirs[valid]
+
+        # Cells overlapped by the x-y footprint of each clipped ray
+        p0 = o[:, 0:2] + t0[valid, None] * d[:, 0:2]
+        p1 = o[:, 0:2] + t1[valid, None] * d[:, 0:2]
+        c_lb = self._cell(np.minimum(p0, p1))
+        c_ub = self._cell(np.maximum(p0, p1))
+        ray, cell = self._expand(c_lb, c_ub - c_lb + 1)
+
+        # Keep the cells where the depths of the ray and the mesh overlap
+        cx = cell % self.n_cells[0]
+        cy = cell // self.n_cells[0]
+        c_min = self.lb[0:2] + self.cell_size * np.column_stack((cx, cy))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ta = (c_min - o[ray, 0:2]) / d[ray, 0:2]
+            tb = (c_min + self.cell_size - o[ray, 0:2]) / d[ray, 0:2]
+        ta[np.isnan(ta)] = -np.inf
+        tb[np.isnan(tb)] = np.inf
+        tc0 = np.maximum(np.max(np.minimum(ta, tb), axis=1), t0[valid][ray])
+        tc1 = np.minimum(np.min(np.maximum(ta, tb), axis=1), t1[valid][ray])
+        z0 = o[ray, 2] + tc0 * d[ray, 2]
+        z1 = o[ray, 2] + tc1 * d[ray, 2]
+        keep = ((tc0 <= tc1 + self.eps)
+                & (np.minimum(z0, z1) <= self.cell_zmax[cell] + self.eps)
+                & (np.maximum(z0, z1) >= self.cell_zmin[cell] - self.eps))
+        ray = ray[keep]
+        cell = cell[keep]
+
+        # Candidate (ray, triangle) pairs
+        n = self.cell_start[cell + 1] - self.cell_start[cell]
+        ray = np.repeat(ray, n)
+        k = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        tri = self.tri_ids[np.repeat(self.cell_start[cell], n) + k]
+
+        # Moller-Trumbore on all the pairs at once
+        dr = d[ray].T
+        e1 = self.e1[tri].T
+        e2 = self.e2[tri].T
+        tvec = (o[ray] - self.v0[tri]).T
+        pvec = _cross(dr, e2)
+        det = _dot(e1, pvec)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inv_det = 1. / det
+            u = _dot(tvec, pvec) * inv_det
+            qvec = _cross(tvec, e1)
+            v = _dot(dr, qvec) * inv_det
+            t = _dot(e2, qvec) * inv_det
+        hit = ((np.abs(det) > self.eps) & (u >= 0.) & (v >= 0.)
+               & (u + v <= 1.) & (t > self.eps))
+
+        # Closest hit per ray
+        t_min = np.full(len(valid), np.inf)
+        np.minimum.at(t_min, ray[hit], t[hit])
+        found = np.isfinite(t_min)
+        hits[valid[found]] = o[found] + t_min[found, None] * d[found]
+
+        return hits
+
+    def project_mbes(self, positions, rotations, n_beams, beam_width, batch_size=100000):
+
+        '''
+        Simulated MBES pings of many sensor poses at once
+        positions: (N,3) numpy array of MBES positions in the mesh frame
+        rotations: (N,3,3) numpy array of MBES orientations in the mesh frame
+        n_beams: number of beams per ping
+        beam_width: opening angle of the swath [rad]
+        batch_size: max number of rays cast together, bounds the memory
+        returns:
+            hits: (N,beams,3) numpy array of beam hits, NaN for missed beams
+        '''
+
+        positions = np.asarray(positions).reshape(-1, 3)
+        dirs = np.einsum('nij,bj->nbi', np.asarray(rotations).reshape(-1, 3, 3),
+                         mbes_beam_dirs(n_beams, beam_width)).reshape(-1, 3)
+        origins = np.repeat(positions, n_beams, axis=0)
+
+        hits = np.empty(origins.shape)
+        for i in range(0, len(origins), batch_size):
+            hits[i:i+batch_size] = self.cast_rays(origins[i:i+batch_size],
+                                                  dirs[i:i+batch_size])
+
+        return hits.reshape(len(positions), n_beams, 3)
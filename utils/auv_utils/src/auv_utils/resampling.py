@@ -1,23 +1,10 @@
-# -*- coding: utf-8 -*-
-# pylint: disable=C0103, R0913, R0902, C0326, R0914
-# disable snake_case warning, too many arguments, too many attributes,
-# one space before assignment, too many local variables
+#!/usr/bin/env python3
 
+"""Resampling schemes for particle filters.
 
-
-"""Copyright 2015 Roger R Labbe Jr.
-
-FilterPy library.
+Vectorized versions of the FilterPy resampling functions.
 http://github.com/rlabbe/filterpy
-
-Documentation at:
-https://filterpy.readthedocs.org
-
-Supporting book at:
-https://github.com/rlabbe/Kalman-and-Bayesian-Filters-in-Python
-
-This is licensed under an MIT license. See the readme.MD file
-for more information.
+Copyright 2015 Roger R Labbe Jr. MIT license.
 """
 
 import numpy as np
@@ -31,12 +18,11 @@ def residual_resample(weights):
     most of the weights. Take int(N*w^i) samples of each particle i, and then
     resample any remaining using a standard resampling algorithm [1]
 
-
     Parameters
     ----------
 
     weights : list-like of float
-        list of weights as floats
+        list of normalised weights as floats
 
     Returns
     -------
@@ -53,28 +39,25 @@ def residual_resample(weights):
        93(443):1032–1044, 1998.
     """
 
+    weights = np.asarray(weights)
     N = len(weights)
-    indexes = np.zeros(N, 'i')
 
     # take int(N*w) copies of each weight, which ensures particles with the
     # same weight are drawn uniformly
-    num_copies = (np.floor(N*np.asarray(weights))).astype(int)
-    k = 0
-    for i in range(N):
-        for _ in range(num_copies[i]): # make n copies
-            indexes[k] = i
-            k += 1
-
-    # use multinormal resample on the residual to fill up the rest. This
+    num_copies = np.floor(N*weights).astype(int)
+    indexes = np.repeat(np.arange(N), num_copies)
+    k = len(indexes)
+    if k == N:
+        return indexes
+
+    # use multinomial resample on the residual to fill up the rest. This
     # maximizes the variance of the samples
-    residual = weights - num_copies     # get fractional part
-    residual /= sum(residual)           # normalize
+    residual = N*weights - num_copies   # get fractional part
+    residual /= residual.sum()          # normalize
     cumulative_sum = np.cumsum(residual)
     cumulative_sum[-1] = 1. # avoid round-off errors: ensures sum is exactly one
-    indexes[k:N] = np.searchsorted(cumulative_sum, random(N-k))
-
-    return indexes
 
+    return np.concatenate((indexes, np.searchsorted(cumulative_sum, random(N-k))))
 
 
 def stratified_resample(weights):
@@ -88,7 +71,7 @@ def stratified_resample(weights):
     Parameters
     ----------
     weights : list-like of float
-        list of weights as floats
+        list of normalised weights as floats
 
     Returns
     -------
@@ -100,36 +83,9 @@ def stratified_resample(weights):
 
     N = len(weights)
     # make N subdivisions, and chose a random position within each one
-    positions = (random(N) + range(N)) / float(N)
-
-    indexes = np.zeros(N, 'i')
-    cumulative_sum = np.cumsum(weights)
-    i, j = 0, 0
-    while i < N:
-        if positions[i] < cumulative_sum[j]:
-            indexes[i] = j
-            i += 1
-        else:
-            j += 1
-    return indexes
-
-def naive_resample(weights):
-    
-    N = len(weights)
-    cdf = np.cumsum(weights)
-    #  print cdf
-    #  print self.pc
-    base = np.arange(0.0,1.0,1/float(N))
-    resample_id = base + np.random.uniform(0, 1./float(N))
-    ind = 0
-    indexes = []
-    for i in range(N):
-        while resample_id[i] > cdf[ind]:
-            ind += 1
-        indexes.append(ind)
-
-    return indexes
+    positions = (random(N) + np.arange(N)) / float(N)
 
+    return _select(weights, positions)
 
 
 def systematic_resample(weights):
@@ -142,7 +98,7 @@ def systematic_resample(weights):
     Parameters
     ----------
     weights : list-like of float
-        list of weights as floats
+        list of normalised weights as floats
 
     Returns
     -------
@@ -151,36 +107,38 @@ def systematic_resample(weights):
         array of indexes into the weights defining the resample. i.e. the
         index of the zeroth resample is indexes[0], etc.
     """
-    N = len(weights)
 
+    N = len(weights)
     # make N subdivisions, and choose positions with a consistent random offset
     positions = (random() + np.arange(N)) / float(N)
 
-    indexes = np.zeros(N, 'i')
+    return _select(weights, positions)
+
+
+def naive_resample(weights):
+    """ Systematic resampling with the offset drawn in [0, 1/N).
+    Kept for compatibility with the original particle filters.
+    """
+
+    N = len(weights)
+    positions = np.arange(N) / float(N) + np.random.uniform(0, 1./float(N))
+
     cumulative_sum = np.cumsum(weights)
-    i, j = 0, 0
-    while i < N:
-        if positions[i] < cumulative_sum[j]:
-            indexes[i] = j
-            i += 1
-        else:
-            j += 1
-    return indexes
+    cumulative_sum[-1] = 1.
+    return np.searchsorted(cumulative_sum, positions)
 
 
 def multinomial_resample(weights):
     """ This is the naive form of roulette sampling where we compute the
     cumulative sum of the weights and then use binary search to select the
     resampled point based on a uniformly distributed random number. Run time
-    is O(n log n). You do not want to use this algorithm in practice; for some
-    reason it is popular in blogs and online courses so I included it for
-    reference.
+    is O(n log n).
 
-   Parameters
-   ----------
+    Parameters
+    ----------
 
     weights : list-like of float
-        list of weights as floats
+        list of normalised weights as floats
 
     Returns
     -------
@@ -189,7 +147,42 @@ def multinomial_resample(weights):
         array of indexes into the weights defining the resample. i.e. the
         index of the zeroth resample is indexes[0], etc.
     """
+
     cumulative_sum = np.cumsum(weights)
     cumulative_sum[-1] = 1.  # avoid round-off errors: ensures sum is exactly one
     return np.searchsorted(cumulative_sum, random(len(weights)))
 
+
+def copy_map(indexes):
+    """ Turns the output of a resampling scheme into a copy map that keeps
+    the surviving particles in place.
+
+    Parameters
+    ----------
+
+    indexes : ndarray of ints
+        output of any of the resampling functions
+
+    Returns
+    -------
+
+    lost : ndarray of ints
+        particles that were not selected
+    dupes : ndarray of ints
+        extra copies of the particles selected more than once, with
+        len(dupes) == len(lost). Apply as poses[lost] = poses[dupes]
+    """
+
+    N = len(indexes)
+    counts = np.bincount(indexes, minlength=N)
+    lost = np.flatnonzero(counts == 0)
+    dupes = np.repeat(np.arange(N), np.maximum(counts - 1, 0))
+
+    return lost, dupes
+
+
+def _select(weights, positions):
+    # first particle whose cumulative weight is over each position
+    cumulative_sum = np.cumsum(weights)
+    cumulative_sum[-1] = 1.  # avoid round-off errors: ensures sum is exactly one
+    return np.searchsorted(cumulative_sum, positions, side='right')